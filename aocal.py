@@ -6,16 +6,30 @@ These files are not documented outside the source code, but you can find the rel
 
 The fit_complex_gains may be useful more widely so it is kept independent from tha aocal stuff.
 
-It should never be necessary to import the AOClass itself, rather it can be returned from the fromfile and zeros functions.
+It should never be necessary to import the AOClass itself, rather it can be returned from the fromfile, open and zeros functions.
 """
-import sys, os, struct, logging, glob
+import sys, os, io, struct, logging, glob, shutil, tempfile, contextlib, zlib
 from collections import namedtuple
 import numpy as np
 
+import profiling
+
 HEADER_FORMAT = "8s6I2d"
 HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
 HEADER_INTRO = b"MWAOCAL\0"
 
+# Chunked, compressed files have the same header with a different intro,
+# followed by CHUNKED_FORMAT (itemsize of the stored values: 16 for
+# complex128 or 8 for complex64, and the compression level), an index of
+# n_int*n_ant + 1 uint64 chunk offsets (relative to the end of the index),
+# and one zlib-compressed chunk per (interval, antenna), in that order.
+# Each chunk is a bit-packed (channel, polarisation) flag (NaN) bitmap,
+# followed by the unflagged values, byte-shuffled, and then the flagged values
+# as they are (so that their NaN payloads, and any non-NaN part, are kept).
+CHUNKED_INTRO = b"MWAOCALZ"
+CHUNKED_FORMAT = "2I"
+CHUNKED_SIZE = HEADER_SIZE + struct.calcsize(CHUNKED_FORMAT)
+
 Header = namedtuple("header", "intro fileType structureType intervalCount antennaCount channelCount polarizationCount timeStart timeEnd")
 Header.__new__.__defaults__ = (HEADER_INTRO, 0, 0, 0, 0, 0, 0, 0.0, 0.0)
 
@@ -27,7 +41,7 @@ if not sys.byteorder == 'little':
 else:
     logging.debug("byteorder=%s", sys.byteorder)
 
-def fit_complex_gains(v, mode='model', amp_order=5, fft_pad_factor=8):
+def fit_complex_gains(v, mode='model', amp_order=5, fft_pad_factor=8, clip_sigma=5.0, clip_iterations=5):
     """
     Fit amplitude & phases of a 1D array of complex values (v).
 
@@ -45,19 +59,24 @@ def fit_complex_gains(v, mode='model', amp_order=5, fft_pad_factor=8):
 
     Amplitudes are fit using a polynomial, unless amp_order is set to <1, in
     which case amplitudes are preserved.
+
+    With mode="clip", v is returned with outliers from the model flagged
+    instead (see fit_complex_gains_batch).
     """
+    if mode=="clip":
+        return fit_complex_gains_batch(v[np.newaxis], mode=mode, amp_order=amp_order, fft_pad_factor=fft_pad_factor, clip_sigma=clip_sigma, clip_iterations=clip_iterations)[0]
     good = ~np.isnan(v) # mask matching non-NaN values
     if sum(good) == 0:
         return v
     v_fft = np.fft.fft(np.nan_to_num(v*np.abs(v)**-3), n=fft_pad_factor*len(v))
-    v_index = np.arange(len(v), dtype=np.float)
-    gradient = float(np.abs(v_fft).argmax())/len(fft) # change in phase per increment of v due to phase wrap
+    v_index = np.arange(len(v), dtype=float)
+    gradient = float(np.abs(v_fft).argmax())/len(v_fft) # change in phase per increment of v due to phase wrap
     wrap = np.array(np.cos(2*np.pi*v_index*gradient), dtype = np.complex128)
     wrap.imag = np.sin(2*np.pi*v_index*gradient)
 
     # unwrap v, keeping only valid values
     u = v[good]/wrap[good]
-    u_index = np.arange(len(v), dtype=np.float)[good]
+    u_index = np.arange(len(v), dtype=float)[good]
     # centre on 0
     u_mean = np.average(u)
     u_mean /= np.abs(u_mean)
@@ -76,20 +95,252 @@ def fit_complex_gains(v, mode='model', amp_order=5, fft_pad_factor=8):
         amp_model = np.abs(v)
     if mode=="model":
         return np.where(good, amp_model*fit_complex*wrap*u_mean, np.nan)
-    elif mode=="clip":
-        # check np.angle(u0) statistics
-        # set "good" array to False where statistics are bad
-        # return original array where not newly flagged
-        #return np.where(good, v, np.nan)
-        raise RuntimeError("clip not implemented")
     else:
         raise RuntimeError("mode %s not implemented" % mode)
 
+def delay_gradients(v, fft_pad_factor=8):
+    """
+    Coarse delay of each spectrum (along the last axis) of v, as the phase
+    gradient in turns per channel, in [0, 1), from the peak of the padded FFT
+    (as in fit_complex_gains). NaN is treated as a flag.
+    """
+    n = v.shape[-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        v_fft = np.fft.fft(np.nan_to_num(v*np.abs(v)**-3), n=fft_pad_factor*n, axis=-1)
+    return np.abs(v_fft).argmax(axis=-1)/float(v_fft.shape[-1])
+
+def _fit_models(v, good, amp_order, fft_pad_factor):
+    """
+    The amplitude and (unit) phase models of fit_complex_gains_batch for the
+    spectra (rows) of the 2D array v, fitting only the values where good is
+    True (each row must have some). Both are in the precision of v.
+    """
+    dtype = v.dtype
+    real = np.finfo(dtype).dtype
+    n = v.shape[-1]
+    v_index = np.arange(n, dtype=real)
+
+    gradient = delay_gradients(np.where(good, v, np.nan), fft_pad_factor)
+    turns = np.outer(gradient, v_index)
+    if dtype == np.complex64:
+        # Up to thousands of turns, so reduced to [0, 1) in double precision first
+        turns = (np.outer(gradient, v_index.astype(np.float64)) % 1.0).astype(real)
+    wrap = np.exp(2j*np.pi*turns)
+
+    # unwrap v and centre on 0, flagged values contribute nothing
+    u = np.where(good, v/wrap, 0.0)
+    u_mean = u.sum(axis=1, dtype=np.complex128)/good.sum(axis=1)
+    u_mean = (u_mean/np.abs(u_mean)).astype(dtype)
+    u_phase = np.where(good, np.angle(u/u_mean[:, np.newaxis]), 0.0)
+    n_good = good.sum(axis=1)
+    phase_mean = u_phase.sum(axis=1, dtype=np.float64)/n_good
+    phase_var = np.where(good, (u_phase - phase_mean[:, np.newaxis].astype(real))**2, 0.0).sum(axis=1, dtype=np.float64)/n_good
+    if np.any(phase_var > 1):
+        logging.warn("high variance detected in phases of %d spectra, check output model!", np.count_nonzero(phase_var > 1))
+
+    # weighted least squares for a straight line. np.polyfit weights
+    # residuals by w=abs(u)**-2, i.e. each squared residual by abs(u)**-4
+    with np.errstate(divide='ignore'):
+        weight = np.where(good, np.abs(u).astype(np.float64)**-4, 0.0)
+    s_w = weight.sum(axis=1)
+    x_mean = (weight*v_index).sum(axis=1)/s_w
+    y_mean = (weight*u_phase).sum(axis=1)/s_w
+    dx = v_index - x_mean[:, np.newaxis]
+    s_xx = (weight*dx**2).sum(axis=1)
+    s_xy = (weight*dx*(u_phase - y_mean[:, np.newaxis])).sum(axis=1)
+    m = np.divide(s_xy, s_xx, out=np.zeros_like(s_xy), where=s_xx > 0)
+    c = y_mean - m*x_mean
+    fit_complex = np.exp(1j*(np.outer(m, v_index) + c[:, np.newaxis]).astype(real))
+
+    # fit poly to amplitudes, as a least squares fit in a Legendre basis on
+    # the scaled channel index (equivalent to, but better conditioned than, a
+    # power series)
+    if amp_order > 0:
+        basis = np.polynomial.legendre.legvander(2*v_index/max(n - 1, 1) - 1, amp_order)
+        gram = good.astype(float) @ (basis[:, :, np.newaxis]*basis[:, np.newaxis, :]).reshape(n, -1)
+        gram = gram.reshape(-1, amp_order + 1, amp_order + 1)
+        rhs = np.where(good, np.abs(v), 0.0) @ basis
+        coeffs = np.einsum('bij,bj->bi', np.linalg.pinv(gram), rhs)
+        amp_model = (coeffs @ basis.T).astype(real)
+    else:
+        amp_model = np.abs(v)
+
+    return amp_model, fit_complex*wrap*u_mean[:, np.newaxis]
+
+def _masked_median(x, good):
+    """
+    The median of the values of each row of the 2D array x where good is
+    True (each row must have some), without a loop over rows
+    """
+    n_good = good.sum(axis=1)
+    x = np.sort(np.where(good, x, np.inf), axis=1)
+    rows = np.arange(x.shape[0])
+    return 0.5*(x[rows, (n_good - 1)//2] + x[rows, n_good//2])
+
+def _local_fit(x, good, half_width=3, order=2):
+    """
+    For each channel of each row of the 2D array x, the value at that channel
+    of a polynomial of the given order, least squares fitted to the channels
+    within half_width of it on either side where good is True (but not to
+    the channel itself), i.e. a leave-one-out Savitzky-Golay smooth that
+    skips flags. NaN where fewer than order + 2 channels are available.
+    """
+    window = 2*half_width + 1
+    x = np.pad(np.where(good, x, 0.0).astype(np.float64), ((0, 0), (half_width, half_width)))
+    weight = np.pad(good.astype(np.float64), ((0, 0), (half_width, half_width)))
+    x = np.lib.stride_tricks.sliding_window_view(x, window, axis=1)
+    weight = np.lib.stride_tricks.sliding_window_view(weight, window, axis=1).copy()
+    weight[..., half_width] = 0.0
+
+    basis = np.vander(np.arange(-half_width, half_width + 1)/half_width, order + 1, increasing=True)
+    gram = (weight @ (basis[:, :, np.newaxis]*basis[:, np.newaxis, :]).reshape(window, -1)).reshape(weight.shape[:2] + (order + 1, order + 1))
+    rhs = (weight*x) @ basis
+    enough = weight.sum(axis=-1) >= order + 2
+    gram[~enough] = np.eye(order + 1)
+    # The constant term is the value at the centre of the window
+    return np.where(enough, np.linalg.solve(gram, rhs[..., np.newaxis])[..., 0, 0], np.nan)
+
+def _robust_outliers(residual, good, sigma):
+    """
+    The values of residual (among those where good is True) more than sigma
+    robust standard deviations (1.4826 times the median absolute deviation,
+    per row) from the median. A MAD of 0 flags nothing.
+    """
+    residual = np.where(good, residual, 0.0)
+    deviation = np.abs(residual - _masked_median(residual, good)[:, np.newaxis])
+    mad = _masked_median(deviation, good)
+    return good & (deviation > sigma*1.4826*mad[:, np.newaxis]) & (mad[:, np.newaxis] > 0)
+
+def _clip_outliers(v, good, amp_model, phase_model, sigma):
+    """
+    The values of v (among those where good is True) whose phase or amplitude
+    residual from the model is an outlier (_robust_outliers()) both among
+    the residuals of the whole spectrum, and among the deviations of the
+    residuals from a local smooth of their neighbours (_local_fit()).
+
+    The first alone flags smooth bandpass structure that the delay and
+    polynomial models do not follow (e.g. a dip in phase over ten channels)
+    and the second alone flags structure on scales of a few channels which
+    is large compared with the channel-to-channel noise of good solutions;
+    RFI stands out in both. The local smooth is only needed for the spectra
+    with outliers of the first kind.
+    """
+    outliers = np.zeros(good.shape, dtype=bool)
+    with np.errstate(invalid='ignore'):
+        residuals = (np.angle(v/phase_model), np.abs(v) - amp_model)
+    for residual in residuals:
+        candidates = _robust_outliers(residual, good, sigma)
+        rows = np.flatnonzero(candidates.any(axis=1))
+        if len(rows) > 0:
+            local = residual[rows] - _local_fit(residual[rows], good[rows])
+            candidates[rows] &= _robust_outliers(local, good[rows] & ~np.isnan(local), sigma)
+        outliers |= candidates
+    return outliers
+
+def fit_complex_gains_batch(v, mode='model', amp_order=5, fft_pad_factor=8, clip_sigma=5.0, clip_iterations=5):
+    """
+    Batched version of fit_complex_gains.
+
+    v is an array of complex values of any shape; each 1D spectrum along the
+    last axis is fitted independently, exactly as fit_complex_gains would fit
+    it, but the delay search, phase fit and amplitude fit are done for all
+    spectra at once as stacked array operations.
+
+    With mode="model", returns an array of the same shape as v containing the
+    models. With mode="clip", returns v with outliers flagged (set to NaN):
+    values whose phase or amplitude residual from the model is more than
+    clip_sigma robust (MAD) standard deviations out, both from the residuals
+    of the whole spectrum and from a local smooth of those of its
+    neighbouring channels (see _clip_outliers()). The fit and clip are
+    repeated without the outliers, for the spectra which had any, until no
+    more are found or clip_iterations have been done. Spectra which are
+    entirely NaN are returned unchanged.
+
+    complex64 input is fitted (and returned) in single precision, apart from
+    the sums of the least squares fits, which are accumulated in double
+    precision, as are the weights (which would overflow in single precision
+    for small gains).
+    """
+    if mode not in ("model", "clip"):
+        raise RuntimeError("mode %s not implemented" % mode)
+    v = np.asarray(v)
+    dtype = np.complex64 if v.dtype == np.complex64 else np.complex128
+    v = v.astype(dtype, copy=False)
+    shape = v.shape
+    n = shape[-1]
+    v = v.reshape(-1, n)
+    good = ~np.isnan(v)
+    rows = np.flatnonzero(good.any(axis=1))
+    out = v.copy()
+    if len(rows) == 0:
+        return out.reshape(shape)
+    v = v[rows]
+    good = good[rows]
+
+    if mode == "model":
+        amp_model, phase_model = _fit_models(v, good, amp_order, fft_pad_factor)
+        out[rows] = np.where(good, amp_model*phase_model, np.nan)
+    elif mode == "clip":
+        # Only the spectra which had outliers in the last iteration are refitted
+        active = np.arange(len(rows))
+        for iteration in range(clip_iterations):
+            amp_model, phase_model = _fit_models(v[active], good[active], amp_order, fft_pad_factor)
+            outliers = _clip_outliers(v[active], good[active], amp_model, phase_model, clip_sigma)
+            good[active] &= ~outliers
+            active = active[outliers.any(axis=1)]
+            logging.debug("clip iteration %d: %d values flagged, in %d spectra", iteration, np.count_nonzero(outliers), len(active))
+            if len(active) == 0:
+                break
+        out[rows] = np.where(good, v, np.nan)
+    return out.reshape(shape)
+
+def count_flagged(before, after):
+    """
+    The number of channels of each antenna (summed over intervals) which are
+    flagged (NaN, in any polarisation) in after but not in before, e.g. the
+    channels clipped by AOCal.fit(mode="clip")
+    """
+    new = np.isnan(after).any(axis=3) & ~np.isnan(before).any(axis=3)
+    return new.sum(axis=(0, 2))
+
+@contextlib.contextmanager
+def shared_memory_dir():
+    """
+    Temporary directory for arrays shared with worker processes (see
+    shared_array), on the /dev/shm tmpfs where available. It is removed on
+    exit, but arrays that are still mapped remain valid.
+    """
+    dirname = tempfile.mkdtemp(prefix="aocal_", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+    try:
+        yield dirname
+    finally:
+        shutil.rmtree(dirname, ignore_errors=True)
+
+def shared_array(dirname, name, shape, dtype=np.complex128, mode='r'):
+    """
+    Create (mode='w+') or attach to (mode='r' or 'r+') the array called name
+    in the shared_memory_dir dirname. Processes attached to the same array
+    share its memory, so it never needs to be pickled.
+    """
+    return np.memmap(os.path.join(dirname, name), dtype=dtype, mode=mode, shape=tuple(shape))
+
+def _fit_block(dirname, shape, interval, antenna_start, antenna_end, pols, mode, amp_order, dtype=np.complex128, clip_sigma=5.0, clip_iterations=5):
+    """
+    Worker for AOCal.fit(workers=N): fit one block of antennas of one interval
+    """
+    data = shared_array(dirname, "data", shape, dtype=dtype, mode='r')
+    fit_array = shared_array(dirname, "fit", shape, dtype=dtype, mode='r+')
+    v = np.moveaxis(np.asarray(data[interval, antenna_start:antenna_end])[:, :, pols], 1, 2)
+    fit_array[interval, antenna_start:antenna_end][:, :, pols] = np.moveaxis(fit_complex_gains_batch(v, mode=mode, amp_order=amp_order, clip_sigma=clip_sigma, clip_iterations=clip_iterations), 2, 1)
+    fit_array.flush()
+
 class AOCal(np.ndarray):
     """
     AOCAl stored as a numpy array (with start and stop time stored as floats)
 
-    Array is of dtype complex128 with the following dimensions:
+    Array is of dtype complex128 (or, as a reduced precision working copy,
+    complex64; files are always written as complex128) with the following
+    dimensions:
 
     - calibration interval
     - antenna
@@ -148,118 +399,535 @@ class AOCal(np.ndarray):
         """
         return self[:, :, n_chan:-n_chan, :]
 
+    @profiling.timed("aocal.tofile")
     def tofile(self, cal_filename):
-        if not (np.iscomplexobj(self) and self.itemsize == 16 and len(self.shape) == 4):
-            raise TypeError("array must have 4 dimensions and be of type complex128")
+        """
+        Write to a (classic) calibration file. complex64 arrays are upcast to
+        the complex128 of the file format.
+        """
+        if not (np.iscomplexobj(self) and len(self.shape) == 4):
+            raise TypeError("array must have 4 dimensions and be complex")
         header = Header(intervalCount=self.shape[0], antennaCount = self.shape[1], channelCount = self.shape[2], polarizationCount = self.shape[3], timeStart = self.time_start, timeEnd = self.time_end)
-        with open(cal_filename, "wb") as cal_file:
+        with io.open(cal_filename, "wb") as cal_file:
             header_string = struct.pack(HEADER_FORMAT, *header)
             cal_file.write(header_string)
             logging.debug("header written")
             cal_file.seek(HEADER_SIZE, os.SEEK_SET) # skip header. os.SEEK_SET means seek relative to start of file
-            np.ndarray.tofile(self, cal_file)
+            np.ndarray.tofile(self if self.dtype == np.complex128 else self.astype(np.complex128), cal_file)
             logging.debug("binary file written")
+        profiling.count("aocal.bytes_written", HEADER_SIZE + self.size*np.dtype(np.complex128).itemsize)
 
-    def fit(self, pols=(0, 3), mode='model', amp_order=5):
-        if not (np.iscomplexobj(self) and self.itemsize == 16 and len(self.shape) == 4):
-            raise TypeError("array must have 4 dimensions and be of type complex128")
-        fit_array = np.zeros(self.shape, dtype=np.complex128)
-        for interval in range(self.shape[0]):
-            for antenna in range(self.shape[1]):
-                logging.debug("fitting antenna %d" % antenna)
-                for pol in pols:
-                    v = self[interval, antenna, :, pol]
-                    if sum(~np.isnan(self[interval, antenna, :, pol])) > 0:
-                        self[interval, antenna, :, pol] = fit_complex_gains(self[interval, antenna, :, pol])
-
-def ones(n_interval=1, n_antennas=128, n_channel=3072, n_pol=4, time_start=0.0, time_end=0.0):
+    @profiling.timed("aocal.tofile_chunked")
+    def tofile_chunked(self, cal_filename, dtype=np.complex128, level=6):
+        """
+        Write to a chunked, compressed file, with one chunk per (interval,
+        antenna). Flagged values (those with either part NaN, as given by
+        np.isnan) are marked in a bitmap, and stored separately from the rest
+        so that they cost almost nothing once compressed. With dtype
+        complex128, fromfile() gives back exactly the same solutions, NaN
+        payloads included; complex64 halves the size of the values, at single
+        precision.
+        """
+        if not (np.iscomplexobj(self) and len(self.shape) == 4):
+            raise TypeError("array must have 4 dimensions and be complex")
+        dtype = np.dtype(dtype)
+        if dtype not in (np.complex128, np.complex64):
+            raise TypeError("dtype must be complex128 or complex64")
+        header = Header(intro=CHUNKED_INTRO, intervalCount=self.shape[0], antennaCount=self.shape[1], channelCount=self.shape[2], polarizationCount=self.shape[3], timeStart=self.time_start, timeEnd=self.time_end)
+        offsets = np.zeros(self.shape[0]*self.shape[1] + 1, dtype=np.uint64)
+        with io.open(cal_filename, "wb") as cal_file:
+            cal_file.write(struct.pack(HEADER_FORMAT, *header))
+            cal_file.write(struct.pack(CHUNKED_FORMAT, dtype.itemsize, level))
+            cal_file.seek(offsets.nbytes, os.SEEK_CUR) # index is written once the chunks have been
+            for i, (interval, antenna) in enumerate(np.ndindex(*self.shape[:2])):
+                chunk = _pack_chunk(np.asarray(self[interval, antenna]), dtype, level)
+                cal_file.write(chunk)
+                offsets[i + 1] = offsets[i] + len(chunk)
+            cal_file.seek(CHUNKED_SIZE, os.SEEK_SET)
+            cal_file.write(offsets.tobytes())
+            logging.debug("chunked file written")
+        profiling.count("aocal.bytes_written", CHUNKED_SIZE + offsets.nbytes + int(offsets[-1]))
+
+    @profiling.timed("aocal.fit")
+    def fit(self, pols=(0, 3), mode='model', amp_order=5, workers=None, clip_sigma=5.0, clip_iterations=5, inplace=True):
+        """
+        Fit each spectrum of the selected polarisations with fit_complex_gains.
+
+        The selected polarisations are replaced by their models, in place
+        (as always) by default, and the AOCal is also returned. With
+        inplace=False, it is left unchanged and a new AOCal (of the same
+        dtype) is returned instead, with the other polarisations copied
+        unchanged. The fits are done with fit_complex_gains_batch, one
+        calibration interval at a time, or, if workers > 1, in blocks of
+        antennas spread over a pool of that many processes which share the
+        array through shared memory.
+
+        With mode="clip", the selected polarisations are instead returned with
+        their outliers (more than clip_sigma robust standard deviations from
+        the model) flagged, and the number of channels clipped from each
+        antenna is logged (see count_flagged).
+        """
+        if not (self.dtype in (np.complex128, np.complex64) and len(self.shape) == 4):
+            raise TypeError("array must have 4 dimensions and be of type complex128 or complex64")
+        pols = list(pols)
+        if workers is not None and workers > 1:
+            fit_array = self._fit_parallel(pols, mode, amp_order, workers, clip_sigma, clip_iterations)
+        else:
+            fit_array = AOCal(np.array(self), self.time_start, self.time_end)
+            for interval in range(self.shape[0]):
+                logging.debug("fitting interval %d" % interval)
+                # (antenna, pol, channel) so that channels run along the last axis
+                v = np.moveaxis(np.asarray(self[interval])[:, :, pols], 1, 2)
+                fit_array[interval][:, :, pols] = np.moveaxis(fit_complex_gains_batch(v, mode=mode, amp_order=amp_order, clip_sigma=clip_sigma, clip_iterations=clip_iterations), 2, 1)
+        if mode == "clip":
+            clipped = count_flagged(self, fit_array)
+            profiling.count("aocal.clipped_channels", int(clipped.sum()))
+            logging.info("clipped %d channels, from %d antennas", clipped.sum(), np.count_nonzero(clipped))
+            for antenna in np.flatnonzero(clipped):
+                logging.debug("antenna %d: %d channels clipped", antenna, clipped[antenna])
+        if inplace:
+            self[...] = fit_array
+            return self
+        return fit_array
+
+    def _fit_parallel(self, pols, mode, amp_order, workers, clip_sigma=5.0, clip_iterations=5):
+        # Aim for a few blocks per worker, so that they finish at about the same time
+        n_blocks = max(1, -(-4*workers // self.shape[0]))
+        antennas_per_block = max(1, -(-self.shape[1] // n_blocks))
+        with shared_memory_dir() as dirname:
+            data = shared_array(dirname, "data", self.shape, dtype=self.dtype, mode='w+')
+            data[:] = self
+            fit_array = shared_array(dirname, "fit", self.shape, dtype=self.dtype, mode='w+')
+            fit_array[:] = data
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                jobs = [pool.submit(_fit_block, dirname, self.shape, interval, antenna, antenna + antennas_per_block, pols, mode, amp_order, self.dtype, clip_sigma, clip_iterations)
+                        for interval in range(self.shape[0])
+                        for antenna in range(0, self.shape[1], antennas_per_block)]
+                for job in jobs:
+                    job.result()
+            return AOCal(np.array(fit_array), self.time_start, self.time_end)
+
+def ones(n_interval=1, n_antennas=128, n_channel=3072, n_pol=4, time_start=0.0, time_end=0.0, dtype=np.complex128):
     """
     produce an aocal with all complex gains set to amp 1, phase 0.
     """
-    return AOCal(np.ones((n_interval, n_antennas, n_channel, n_pol), dtype=np.complex128), time_start, time_end)
+    return AOCal(np.ones((n_interval, n_antennas, n_channel, n_pol), dtype=dtype), time_start, time_end)
 
-def zeros(n_interval=1, n_antennas=128, n_channel=3072, n_pol=4, time_start=0.0, time_end=0.0):
+def zeros(n_interval=1, n_antennas=128, n_channel=3072, n_pol=4, time_start=0.0, time_end=0.0, dtype=np.complex128):
     """
     produce an aocal with all complex gains set to amp 0, phase 0.
     """
-    return AOCal(np.zeros((n_interval, n_antennas, n_channel, n_pol), dtype=np.complex128), time_start, time_end)
+    return AOCal(np.zeros((n_interval, n_antennas, n_channel, n_pol), dtype=dtype), time_start, time_end)
 
-def fromfile(cal_filename):
+def _antenna_blocks(shape, block_size):
     """
-    Read AOCal from file.
+    slices of antennas, each covering about block_size values of an array of shape
     """
-    with open(cal_filename, "rb") as cal_file:
-        header_string = cal_file.read(struct.calcsize(HEADER_FORMAT))
-        header = Header._make(struct.unpack(HEADER_FORMAT, header_string))
-        logging.debug(header)
-        assert header.intro == HEADER_INTRO, "File is not a calibrator file"
-        assert header.fileType == 0, "fileType not recognised. Only 0 (complex Jones solutions) is recognised in mwatools/solutionfile.h as of 2013-08-30"
-        assert header.structureType == 0, "structureType not recognised. Only 0 (ordered real/imag, polarization, channel, antenna, time) is recognised in mwatools/solutionfile.h as of 2013-08-30"
-        logging.debug("header OK")
+    antennas_per_block = max(1, block_size // (shape[0]*shape[2]*shape[3]))
+    for start in range(0, shape[1], antennas_per_block):
+        yield slice(start, start + antennas_per_block)
 
-        count = header.intervalCount * header.antennaCount * header.channelCount * header.polarizationCount
-        assert os.path.getsize(cal_filename) == HEADER_SIZE + 2*count*struct.calcsize("d"), "File is the wrong size."
-        logging.debug("file correct size")
-        cal_file.seek(HEADER_SIZE, os.SEEK_SET) # skip header. os.SEEK_SET means seek relative to start of file
+@profiling.timed("aocal.alignment_phases")
+def alignment_phases(ao, block_size=2**20):
+    """
+    Phases which line up adjacent intervals and adjacent channels without a
+    reference antenna. Returns (interval_phases, channel_phases), such that in
+    ao*exp(-1j*(interval_phases[t] + channel_phases[c])) the sum (over
+    everything else) of each channel times the conjugate of the previous one
+    is real, and likewise for intervals. The two are independent, as a phase
+    per channel cancels in the sums between intervals and vice versa.
+
+    NaNs are ignored. Flagged (all NaN) channels and intervals are skipped
+    over, so that the channels on either side of them are lined up with each
+    other, and their phases are 0. ao is read block_size values (a block of
+    antennas) at a time, twice (first just to find the flagged channels and
+    intervals), so it is never copied as a whole, and may be memory mapped
+    (see open()).
+    """
+    shape = ao.shape
+    good_int = np.zeros(shape[0], dtype=bool)
+    good_chan = np.zeros(shape[2], dtype=bool)
+    blocks = list(_antenna_blocks(shape, block_size))
+    for block in blocks:
+        flagged = np.isnan(np.asarray(ao[:, block]))
+        good_int |= ~np.all(flagged, axis=(1, 2, 3))
+        good_chan |= ~np.all(flagged, axis=(0, 1, 3))
+    ints = np.flatnonzero(good_int)
+    chans = np.flatnonzero(good_chan)
+
+    S_int = np.zeros(max(len(ints) - 1, 0), dtype=np.complex128)
+    S_chan = np.zeros(max(len(chans) - 1, 0), dtype=np.complex128)
+    for block in blocks:
+        x = np.asarray(ao[:, block])
+        if len(ints) > 1:
+            S_int += np.nansum(x[ints[1:]] * np.conj(x[ints[:-1]]), axis=(1, 2, 3), dtype=np.complex128)
+        if len(chans) > 1:
+            S_chan += np.nansum(x[:, :, chans[1:]] * np.conj(x[:, :, chans[:-1]]), axis=(0, 1, 3), dtype=np.complex128)
+
+    interval_phases = np.zeros(shape[0])
+    channel_phases = np.zeros(shape[2])
+    interval_phases[ints[1:]] = np.cumsum(np.angle(S_int))
+    channel_phases[chans[1:]] = np.cumsum(np.angle(S_chan))
+    return interval_phases, channel_phases
+
+def align_phases(ao, intervals=True, channels=True, out=None, block_size=2**20):
+    """
+    Line up the phases of adjacent intervals and/or channels (see
+    alignment_phases()), without a reference antenna. The phases are applied
+    in place, in a single multiplication, or, if out is given, into out.
+    Returns the aligned array.
+    """
+    interval_phases, channel_phases = alignment_phases(ao, block_size)
+    phases = np.zeros((ao.shape[0], 1, ao.shape[2], 1))
+    if intervals:
+        phases += interval_phases[:, np.newaxis, np.newaxis, np.newaxis]
+    if channels:
+        phases += channel_phases[np.newaxis, np.newaxis, :, np.newaxis]
+    if out is None:
+        out = ao
+    return np.multiply(ao, np.exp(-1j*phases).astype(ao.dtype), out=out)
+
+def read_header(cal_filename):
+    """
+    Read and check the header of a calibration file, including that the file
+    is the right size for the header's dimensions. The payload is not read.
+    Raises ValueError if the file is not a (classic) calibration file, or is
+    truncated.
+    """
+    with io.open(cal_filename, "rb") as cal_file:
+        header_string = cal_file.read(HEADER_SIZE)
+    if len(header_string) < HEADER_SIZE:
+        raise ValueError("%s is not a calibration file: it is too short (%d bytes) to hold a header" % (cal_filename, len(header_string)))
+    header = Header._make(struct.unpack(HEADER_FORMAT, header_string))
+    logging.debug(header)
+    if header.intro == CHUNKED_INTRO:
+        raise ValueError("%s is a chunked (compressed) calibration file, which can only be read whole (fromfile) or block by block (iter_blocks), not memory mapped; convert it with convert_file() if needed" % cal_filename)
+    if header.intro != HEADER_INTRO:
+        raise ValueError("%s is not a calibration file" % cal_filename)
+    if header.fileType != 0:
+        raise ValueError("%s: fileType %d not recognised. Only 0 (complex Jones solutions) is recognised in mwatools/solutionfile.h as of 2013-08-30" % (cal_filename, header.fileType))
+    if header.structureType != 0:
+        raise ValueError("%s: structureType %d not recognised. Only 0 (ordered real/imag, polarization, channel, antenna, time) is recognised in mwatools/solutionfile.h as of 2013-08-30" % (cal_filename, header.structureType))
+    logging.debug("header OK")
+
+    count = header.intervalCount * header.antennaCount * header.channelCount * header.polarizationCount
+    size = os.path.getsize(cal_filename)
+    if size != HEADER_SIZE + 2*count*struct.calcsize("d"):
+        raise ValueError("%s is the wrong size: %d bytes, where its header (%s) needs %d" % (cal_filename, size, "x".join(str(n) for n in header_shape(header)), HEADER_SIZE + 2*count*struct.calcsize("d")))
+    logging.debug("file correct size")
+    return header
+
+def file_header(cal_filename):
+    """
+    The header of a calibration file, classic or chunked
+    """
+    if is_chunked(cal_filename):
+        return read_chunked_header(cal_filename)[0]
+    return read_header(cal_filename)
+
+def header_shape(header):
+    """
+    (intervalCount, antennaCount, channelCount, polarizationCount) of a header
+    """
+    return (header.intervalCount, header.antennaCount, header.channelCount, header.polarizationCount)
+
+def _pack_chunk(block, dtype, level):
+    """
+    Compress one (channel, polarisation) block: a flag bitmap, then the
+    unflagged values as dtype, byte-shuffled (all first bytes, then all second
+    bytes, ...) which makes the exponents compress well, then the flagged
+    values as dtype, which (being mostly the same few bit patterns) compress
+    to almost nothing.
+    """
+    flags = np.isnan(block)
+    values = block[~flags].astype(dtype)
+    shuffled = values.view(np.uint8).reshape(-1, values.itemsize).T
+    return zlib.compress(np.packbits(flags).tobytes() + np.ascontiguousarray(shuffled).tobytes() + block[flags].astype(dtype).tobytes(), level)
 
-        data = np.fromfile(cal_file, dtype=np.complex128, count=count)
-    shape = [header.intervalCount, header.antennaCount, header.channelCount, header.polarizationCount]
+def _unpack_chunk(chunk, shape, dtype):
+    """
+    Inverse of _pack_chunk, giving a complex128 block of the given shape
+    """
+    raw = zlib.decompress(chunk)
+    n_values = int(np.prod(shape))
+    n_flag_bytes = (n_values + 7)//8
+    flags = np.unpackbits(np.frombuffer(raw, dtype=np.uint8, count=n_flag_bytes), count=n_values).astype(bool).reshape(shape)
+    itemsize = np.dtype(dtype).itemsize
+    n_good = n_values - np.count_nonzero(flags)
+    shuffled = np.frombuffer(raw, dtype=np.uint8, count=n_good*itemsize, offset=n_flag_bytes).reshape(itemsize, -1)
+    block = np.empty(shape, dtype=np.complex128)
+    block[~flags] = np.ascontiguousarray(shuffled.T).view(dtype).ravel()
+    block[flags] = np.frombuffer(raw, dtype=dtype, offset=n_flag_bytes + n_good*itemsize)
+    return block
+
+def is_chunked(cal_filename):
+    """
+    True if cal_filename is a chunked, compressed calibration file (see AOCal.tofile_chunked)
+    """
+    with io.open(cal_filename, "rb") as cal_file:
+        return cal_file.read(len(CHUNKED_INTRO)) == CHUNKED_INTRO
+
+def read_chunked_header(cal_filename):
+    """
+    Read and check the header of a chunked calibration file, returning the
+    header, the stored dtype and the chunk offsets. Raises ValueError if the
+    file is not a chunked calibration file, or is truncated.
+    """
+    with io.open(cal_filename, "rb") as cal_file:
+        header_string = cal_file.read(CHUNKED_SIZE)
+        if len(header_string) < CHUNKED_SIZE:
+            raise ValueError("%s is not a chunked calibration file: it is too short (%d bytes) to hold a header" % (cal_filename, len(header_string)))
+        header = Header._make(struct.unpack(HEADER_FORMAT, header_string[:HEADER_SIZE]))
+        if header.intro != CHUNKED_INTRO:
+            raise ValueError("%s is not a chunked calibration file" % cal_filename)
+        itemsize, level = struct.unpack(CHUNKED_FORMAT, header_string[HEADER_SIZE:])
+        if itemsize not in (8, 16):
+            raise ValueError("%s: unrecognised item size %d" % (cal_filename, itemsize))
+        n_chunks = header.intervalCount*header.antennaCount
+        offsets = np.fromfile(cal_file, dtype=np.uint64, count=n_chunks + 1)
+    if len(offsets) != n_chunks + 1:
+        raise ValueError("%s is truncated: its chunk index is incomplete" % cal_filename)
+    size = os.path.getsize(cal_filename)
+    if size != CHUNKED_SIZE + offsets.nbytes + int(offsets[-1]):
+        raise ValueError("%s is the wrong size: %d bytes, where its chunk index needs %d" % (cal_filename, size, CHUNKED_SIZE + offsets.nbytes + int(offsets[-1])))
+    return header, np.dtype(np.complex128 if itemsize == 16 else np.complex64), offsets
+
+@profiling.timed("aocal.fromfile_chunked")
+def fromfile_chunked(cal_filename, intervals=None, antennas=None):
+    """
+    Read AOCal from a chunked file, optionally just the given intervals and
+    antennas (sequences of indices), decompressing only their chunks.
+    """
+    header, dtype, offsets = read_chunked_header(cal_filename)
+    intervals = range(header.intervalCount) if intervals is None else intervals
+    antennas = range(header.antennaCount) if antennas is None else antennas
+    block_shape = (header.channelCount, header.polarizationCount)
+    data = np.empty((len(intervals), len(antennas)) + block_shape, dtype=np.complex128)
+    start = CHUNKED_SIZE + offsets.nbytes
+    with io.open(cal_filename, "rb") as cal_file:
+        for i, interval in enumerate(intervals):
+            for a, antenna in enumerate(antennas):
+                k = interval*header.antennaCount + antenna
+                cal_file.seek(start + int(offsets[k]), os.SEEK_SET)
+                chunk = cal_file.read(int(offsets[k + 1] - offsets[k]))
+                data[i, a] = _unpack_chunk(chunk, block_shape, dtype)
+                profiling.count("aocal.bytes_read", len(chunk))
+    return AOCal(data, header.timeStart, header.timeEnd)
+
+def convert_file(in_filename, out_filename, dtype=np.complex128, level=6):
+    """
+    Convert a classic calibration file to a chunked one, or a chunked one to
+    a classic one.
+    """
+    ao = fromfile(in_filename)
+    if is_chunked(in_filename):
+        ao.tofile(out_filename)
+    else:
+        ao.tofile_chunked(out_filename, dtype, level)
+
+@profiling.timed("aocal.fromfile")
+def fromfile(cal_filename):
+    """
+    Read AOCal from file (classic or chunked).
+    """
+    if is_chunked(cal_filename):
+        return fromfile_chunked(cal_filename)
+    header = read_header(cal_filename)
+    shape = header_shape(header)
+    with io.open(cal_filename, "rb") as cal_file:
+        cal_file.seek(HEADER_SIZE, os.SEEK_SET) # skip header. os.SEEK_SET means seek relative to start of file
+        data = np.fromfile(cal_file, dtype=np.complex128, count=int(np.prod(shape)))
+    profiling.count("aocal.bytes_read", HEADER_SIZE + data.nbytes)
     data = data.reshape(shape)
     new_aocal = AOCal(data, header.timeStart, header.timeEnd)
     return new_aocal
 
-def rtsfile(metafitsfile, rts_filename_pattern="DI_JonesMatrices_node[0-9]*.dat"):
-    import astropy.io.fits as fits
+def open(cal_filename, mmap=True, mode='r'):
+    """
+    Open AOCal from file, by default without reading it.
+
+    With mmap=True the returned AOCal is backed by a np.memmap of the file
+    payload, so that only the parts which are actually used (e.g. one
+    interval, antenna or channel range of ao[i, a, c0:c1]) are read from disk.
+    mode is passed to np.memmap:
 
+    - 'r'  read only (default). Anything that tries to modify the array fails.
+    - 'c'  copy-on-write. The array may be modified in memory, but changes are
+           never written back to the file.
+    - 'r+' modifications are written back to the file.
+
+    With mmap=False this is the same as fromfile.
+    """
+    if not mmap:
+        return fromfile(cal_filename)
+    if mode not in ('r', 'c', 'r+'):
+        raise ValueError("mode must be one of 'r', 'c' or 'r+'")
+    header = read_header(cal_filename)
+    data = np.memmap(cal_filename, dtype=np.complex128, mode=mode, offset=HEADER_SIZE, shape=header_shape(header))
+    return AOCal(data, header.timeStart, header.timeEnd)
+
+def iter_blocks(cal_filename, antennas_per_block=None):
+    """
+    Iterate over a calibration file one block at a time, reading only that
+    block into memory.
+
+    Yields (interval, antenna, block), where block is an (in-memory) AOCal of
+    shape (1, n, n_chan, n_pol) holding antennas antenna:antenna+n of the
+    given interval. By default each block is a whole interval.
+
+    Chunked files are read one block of chunks at a time with
+    fromfile_chunked.
+    """
+    if is_chunked(cal_filename):
+        n_int, n_ant = header_shape(file_header(cal_filename))[:2]
+        for interval in range(n_int):
+            for antenna in range(0, n_ant, antennas_per_block or n_ant):
+                yield interval, antenna, fromfile_chunked(cal_filename, intervals=[interval], antennas=range(antenna, min(antenna + (antennas_per_block or n_ant), n_ant)))
+        return
+    ao = open(cal_filename, mode='r')
+    if antennas_per_block is None:
+        antennas_per_block = ao.n_ant
+    for interval in range(ao.n_int):
+        for antenna in range(0, ao.n_ant, antennas_per_block):
+            block = np.array(ao[interval:interval+1, antenna:antenna+antennas_per_block])
+            profiling.count("aocal.bytes_read", block.nbytes)
+            yield interval, antenna, AOCal(block, ao.time_start, ao.time_end)
+
+class AOCalWriter(object):
+    """
+    Write a calibration file block by block, for when the whole array is not
+    available (or does not fit) in memory at once. The streaming counterpart
+    of AOCal.tofile.
+
+    The header is written, and the file extended to its full size, when the
+    writer is created. Blocks can then be written in any order with write();
+    anything not written is left as zeros.
+
+    with AOCalWriter("out.bin", n_interval, n_antennas, n_channel) as writer:
+        for interval, antenna, block in iter_blocks("in.bin"):
+            writer.write(block, interval, antenna)
+    """
+
+    def __init__(self, cal_filename, n_interval=1, n_antennas=128, n_channel=3072, n_pol=4, time_start=0.0, time_end=0.0):
+        self.shape = (n_interval, n_antennas, n_channel, n_pol)
+        header = Header(intervalCount=n_interval, antennaCount=n_antennas, channelCount=n_channel, polarizationCount=n_pol, timeStart=time_start, timeEnd=time_end)
+        self.cal_file = io.open(cal_filename, "wb")
+        self.cal_file.write(struct.pack(HEADER_FORMAT, *header))
+        logging.debug("header written")
+        profiling.count("aocal.bytes_written", HEADER_SIZE)
+        self.cal_file.truncate(HEADER_SIZE + int(np.prod(self.shape))*np.dtype(np.complex128).itemsize)
+
+    def write(self, block, interval, antenna=0):
+        """
+        Write block, of shape (n_ant, n_chan, n_pol) or (1, n_ant, n_chan,
+        n_pol), as antennas antenna:antenna+n_ant of the given interval.
+        """
+        block = np.asarray(block)
+        if block.ndim == 4:
+            if block.shape[0] != 1:
+                raise ValueError("blocks must contain a single interval")
+            block = block[0]
+        if not np.iscomplexobj(block):
+            raise TypeError("block must be complex")
+        block = block.astype(np.complex128, copy=False)  # complex64 blocks are upcast
+        if block.shape[1:] != self.shape[2:] or antenna + block.shape[0] > self.shape[1] or not 0 <= interval < self.shape[0]:
+            raise ValueError("block of shape %s does not fit at interval %d, antenna %d of %s" % (block.shape, interval, antenna, self.shape))
+        offset = ((interval*self.shape[1] + antenna)*self.shape[2]*self.shape[3])*block.itemsize
+        self.cal_file.seek(HEADER_SIZE + offset, os.SEEK_SET)
+        np.ascontiguousarray(block).tofile(self.cal_file)
+        profiling.count("aocal.bytes_written", block.nbytes)
+
+    def close(self):
+        self.cal_file.close()
+        logging.debug("binary file written")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+@profiling.timed("aocal.fit_file")
+def fit_file(in_filename, out_filename, pols=(0, 3), mode='model', amp_order=5, antennas_per_block=None, clip_sigma=5.0, clip_iterations=5):
+    """
+    AOCal.fit applied to a file, one interval (or block of antennas) at a
+    time, so that memory use is bounded by the size of one block.
+    """
+    header = file_header(in_filename)
+    with AOCalWriter(out_filename, *header_shape(header), time_start=header.timeStart, time_end=header.timeEnd) as writer:
+        for interval, antenna, block in iter_blocks(in_filename, antennas_per_block):
+            writer.write(block.fit(pols=pols, mode=mode, amp_order=amp_order, clip_sigma=clip_sigma, clip_iterations=clip_iterations, inplace=False), interval, antenna)
+
+def read_rts_jones(rts_filename, apply_jref=True):
+    """
+    Read one RTS DI_JonesMatrices file, returning an array of shape
+    (n_antennas, 4) of the gains in RTS polarisation order and RTS antenna
+    order, multiplied through by the Jref factor in the first line (unless
+    apply_jref is False).
+    """
+    with io.open(rts_filename, "r") as rts_file:
+        Jref = float(rts_file.readline()) # Common factor of all gains is a single number in the first line of the file
+        # The second line contains the model primary beam Jones matrix (in the direction of the calibrator)
+        jones = np.loadtxt(rts_file, delimiter=",", skiprows=1, ndmin=2)
+    assert jones.shape[1] == 8, "Incorrect number of elements in Jones matrix"
+    jones = np.ascontiguousarray(jones).view(np.complex128)
+    if apply_jref:
+        jones *= Jref
+    return jones
+
+@profiling.timed("aocal.rtsfile")
+def rtsfile(metafitsfile, rts_filename_pattern="DI_JonesMatrices_node[0-9]*.dat", apply_jref=True, workers=None, time_start=0., time_end=0.):
     """
     Read DI Jones matrices from RTS output files and convert to "aocal" format.
     Assumes RTS solutions are one per coarse channel.
     Needs the associated metafits file to get the antenna ordering right.
+
+    rts_filename_pattern is a glob matching the files of one interval, or a
+    list of them, one per interval. The gains are multiplied through by the
+    Jref factor at the top of each file, unless apply_jref is False. Files are
+    read by a pool of worker threads if workers > 1.
     """
+    import tileindex
+
     # (Relative) comparison of RTS and OFFRINGA polarisation ordering:
     # OFFRINGA:  XX-R  XX-I  XY-R  XY-I  YX-R  YX-I  YY-R  YY-I
     # RTS:       YY-R  YY-I  YX-R  YX-I  XY-R  XY-I  XX-R  XX-R
     pol_map = [3, 2, 1, 0]
 
     # Antenna reording:
-    hdu = fits.open(metafitsfile)
-    ant_map = hdu['TILEDATA'].data['Antenna'][::2] # only want each tile once
-    hdu.close()
+    ant_map = tileindex.tile_index(metafitsfile).rts_to_ao
 
-    # Assumptions:
-    nintervals = 1
-    npols = 4
+    if isinstance(rts_filename_pattern, str):
+        rts_filename_pattern = [rts_filename_pattern]
 
     # Get file names
-    rts_filenames = sorted(glob.glob(rts_filename_pattern)) # <-- Assumes file names are appropriately ordered by channel
-    rts_filenames.reverse()
-    nchannels = len(rts_filenames)
-
-    for chan in range(len(rts_filenames)):
-        rts_filename = rts_filenames[chan]
-        with open(rts_filename, "r") as rts_file:
-            Jref = float(rts_file.readline()) # Common factor of all gains is a single number in the first line of the file
-            rts_file.readline() # The second line contains the model primary beam Jones matrix (in the direction of the calibrator)
-            lines = rts_file.readlines()
-
-            # If first time through, get number of antennas and set up data array for solution
-            if chan == 0:
-                nantennas = len(lines)
-                # Create numpy array structure
-                data = np.empty((nintervals, nantennas, nchannels, npols,),dtype=np.complex128)
-                data[:] = np.nan
-            else:
-                assert len(lines) == nantennas, "Files contain different numbers of antennas"
-
-            # Parse each line
-            for ant in range(len(lines)):
-                line = lines[ant]
-                jones_str = line.split(",")
-                assert len(jones_str) == 2*npols, "Incorrect number of elements in Jones matrix"
-                ant_idx = ant_map[ant]
-                for pol in range(len(pol_map)):
-                    p = pol_map[pol]
-                    data[0,ant_idx,chan,pol] = float(jones_str[2*p]) + float(jones_str[2*p+1])*1j
-
-    new_aocal = AOCal(data, 0, 0)
-    return new_aocal
+    rts_filenames = []
+    for pattern in rts_filename_pattern:
+        filenames = sorted(glob.glob(pattern)) # <-- Assumes file names are appropriately ordered by channel
+        filenames.reverse()
+        if rts_filenames and len(filenames) != len(rts_filenames[0]):
+            raise ValueError("%s matches %d files, but %s matches %d" % (pattern, len(filenames), rts_filename_pattern[0], len(rts_filenames[0])))
+        rts_filenames.append(filenames)
+    nintervals = len(rts_filenames)
+    nchannels = len(rts_filenames[0])
+    if nchannels == 0:
+        raise ValueError("no files match %s" % rts_filename_pattern[0])
+
+    all_filenames = [filename for filenames in rts_filenames for filename in filenames]
+    if workers is not None and workers > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            jones = list(executor.map(lambda filename: read_rts_jones(filename, apply_jref), all_filenames))
+    else:
+        jones = [read_rts_jones(filename, apply_jref) for filename in all_filenames]
+
+    nantennas = len(jones[0])
+    assert all(len(j) == nantennas for j in jones), "Files contain different numbers of antennas"
+
+    # (interval, channel, RTS antenna, RTS pol) -> (interval, AO antenna, channel, AO pol)
+    jones = np.stack(jones).reshape(nintervals, nchannels, nantennas, 4)
+    data = np.full((nintervals, nantennas, nchannels, 4), np.nan, dtype=np.complex128)
+    data[:, ant_map[:nantennas]] = jones[..., pol_map].transpose(0, 2, 1, 3)
+
+    return AOCal(data, time_start, time_end)
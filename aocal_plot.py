@@ -1,51 +1,26 @@
 #!/usr/bin/env python
-import os, logging
+import os, sys, logging
 from optparse import OptionParser #NB zeus does not have argparse!
 
 import numpy as np
-import matplotlib
-import matplotlib.pyplot as plt
-#matplotlib.use('Agg')
-import matplotlib.gridspec as gridspec
-import pylab
-from astropy.io import fits
 
+# matplotlib (like astropy, via tileindex) is only imported by the functions
+# that draw, so that using reference() etc., or importing this module, is cheap
 import aocal
+import tileindex
+import profiling
 
 def get_tile_flavors(metafits):
     """
     return tile flavours ordered in AO order
     """
-    hdus = fits.open(metafits)
-    # This mirrors what cotter does (see metafitsfile.cpp MetaFitsFile::ReadTiles
-    inputs = hdus[1].data
-    tiles = inputs[inputs['pol'] == 'X']
-    sort_ant = tiles['antenna'].argsort()
-    return tiles['Flavors'][sort_ant]
+    return tileindex.tile_index(metafits).flavor
 
 def get_receiver_slot_order(metafits):
     """
     returns a dictionary of dictionaries which will give an AO ordinal index to each receiver and slot
     """
-    # get tile metadata table in AO order (discard Y polarisations)
-    hdus = fits.open(metafits)
-    inputs = hdus[1].data
-    tiles = inputs[inputs['pol'] == 'X']
-    sort_ant = tiles['antenna'].argsort()
-    tiles = tiles[sort_ant]
-
-    receivers = set(tiles['Rx'])
-    rec_slot_dict = {}
-    for receiver in sorted(receivers):
-        rec_slot_dict[receiver] = {}
-        rec_slots = set(tiles[tiles['Rx'] == receiver]['Slot'])
-        for slot in sorted(rec_slots):
-            # tiles with this rec, slot
-            ant = tiles[(tiles['Rx'] == receiver) & (tiles['Slot'] == slot)]['antenna']
-            if not len(ant) == 1:
-                raise RuntimeError("Rx %d Slot %d does not map to a single antenna, but to %s" % (receiver, slot, str(ant)))
-            rec_slot_dict[receiver][slot] = ant[0]
-    return rec_slot_dict
+    return tileindex.tile_index(metafits).receiver_slot_order()
 
 def iter_rec_slot(rec_slot_dict):
     """
@@ -67,10 +42,54 @@ def nanaverage(a, axis=None, weights=None):
         weights = np.ones(a.shape)
     return np.nansum(a*weights, axis=axis)/np.nansum(weights, axis=axis)
 
+@profiling.timed("aocal_plot.reference")
+def reference(ao, refant, metafits=None):
+    """
+    divide solutions through by a reference antenna (int), the average antenna
+    (negative int), or the average of all tiles of a flavour (str), or, for
+    refant "align", line up the phases of adjacent channels and intervals
+    without a reference (aocal.align_phases). Returns the referenced solutions
+    and a suffix for the plot title
+    """
+    if refant is None:
+        logging.info("no reference antenna")
+        return ao, ""
+    if refant == "align":
+        logging.info("aligning phases without a reference antenna")
+        return aocal.align_phases(ao, out=np.empty_like(ao)), " refant=align"
+    ao_amp = np.abs(ao)
+    if isinstance(refant, int):
+        if refant < 0:
+            logging.info("using average as reference antenna")
+            ant_avg = nanaverage(ao, axis=1, weights=ao_amp**-2)#correct phase
+            ant_avg /= np.abs(ant_avg) # normalised
+            ant_avg *= nanaverage(ao_amp, axis=1, weights=ao_amp**-2) #standard scalar avg for amp
+            return ao / ant_avg[:, np.newaxis, :, :], " refant=average"
+        logging.info("using antenna %d as reference antenna", refant)
+        return ao / ao[:, refant, :, :][:, np.newaxis, :, :], " refant=%d" % refant
+    logging.info("using %s average as reference antenna", refant)
+    flavors = get_tile_flavors(metafits).reshape(1, -1)
+    if not refant in flavors:
+        raise RuntimeError("refant flavor not found")
+    # ao[flavors == refant] has shape (n_refant, n_freq, n_pol)
+    ant_avg = nanaverage(ao[flavors == refant], axis=0, weights=ao_amp[flavors == refant]**-2) # correct phase
+    return ao / ant_avg[np.newaxis, np.newaxis, :, :], " refant=%s" % refant
+
+def antenna_order(n_ant, metafits=None):
+    """
+    antennas in plotting order: by receiver/slot if metafits is given, otherwise AO order
+    """
+    if metafits is None:
+        return list(range(n_ant))
+    return list(iter_rec_slot(get_receiver_slot_order(metafits)))
+
+@profiling.timed("aocal_plot.plot")
 def plot(ao, plot_filename=None, refant=None, n_rows=8, plot_title="", amp_max=None, format="png", outdir=None, ants_per_line=8, marker=',', markersize=2, verbose=0, metafits=None, chan_idxs=None):
     """
     plot aocal
     """
+    import matplotlib.pyplot as plt
+    import matplotlib.gridspec as gridspec
 
     if verbose == 1:
         logging.basicConfig(level=logging.INFO)
@@ -83,33 +102,8 @@ def plot(ao, plot_filename=None, refant=None, n_rows=8, plot_title="", amp_max=N
     n_cols = ao.n_ant//n_rows
     gs = gridspec.GridSpec(n_rows, n_cols)
     gs.update(hspace=0.0, wspace=0.0)
-    ao_amp = np.abs(ao)
-    if refant is not None:
-        if isinstance(refant, int):
-            if refant < 0:
-                logging.info("using average as reference antenna")
-                ant_avg = nanaverage(ao, axis=1, weights=ao_amp**-2)#correct phase
-                ant_avg /= np.abs(ant_avg) # normalised
-                print(nanaverage(ao_amp, axis=1, weights=ao_amp**-2))
-                ant_avg *= nanaverage(ao_amp, axis=1, weights=ao_amp**-2) #standard scalar avg for amp
-                ao = ao / ant_avg[:, np.newaxis, :, :]
-                plot_title += " refant=average"
-            else:
-                logging.info("using antenna %d as reference antenna", refant)
-                ao = ao / ao[:, refant, :, :][:, np.newaxis, :, :]
-                plot_title += " refant=%d" % refant
-        else:
-                logging.info("using %s average as reference antenna", refant)
-                flavors = get_tile_flavors(metafits).reshape(1, -1)
-                if not refant in flavors:
-                    raise RuntimeError("refant flavor not found")
-                # ao[flavors == refant] has shape (n_refant, n_freq, n_pol)
-                ant_avg = nanaverage(ao[flavors == refant], axis=0, weights=ao_amp[flavors == refant]**-2) # correct phase
-                print(ant_avg.shape)
-                ao = ao / ant_avg[np.newaxis, np.newaxis, :, :]
-                plot_title += " refant=%s" % refant
-    else:
-        logging.info("no reference antenna")
+    ao, title_suffix = reference(ao, refant, metafits)
+    plot_title += title_suffix
 
     # Scale amplitude plots to the same, maximum gain 
     if amp_max is None:
@@ -117,11 +111,7 @@ def plot(ao, plot_filename=None, refant=None, n_rows=8, plot_title="", amp_max=N
         logging.info("amp_max=%.1f" % amp_max)
 
     # Order by receiver/slot if metafits is requested
-    if metafits is not None:
-        rec_slot_dict = get_receiver_slot_order(metafits)
-        ant_iter = iter_rec_slot(rec_slot_dict)
-    else:
-        ant_iter = range(ao.n_ant)
+    ant_iter = antenna_order(ao.n_ant, metafits)
 
     for timestep in range(ao.n_int):
 
@@ -205,14 +195,151 @@ def plot(ao, plot_filename=None, refant=None, n_rows=8, plot_title="", amp_max=N
             ampfig.savefig("%s%s_amp.%s" % (plot_filename, int_str, format))
             phsfig.savefig("%s%s_phase.%s" % (plot_filename, int_str, format))
 
+def _grid_layout(ax, n_rows, n_cols, n_chan_span, y_span, yticks, ytick_labels, ylabel, thumbnail):
+    """
+    set up a single axes as an n_rows x n_cols grid of antenna panels, each
+    n_chan_span wide and y_span high
+    """
+    ax.set_autoscale_on(False)
+    ax.set_xlim(0, n_cols*n_chan_span)
+    ax.set_ylim(0, n_rows*y_span)
+    ax.vlines(np.arange(1, n_cols)*n_chan_span, 0, n_rows*y_span, colors='k', linewidth=0.5)
+    ax.hlines(np.arange(1, n_rows)*y_span, 0, n_cols*n_chan_span, colors='k', linewidth=0.5)
+    if thumbnail:
+        ax.set_xticks([])
+        ax.set_yticks([])
+        return
+    row_offsets = np.arange(n_rows)[:, np.newaxis]*y_span
+    ax.set_yticks((row_offsets + yticks).ravel())
+    ax.set_yticklabels(ytick_labels*n_rows)
+    ax.set_ylabel(ylabel)
+    # channel ticks (0 and half way) for every column of panels
+    col_offsets = np.arange(n_cols)[:, np.newaxis]*n_chan_span + 1
+    xticks = np.array([0, (n_chan_span - 2)//2])
+    ax.set_xticks((col_offsets + xticks).ravel())
+    ax.set_xticklabels([str(t) for t in xticks]*n_cols)
+    ax.set_xlabel("Frequency")
+
+@profiling.timed("aocal_plot.render_interval")
+def render_interval(fig, values, chan_idxs, n_rows, y_min, y_max, yticks, ytick_labels, ylabel, antennas, plot_title="", marker=',', markersize=2, thumbnail=False):
+    """
+    draw one interval of amplitudes or phases (values, shape (n_ant, n_chan,
+    n_pol), already in plotting order) onto fig as a grid of antenna panels.
+    Everything is drawn on one axes, with one artist per polarisation, rather
+    than one axes per antenna and one artist per antenna and polarisation
+    """
+    n_ant, n_chan, n_pol = values.shape
+    n_cols = n_ant//n_rows
+    n_chan_span = chan_idxs[-1] + 2
+    y_span = y_max - y_min
+
+    panel = np.arange(n_ant)
+    x_offset = (panel % n_cols)*n_chan_span + 1
+    y_offset = (n_rows - 1 - panel//n_cols)*y_span - y_min
+    x = (x_offset[:, np.newaxis] + chan_idxs[np.newaxis, :]).ravel()
+    # Points outside a panel's range would otherwise be drawn in the neighbouring panel
+    values = np.where((values >= y_min) & (values <= y_max), values, np.nan)
+    y = values + y_offset[:, np.newaxis, np.newaxis]
+
+    ax = fig.add_axes([0.04, 0.06, 0.95, 0.89] if not thumbnail else [0, 0, 1, 1])
+    _grid_layout(ax, n_rows, n_cols, n_chan_span, y_span, np.array(yticks) - y_min, ytick_labels, ylabel, thumbnail)
+    for pol in range(n_pol):
+        polstr = POLS[pol]
+        ax.plot(x, y[..., pol].ravel(), color=POL_COLOR[polstr], zorder=POL_ZORDER[polstr], linestyle='None', marker=marker, markersize=markersize, label=polstr)
+    if not thumbnail:
+        for a, antenna in enumerate(antennas):
+            ax.text(x_offset[a] + 0.05*n_chan_span, y_offset[a] + y_min + 0.05*y_span, f'Ant #{antenna}', horizontalalignment='left', verticalalignment='bottom')
+        fig.suptitle(plot_title, fontsize=16)
+    return fig
+
+def _render_files(amp, phase, chan_idxs, n_rows, amp_max, antennas, plot_title, marker, markersize, thumbnail, filenames):
+    """
+    render one interval's amplitude and phase plots to files, using the Agg
+    backend directly (no pyplot), so that it can run in a worker process
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    figsize, dpi = ((4.8, 2.7), 50) if thumbnail else ((24.0, 13.5), 100)
+    for values, args, filename in ((amp, (0, amp_max, [0, amp_max/2], ["0", "%.3g" % (amp_max/2)], "Amplitude"), filenames[0]),
+                                   (phase, (-180, 180, [-90, 0, 90], ["-90", "0", "90"], "Phase (deg)"), filenames[1])):
+        fig = Figure(figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(fig)
+        render_interval(fig, values, chan_idxs, n_rows, *args, antennas=antennas, plot_title=plot_title, marker=marker, markersize=markersize, thumbnail=thumbnail)
+        fig.savefig(filename, dpi=dpi)
+    return filenames
+
+@profiling.timed("aocal_plot.plot_fast")
+def plot_fast(ao, plot_filename=None, refant=None, n_rows=8, plot_title="", amp_max=None, format="png", outdir=None, marker=',', markersize=2, verbose=0, metafits=None, chan_idxs=None, thumbnail=False, workers=None):
+    """
+    plot aocal, like plot(), but drawing each figure as a single axes with
+    one artist per polarisation, computing amplitudes and phases once for the
+    whole array, and rendering intervals in parallel worker processes (if
+    workers > 1). thumbnail gives small, unlabelled png plots (named *_thumb.png)
+    for dashboards. Returns the names of the files written
+    """
+    if verbose == 1:
+        logging.basicConfig(level=logging.INFO)
+    elif verbose > 1:
+        logging.basicConfig(level=logging.DEBUG)
+
+    if chan_idxs is None:
+        chan_idxs = np.arange(ao.n_chan)
+    chan_idxs = np.asarray(chan_idxs)
+
+    ao, title_suffix = reference(ao, refant, metafits)
+    plot_title += title_suffix
+    antennas = antenna_order(ao.n_ant, metafits)
+    if len(antennas) % n_rows != 0:
+        raise ValueError("%d antennas do not fit in %d rows" % (len(antennas), n_rows))
+
+    # Amplitudes and phases for the whole array at once (single precision is plenty to plot)
+    ao = np.asarray(ao)[:, antennas]
+    amp = np.abs(ao).astype(np.float32)
+    phase = np.angle(ao, deg=True).astype(np.float32)
+
+    if amp_max is None:
+        amp_max = 2*np.median(np.nan_to_num(amp[..., [0,-1]]))
+        logging.info("amp_max=%.1f" % amp_max)
+
+    if plot_filename is None:
+        import matplotlib.pyplot as plt
+        for timestep in range(ao.shape[0]):
+            for values, args in ((amp[timestep], (0, amp_max, [0, amp_max/2], ["0", "%.3g" % (amp_max/2)], "Amplitude")),
+                                 (phase[timestep], (-180, 180, [-90, 0, 90], ["-90", "0", "90"], "Phase (deg)"))):
+                fig = plt.figure(figsize=(24.0, 13.5))
+                render_interval(fig, values, chan_idxs, n_rows, *args, antennas=antennas, plot_title=plot_title, marker=marker, markersize=markersize, thumbnail=thumbnail)
+                fig.show()
+        return []
+
+    if outdir is not None:
+        plot_filename = os.path.join(outdir, os.path.basename(plot_filename))
+    if thumbnail:
+        format = "png"
+    jobs = []
+    for timestep in range(ao.shape[0]):
+        int_str = "_t%04d" % timestep if ao.shape[0] > 1 else ""
+        thumb_str = "_thumb" if thumbnail else ""
+        filenames = ("%s%s_amp%s.%s" % (plot_filename, int_str, thumb_str, format), "%s%s_phase%s.%s" % (plot_filename, int_str, thumb_str, format))
+        jobs.append((amp[timestep], phase[timestep], chan_idxs, n_rows, amp_max, antennas, plot_title, marker, markersize, thumbnail, filenames))
+
+    if workers is not None and workers > 1 and len(jobs) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            written = list(executor.map(_render_files, *zip(*jobs)))
+    else:
+        written = [_render_files(*job) for job in jobs]
+    return [filename for filenames in written for filename in filenames]
+
 if __name__ == '__main__':
     parser = OptionParser(usage = "usage: %prog binfile" +
     """
     Plot calibration solutions
     """)
-    parser.add_option("--refant", default=None, dest="refant", type="int", help="divide solutions through by reference antenna. Negative means divide through by mean antenna")
+    parser.add_option("--refant", default=None, dest="refant", type="str", help="divide solutions through by reference antenna. Negative means divide through by mean antenna. 'align' lines up the phases of adjacent channels and intervals instead, without a reference antenna")
     parser.add_option("--ref_flavor", default=None, dest="ref_flavor", type="str", help="divide solutions through by all antennas of given flavour. Negative means divide through by mean antenna")
     parser.add_option("-m", "--metafits", default=None, dest="metafits", help="metafits file (for ordering by receiver or ref_flavour)")
+    parser.add_option("--tile_cache", action="store_true", default=False, dest="tile_cache", help="save the metafits tile table as a sidecar METAFITS.tiles.npz, which later runs read instead of the metafits file")
     parser.add_option("-v", "--verbose", action="count", default=0, dest="verbose", help="-v info, -vv debug")
     parser.add_option("--outdir", default=None, dest="outdir", help="output directory [default: same as binfile]")
     parser.add_option("--title", default="", dest="plot_title", help="plot title")
@@ -221,16 +348,36 @@ if __name__ == '__main__':
     parser.add_option("--amp_max", default=None, dest="amp_max", type="float", help="Maximum of y axis of amplitude plots")
     parser.add_option("--marker", default=',', dest="marker", type="string", help="matplotlib marker [default: %default]")
     parser.add_option("--markersize", default=2, dest="markersize", type="int", help="matplotlib markersize [default: %default]")
+    parser.add_option("--fast", action="store_true", default=False, dest="fast", help="draw each plot as a single axes, which is much faster for many antennas/intervals")
+    parser.add_option("--thumbnail", action="store_true", default=False, dest="thumbnail", help="write small, unlabelled png thumbnails (implies --fast)")
+    parser.add_option("--workers", default=None, dest="workers", type="int", help="number of processes rendering intervals in parallel (with --fast)")
+    parser.add_option("--profile", default=None, dest="profile", help="write timings, counters and peak memory to this file, as JSON")
     opts, args = parser.parse_args()
 
     if len(args) != 1:
         parser.error("incorrect number of arguments")
     if opts.ref_flavor is not None and opts.metafits is None:
         parser.error("ref_flavor requires metafits")
+    if opts.refant is not None and opts.refant != "align":
+        try:
+            opts.refant = int(opts.refant)
+        except ValueError:
+            parser.error("refant must be an antenna number or 'align'")
     if opts.refant is not None and opts.ref_flavor is not None:
         logging.warn("refant and ref_flavor given, using refant")
     ref = opts.refant if opts.refant is not None else opts.ref_flavor
+    if opts.profile is not None:
+        profiling.enable()
 
+    if opts.metafits is not None:
+        tileindex.tile_index(opts.metafits, sidecar=opts.tile_cache)
 
     ao = aocal.fromfile(args[0])
-    plot(ao, os.path.splitext(args[0])[0]+opts.suffix, ref, plot_title = opts.plot_title, outdir=opts.outdir, format=opts.format, amp_max=opts.amp_max, marker=opts.marker, markersize=opts.markersize, verbose=opts.verbose, metafits=opts.metafits)
+    if opts.fast or opts.thumbnail or opts.workers is not None:
+        import matplotlib
+        matplotlib.use('Agg')
+        plot_fast(ao, os.path.splitext(args[0])[0]+opts.suffix, ref, plot_title = opts.plot_title, outdir=opts.outdir, format=opts.format, amp_max=opts.amp_max, marker=opts.marker, markersize=opts.markersize, verbose=opts.verbose, metafits=opts.metafits, thumbnail=opts.thumbnail, workers=opts.workers)
+    else:
+        plot(ao, os.path.splitext(args[0])[0]+opts.suffix, ref, plot_title = opts.plot_title, outdir=opts.outdir, format=opts.format, amp_max=opts.amp_max, marker=opts.marker, markersize=opts.markersize, verbose=opts.verbose, metafits=opts.metafits)
+    if opts.profile is not None:
+        profiling.write(opts.profile, argv=sys.argv)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+Smooth (and optionally fit) many calibration solution files in one go.
+
+Files are given as glob patterns and/or a manifest (one filename per line) and
+are shared out over a pool of worker processes, so the interpreter start-up
+and imports are paid once per worker rather than once per file. Files whose
+outputs are already newer than the input are skipped, and files that cannot
+be read or processed are recorded and skipped rather than stopping the run.
+
+A status line is written for every file to a JSONL summary as it finishes.
+"""
+import os
+import sys
+import json
+import glob
+import time
+import logging
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import aocal
+import do_smoothing
+
+# Suffixes of the outputs of this tool, whose files are not picked up by glob
+# patterns, so that a second run over the same directory does not smooth
+# (or fit) its own outputs
+OUTPUT_SUFFIXES = ("_smoothed", "_fit")
+
+
+def up_to_date(in_filename, out_filenames):
+    '''
+    True if all of the outputs exist and are newer than the input
+    '''
+    in_mtime = os.path.getmtime(in_filename)
+    return all(os.path.exists(f) and os.path.getmtime(f) > in_mtime for f in out_filenames)
+
+
+def process_file(solution_file, lmbda, method='L-BFGS-B', maxiter=1000, fit=False, outdir=None, force=False, lmbdas=None, criterion='gcv', multigrid=False):
+    '''
+    Smooth (and, if fit is True, fit) a single solution file. Never raises;
+    returns a dictionary describing what happened, for the summary.
+    '''
+    status = {"file": solution_file, "outputs": {}}
+    start = time.time()
+    try:
+        outputs = {"smoothed": do_smoothing.default_outfile(solution_file, outdir=outdir)}
+        if fit:
+            outputs["fit"] = do_smoothing.default_outfile(solution_file, suffix="_fit", outdir=outdir)
+        status["outputs"] = outputs
+
+        if not force and up_to_date(solution_file, outputs.values()):
+            status["status"] = "skipped"
+            return status
+
+        aocal.file_header(solution_file)  # fail early, with a ValueError saying why, on corrupt or truncated files
+        status["costs"] = []
+        status["lmbdas"] = []
+        for interval, stickel in do_smoothing.smooth_file(solution_file, outputs["smoothed"], lmbda, method=method, maxiter=maxiter, lmbdas=lmbdas, criterion=criterion, multigrid=multigrid):
+            status["costs"].append(float(stickel.cost))
+            status["lmbdas"].append(float(stickel.lmbda))
+        if fit:
+            aocal.fit_file(solution_file, outputs["fit"])
+        status["status"] = "ok"
+    except Exception as e:
+        status["status"] = "error"
+        status["error"] = "%s: %s" % (type(e).__name__, e)
+        logging.debug(traceback.format_exc())
+        # Don't leave partial outputs behind to be mistaken for up-to-date ones
+        for f in status["outputs"].values():
+            if os.path.exists(f) and os.path.getmtime(f) >= start:
+                os.remove(f)
+    finally:
+        status["seconds"] = round(time.time() - start, 3)
+    return status
+
+
+def find_files(patterns, manifest=None):
+    '''
+    Solution files matching any of the glob patterns (except outputs of this
+    tool, i.e. those whose base name ends in one of OUTPUT_SUFFIXES), plus
+    those listed in the manifest (blank lines and lines starting with # are
+    ignored), without duplicates and in the order found
+    '''
+    filenames = []
+    for pattern in patterns:
+        filenames.extend(f for f in sorted(glob.glob(pattern)) if not os.path.splitext(f)[0].endswith(OUTPUT_SUFFIXES))
+    if manifest is not None:
+        with open(manifest) as f:
+            filenames.extend(line.strip() for line in f if line.strip() and not line.startswith("#"))
+    return list(dict.fromkeys(filenames))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply smoothing by regularisation to many calibration solution files')
+
+    parser.add_argument('patterns', nargs='*', help='Glob patterns (quote them) matching calibration solution files in the "AOCal" format, e.g. "*.aocalibrate.bin"')
+    parser.add_argument('--manifest', help='A file listing calibration solution files, one per line')
+    parser.add_argument('--lmbda', type=do_smoothing.lmbda_arg, default=1.0, help='The regularisation parameter, or "auto" (see do_smoothing.py) [default = 1.0]')
+    parser.add_argument('--lmbda_range', type=float, nargs=2, default=[1e-2, 1e6], metavar=('MIN', 'MAX'), help='The range of lmbda searched by --lmbda auto [default = 1e-2 1e6]')
+    parser.add_argument('--lmbda_steps', type=int, default=17, help='The number of (log-spaced) values of lmbda tried by --lmbda auto [default = 17]')
+    parser.add_argument('--multigrid', action='store_true', help='Solve each interval coarse-to-fine (see do_smoothing.py --multigrid)')
+    parser.add_argument('--lmbda_criterion', choices=('gcv', 'lcurve'), default='gcv', help='How --lmbda auto chooses lmbda (see do_smoothing.py) [default = gcv]')
+    parser.add_argument('--method', default='L-BFGS-B', help='The solver method (see do_smoothing.py) [default = L-BFGS-B]')
+    parser.add_argument('--maxiter', type=int, default=1000, help='The maximum number of iterations of the solver [default = 1000]')
+    parser.add_argument('--fit', action='store_true', help='Also write a fitted ("_fit") version of each file (see aocal.AOCal.fit)')
+    parser.add_argument('--outdir', help='Directory to write outputs to, created if need be [default = same as each input file]')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='The number of files to process at once [default = number of CPUs]')
+    parser.add_argument('--force', action='store_true', help='Process files even if their outputs are newer than the input')
+    parser.add_argument('--summary', default='batch_summary.jsonl', help='JSONL file to append per-file status and timing to [default = batch_summary.jsonl]')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='-v info, -vv debug')
+
+    args = parser.parse_args()
+
+    assert args.lmbda == 'auto' or args.lmbda > 0, "The 'lmbda' parameter must be > 0"
+    lmbdas = np.logspace(np.log10(args.lmbda_range[0]), np.log10(args.lmbda_range[1]), args.lmbda_steps)
+
+    if args.verbose == 1:
+        logging.basicConfig(level=logging.INFO)
+    elif args.verbose > 1:
+        logging.basicConfig(level=logging.DEBUG)
+
+    filenames = find_files(args.patterns, args.manifest)
+    if len(filenames) == 0:
+        parser.error("no solution files found")
+
+    if args.outdir is not None:
+        os.makedirs(args.outdir, exist_ok=True)
+
+    counts = {}
+    with open(args.summary, "a") as summary, ProcessPoolExecutor(max_workers=args.workers) as pool:
+        jobs = [pool.submit(process_file, f, args.lmbda, method=args.method, maxiter=args.maxiter, fit=args.fit, outdir=args.outdir, force=args.force, lmbdas=lmbdas, criterion=args.lmbda_criterion, multigrid=args.multigrid) for f in filenames]
+        for job in as_completed(jobs):
+            status = job.result()
+            summary.write(json.dumps(status) + "\n")
+            summary.flush()
+            counts[status["status"]] = counts.get(status["status"], 0) + 1
+            logging.info("%s: %s (%.1f s)", status["file"], status["status"], status["seconds"])
+            if status["status"] == "error":
+                print("%s: %s" % (status["file"], status["error"]), file=sys.stderr)
+
+    print(", ".join("%d %s" % (n, s) for s, n in sorted(counts.items())))
+
+
+if __name__ == '__main__':
+    main()
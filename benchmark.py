@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the aocal / smoothing hot paths.
+
+Each task (file I/O, fitting, objective evaluation, smoothing, plotting) is run
+on each case in a fresh process, so that its peak resident memory can be
+measured on its own. Cases are either synthetic solutions (built with
+aocal.ones/zeros, with realistic noise, phase wraps and flagged edge channels
+and tiles) of a given size, or the bundled B1934 solution file.
+
+Results are printed and written as JSON, and can be compared against the
+results of an earlier run (e.g. from another version) with --compare.
+
+With --startup, the start-up cost of the command line entry points is
+measured instead (with python -X importtime): reading a file, and
+(non-plotting) smooths of the bundled file, with the banded solver and with
+the default L-BFGS-B. The run fails if the time spent importing modules
+exceeds a budget, or if any of the heavy, plotting or metafits only,
+dependencies (HEAVY_MODULES) are imported. L-BFGS-B needs scipy.optimize,
+whose (lazy) import is reported for that command but is neither counted
+against the budget nor failed as heavy; everything else it imports is.
+
+With --dtype complex64, the tasks that can work in single precision do, and
+each of their results is also compared with the complex128 result (computed
+untimed), as the maximum difference relative to the largest value.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import argparse
+import resource
+import subprocess
+import multiprocessing
+
+import numpy as np
+
+import aocal
+
+B1934_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "SB38969.B1934-638.beam0.aocalibrate.bin")
+
+# (n_interval, n_antennas, n_channel)
+SIZES = {
+    "quick": [(1, 128, 768)],
+    "production": [(1, 128, 768), (1, 128, 3072), (1, 256, 3072), (10, 128, 3072), (50, 128, 768)],
+}
+
+# Modules which reading and (banded) smoothing should never import
+HEAVY_MODULES = ["matplotlib", "pylab", "astropy", "scipy"]
+
+# Start-up budget (total import time, in ms) of each STARTUP_COMMANDS entry
+STARTUP_BUDGET_MS = 250.0
+
+# name: arguments to python, with {file} and {out} for the input and output files
+STARTUP_COMMANDS = {
+    "fromfile": ["-c", "import aocal; aocal.fromfile({file!r})"],
+    "smooth": ["do_smoothing.py", "{file}", "--method", "banded", "--outfile", "{out}"],
+    "smooth_lbfgs": ["do_smoothing.py", "{file}", "--outfile", "{out}"],
+}
+
+# name: the HEAVY_MODULES which a STARTUP_COMMANDS entry needs, and which it
+# may import (lazily, not as a dependency of another import) outside its budget
+STARTUP_NEEDS = {
+    "smooth_lbfgs": ["scipy"],
+}
+
+# Tasks which have a working precision
+DTYPE_TASKS = ["tofile", "fit", "clip", "objective", "value_and_grad", "smooth_banded", "smooth_lbfgs", "smooth_multigrid", "smooth_jones"]
+
+TASKS = ["tofile", "fromfile", "open_slice", "fit", "clip", "objective", "value_and_grad", "smooth_banded", "smooth_lbfgs", "smooth_multigrid", "smooth_jones", "plot", "plot_fast"]
+
+
+def synthetic(n_interval=1, n_antennas=128, n_channel=3072, seed=0, n_coarse=24, n_edge=2, n_flagged_tiles=2):
+    """
+    Synthetic calibration solutions resembling real ones: a smooth bandpass
+    with noise on the diagonal terms, phase slopes which wrap several times
+    across the band, small leakage terms, the edge channels of each coarse
+    channel flagged (NaN), and a few tiles flagged entirely.
+    """
+    rng = np.random.default_rng(seed)
+    shape = (n_interval, n_antennas, n_channel, 4)
+    freq = np.linspace(-1, 1, n_channel)[np.newaxis, np.newaxis, :, np.newaxis]
+
+    ao = aocal.ones(n_interval, n_antennas, n_channel)
+    ao[..., 1:3] = aocal.zeros(n_interval, n_antennas, n_channel, 2) + 0.01
+    bandpass = 1 + 0.2*np.sin(3*freq) + 0.05*rng.standard_normal((n_interval, n_antennas, 1, 4))
+    delay = rng.uniform(-10, 10, (n_interval, n_antennas, 1, 4)) * np.pi  # up to ~10 phase wraps across the band
+    ao *= bandpass * np.exp(1j*(delay*freq + rng.uniform(0, 2*np.pi, (n_interval, n_antennas, 1, 4))))
+    ao += 0.02*(rng.standard_normal(shape) + 1j*rng.standard_normal(shape))
+
+    chan_per_coarse = max(1, n_channel // n_coarse)
+    n_edge = min(n_edge, (chan_per_coarse - 1) // 2)
+    edge = np.arange(n_channel) % chan_per_coarse
+    ao[:, :, (edge < n_edge) | (edge >= chan_per_coarse - n_edge), :] = np.nan
+    ao[:, rng.choice(n_antennas, n_flagged_tiles, replace=False), :, :] = np.nan
+    return ao
+
+
+def make_case(case, dirname):
+    """
+    Returns (AOCal, filename) for a case: either "b1934" or a size string
+    "n_intervalxn_antennasxn_channel"
+    """
+    if case == "b1934":
+        return aocal.fromfile(B1934_FILE), B1934_FILE
+    ao = synthetic(*parse_size(case))
+    filename = os.path.join(dirname, "case.bin")
+    ao.tofile(filename)
+    return ao, filename
+
+
+def parse_size(size):
+    return tuple(int(n) for n in size.split("x"))
+
+
+def n_rows_for(n_ant):
+    """
+    A number of plot rows (close to 8) which divides n_ant, for aocal_plot.plot
+    """
+    return min((n for n in range(1, n_ant + 1) if n_ant % n == 0), key=lambda n: abs(n - 8))
+
+
+def relative_difference(value, reference):
+    """
+    The maximum absolute difference between a task's result and the
+    reference (complex128) result, relative to the largest reference value
+    """
+    if isinstance(value, tuple):
+        value, reference = value[0], reference[0]
+    value = np.asarray(value, dtype=np.complex128)
+    reference = np.asarray(reference, dtype=np.complex128)
+    return float(np.nanmax(np.abs(value - reference)) / np.nanmax(np.abs(reference)))
+
+
+def task_function(task, ao, filename, dirname, lmbda=1.0, dtype=np.complex128):
+    """
+    A function which runs task once on ao (read from filename), working in
+    dtype where it can, and returns its result
+    """
+    import do_smoothing
+
+    chans = do_smoothing.good_channels(ao)
+    out_filename = os.path.join(dirname, "out.bin")
+
+    if task == "tofile":
+        ao_dtype = ao.astype(dtype)
+        run = lambda: ao_dtype.tofile(out_filename)
+    elif task == "fromfile":
+        run = lambda: aocal.fromfile(filename)
+    elif task == "open_slice":
+        run = lambda: np.array(aocal.open(filename)[0, ao.n_ant//2])
+    elif task == "fit":
+        ao_dtype = ao.astype(dtype)
+        run = lambda: ao_dtype.fit(inplace=False)
+    elif task == "clip":
+        ao_dtype = ao.astype(dtype)
+        run = lambda: ao_dtype.fit(mode='clip', inplace=False)
+    elif task == "objective":
+        ao_dtype = ao[:, :, chans, :].astype(dtype)
+        ao_hat = aocal.AOCal(np.nan_to_num(ao_dtype))
+        run = lambda: do_smoothing.objective(ao_dtype, ao_hat, lmbda, chans)
+    elif task == "value_and_grad":
+        stickel = do_smoothing.GeneralisedStickel(ao[:, :, chans, :], lmbda, freqs=chans, dtype=dtype)
+        ao_hat = stickel.initial_model().astype(dtype)
+        run = lambda: stickel.value_and_grad(ao_hat)
+    elif task == "smooth_banded":
+        run = lambda: do_smoothing.smooth(ao, lmbda, method='banded', dtype=dtype)[0]
+    elif task == "smooth_lbfgs":
+        # A fixed number of iterations, so that timings are comparable
+        run = lambda: do_smoothing.smooth(ao, lmbda, method='L-BFGS-B', maxiter=20, dtype=dtype)[0]
+    elif task == "smooth_multigrid":
+        # Run to convergence: coarse-to-fine time-to-solution
+        run = lambda: do_smoothing.smooth(ao, lmbda, method='L-BFGS-B', multigrid=True, dtype=dtype)[0]
+    elif task == "smooth_jones":
+        # As smooth_lbfgs, but with the 5-parameter Jones model
+        run = lambda: do_smoothing.smooth(ao, lmbda, method='L-BFGS-B', maxiter=20, jones='constrained', dtype=dtype)[0]
+    elif task == "plot":
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        import aocal_plot
+        plot_filename = os.path.join(dirname, "plot")
+        def run():
+            aocal_plot.plot(ao[:1], plot_filename=plot_filename, n_rows=n_rows_for(ao.n_ant))
+            plt.close('all')
+    elif task == "plot_fast":
+        import matplotlib
+        matplotlib.use('Agg')
+        import aocal_plot
+        plot_filename = os.path.join(dirname, "plot")
+        run = lambda: aocal_plot.plot_fast(ao, plot_filename=plot_filename, n_rows=n_rows_for(ao.n_ant))
+    else:
+        raise ValueError("unknown task %s" % task)
+    return run
+
+
+def run_task(task, case, lmbda=1.0, dtype="complex128"):
+    """
+    Set up and time one task on one case. Meant to run in its own process, so
+    that ru_maxrss is the peak memory of just this task. Tasks in DTYPE_TASKS
+    work in dtype, and if that is not complex128, their results are compared
+    with the complex128 results, which are computed after the timed run (so
+    do not add to its time or peak memory).
+    """
+    dtype = np.dtype(dtype)
+    with tempfile.TemporaryDirectory() as dirname:
+        ao, filename = make_case(case, dirname)
+        run = task_function(task, ao, filename, dirname, lmbda, dtype if task in DTYPE_TASKS else np.complex128)
+
+        start = time.perf_counter()
+        value = run()
+        seconds = time.perf_counter() - start
+        result = {"seconds": seconds, "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, "shape": list(ao.shape)}
+
+        if task in DTYPE_TASKS and dtype != np.complex128:
+            result["dtype"] = dtype.name
+            if value is not None:
+                reference = task_function(task, ao, filename, dirname, lmbda, np.complex128)()
+                result["relative_difference"] = relative_difference(value, reference)
+
+    return result
+
+
+def _run_task_in_child(task, case, lmbda, dtype):
+    try:
+        return run_task(task, case, lmbda, dtype)
+    except Exception as e:
+        return {"error": "%s: %s" % (type(e).__name__, e)}
+
+
+def parse_importtime(stderr, exclude=()):
+    """
+    Returns (total, excluded, modules) from the output of python -X
+    importtime: the total import time in ms (the sum of the cumulative times
+    of the top-level imports), apart from that of top-level imports of
+    modules in the packages exclude, which is returned as excluded, and the
+    names of all the modules imported
+    """
+    total = 0.0
+    excluded = 0.0
+    modules = []
+    for line in stderr.splitlines():
+        fields = line.split("|")
+        if not line.startswith("import time:") or len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2][1:]
+        modules.append(name.strip())
+        if name.startswith(" "):
+            continue
+        if name.strip().split(".")[0] in exclude:
+            excluded += int(fields[1]) / 1000.0
+        else:
+            total += int(fields[1]) / 1000.0
+    return total, excluded, modules
+
+
+def run_startup(name, budget_ms=STARTUP_BUDGET_MS):
+    """
+    Run one of STARTUP_COMMANDS on the bundled file in a fresh interpreter
+    with -X importtime, and check it against the budget
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as dirname:
+        args = [arg.format(file=B1934_FILE, out=os.path.join(dirname, "out.bin")) for arg in STARTUP_COMMANDS[name]]
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, "-X", "importtime"] + args, cwd=here, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        seconds = time.perf_counter() - start
+    if process.returncode != 0:
+        return {"task": name, "error": process.stderr.splitlines()[-1]}
+    needs = STARTUP_NEEDS.get(name, [])
+    import_ms, needed_ms, modules = parse_importtime(process.stderr, needs)
+    heavy = sorted(set(module.split(".")[0] for module in modules) & set(HEAVY_MODULES) - set(needs))
+    return {"task": name, "seconds": seconds, "import_ms": import_ms, "budget_ms": budget_ms, "heavy_modules": heavy,
+            "needed_modules": needs, "needed_ms": needed_ms, "ok": import_ms <= budget_ms and not heavy}
+
+
+def startup(budget_ms=STARTUP_BUDGET_MS):
+    """
+    Run all of STARTUP_COMMANDS, printing and returning the results
+    """
+    print("%-16s %10s %10s %10s  %s" % ("task", "seconds", "import/ms", "budget/ms", "heavy modules (needed modules, outside the budget)"))
+    results = []
+    for name in STARTUP_COMMANDS:
+        result = run_startup(name, budget_ms)
+        results.append(result)
+        if "error" in result:
+            print("%-16s %s" % (name, result["error"]))
+        else:
+            needed = " (%s: %.1f ms)" % (", ".join(result["needed_modules"]), result["needed_ms"]) if result["needed_modules"] else ""
+            print("%-16s %10.3f %10.1f %10.1f  %s%s%s" % (name, result["seconds"], result["import_ms"], budget_ms, ", ".join(result["heavy_modules"]) or "-", needed, "" if result["ok"] else "  <-- over budget"))
+    return results
+
+
+def metadata():
+    try:
+        version = subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        version = None
+    return {"version": version, "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(), "cpus": os.cpu_count()}
+
+
+def compare(results, old_results):
+    """
+    Print the ratio of the new to old timings (and memory) of matching results
+    """
+    old = {(r["case"], r["task"]): r for r in old_results if "seconds" in r}
+    print("\n%-16s %-16s %10s %10s" % ("case", "task", "time", "memory"))
+    for r in results:
+        key = (r["case"], r["task"])
+        if "seconds" in r and key in old:
+            print("%-16s %-16s %9.2fx %9.2fx" % (r["case"], r["task"], r["seconds"]/old[key]["seconds"], r["peak_rss_mb"]/old[key]["peak_rss_mb"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the aocal and smoothing hot paths')
+
+    parser.add_argument('--sizes', nargs='+', help='Synthetic case sizes, as N_INTERVALxN_ANTENNASxN_CHANNEL (e.g. 1x128x3072), or a preset: %s [default = quick]' % ", ".join(SIZES))
+    parser.add_argument('--no_b1934', action='store_true', help='Leave out the bundled B1934 solution file case')
+    parser.add_argument('--tasks', nargs='+', choices=TASKS, default=TASKS, help='The tasks to time [default = all]')
+    parser.add_argument('--lmbda', type=float, default=1.0, help='The regularisation parameter used for objective and smoothing tasks [default = 1.0]')
+    parser.add_argument('--dtype', choices=('complex128', 'complex64'), default='complex128', help='The working precision of the tasks which have one (%s). With complex64, their results are also compared with complex128 results [default = complex128]' % ", ".join(DTYPE_TASKS))
+    parser.add_argument('--output', default='bench_results.json', help='File to write the results to, as JSON [default = bench_results.json]')
+    parser.add_argument('--compare', help='Results of an earlier run to compare against')
+    parser.add_argument('--startup', action='store_true', help='Instead of the tasks, measure the start-up (import) time of reading a file and of non-plotting smooths (banded and L-BFGS-B), failing if it is over --startup_budget or if heavy modules (%s) are imported, apart from the scipy.optimize that L-BFGS-B needs, which is reported separately' % ", ".join(HEAVY_MODULES))
+    parser.add_argument('--startup_budget', type=float, default=STARTUP_BUDGET_MS, help='The start-up budget, as total import time in ms [default = %g]' % STARTUP_BUDGET_MS)
+
+    args = parser.parse_args()
+
+    if args.startup:
+        results = startup(args.startup_budget)
+        with open(args.output, "w") as f:
+            json.dump({"meta": metadata(), "startup": results}, f, indent=1)
+        print("Results written to %s" % args.output)
+        if not all(result.get("ok") for result in results):
+            sys.exit("start-up budget exceeded")
+        return
+
+    cases = [] if args.no_b1934 else ["b1934"]
+    for size in args.sizes or ["quick"]:
+        if size in SIZES:
+            cases.extend("%dx%dx%d" % s for s in SIZES[size])
+        else:
+            parse_size(size)
+            cases.append(size)
+
+    # A fresh process for every task, so that peak memory is per task
+    context = multiprocessing.get_context("spawn")
+    results = []
+    print("%-16s %-16s %10s %12s %10s" % ("case", "task", "seconds", "peak RSS/MB", "rel. diff" if args.dtype != "complex128" else ""))
+    for case in cases:
+        for task in args.tasks:
+            with context.Pool(1, maxtasksperchild=1) as pool:
+                result = pool.apply(_run_task_in_child, (task, case, args.lmbda, args.dtype))
+            result.update(case=case, task=task)
+            results.append(result)
+            if "error" in result:
+                print("%-16s %-16s %s" % (case, task, result["error"]))
+            else:
+                difference = " %10.2g" % result["relative_difference"] if "relative_difference" in result else ""
+                print("%-16s %-16s %10.4f %12.1f%s" % (case, task, result["seconds"], result["peak_rss_mb"], difference))
+            sys.stdout.flush()
+
+    with open(args.output, "w") as f:
+        json.dump({"meta": metadata(), "results": results}, f, indent=1)
+    print("Results written to %s" % args.output)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f)["results"])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+"""
+Compare two calibration solution files, e.g. the input and output of a
+smoothing run, or yesterday's and today's solutions.
+
+The metric is the residual of ao_min_diff() (in do_smoothing): the
+difference of the solutions after the second has been rotated onto the
+first by the optimal (closed-form) phase of each channel, here of each
+channel of each interval. The files are streamed one interval, or one block
+of antennas of an interval, at a time, with plain file reads (not memory
+mapped, so that what has been read does not stay resident), so memory use
+is bounded by the block size whatever the size of the files; with blocks of
+antennas, each interval is read twice, first to find the rotations.
+Chunked files are decompressed one block at a time (aocal.fromfile_chunked()),
+and can be compared with each other or with classic files.
+
+Statistics (residual rms, rms relative to the first file, maximum
+deviation, and values flagged in one file but not the other) are
+accumulated per antenna, channel, polarisation and interval, and the report
+can be written as JSON or CSV.
+"""
+import os
+import sys
+import csv
+import json
+import logging
+import argparse
+
+import numpy as np
+
+import aocal
+import profiling
+
+AXES = ("interval", "antenna", "channel", "pol")
+FIELDS = ("n", "sum_sq", "sum_ref", "max", "flagged_1_only", "flagged_2_only")
+COLUMNS = ("axis", "index", "n", "rms", "rel_rms", "max", "flagged_1_only", "flagged_2_only")
+
+
+class Comparison(object):
+    """
+    Running statistics of the residuals between two sets of solutions of the
+    given shape, accumulated block by block with add(), per interval,
+    antenna, channel and polarisation
+    """
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.stats = {axis: {field: np.zeros(n, dtype=float if field in ("sum_sq", "sum_ref", "max") else np.int64) for field in FIELDS}
+                      for axis, n in zip(AXES, self.shape)}
+        self.max = 0.0
+        self.max_at = None
+
+    @profiling.timed("compare.add")
+    def add(self, interval, antenna, x1, x2):
+        """
+        Add the residuals x1 - x2 of antennas antenna:antenna+n of interval
+        (x1 and x2, already rotated onto x1, have shape (n, n_chan, n_pol))
+        """
+        flagged1 = np.isnan(x1)
+        flagged2 = np.isnan(x2)
+        good = ~(flagged1 | flagged2)
+        with np.errstate(invalid='ignore'):
+            residual = np.where(good, np.abs(x1 - x2), 0.0)
+            reference = np.where(good, np.abs(x1), 0.0)
+        values = {"n": good, "sum_sq": residual**2, "sum_ref": reference**2,
+                  "flagged_1_only": flagged1 & ~flagged2, "flagged_2_only": flagged2 & ~flagged1}
+        antennas = slice(antenna, antenna + x1.shape[0])
+        # (axis, index into its statistics, block axes summed over)
+        for axis, index, sum_axes in (("interval", interval, (0, 1, 2)), ("antenna", antennas, (1, 2)),
+                                      ("channel", slice(None), (0, 2)), ("pol", slice(None), (0, 1))):
+            stats = self.stats[axis]
+            for field, value in values.items():
+                stats[field][index] += value.sum(axis=sum_axes)
+            stats["max"][index] = np.maximum(stats["max"][index], residual.max(axis=sum_axes))
+
+        if residual.size > 0 and residual.max() > self.max:
+            a, c, p = np.unravel_index(np.argmax(residual), residual.shape)
+            self.max = float(residual[a, c, p])
+            self.max_at = {"interval": int(interval), "antenna": int(antenna + a), "channel": int(c), "pol": int(p)}
+
+    @staticmethod
+    def _row(axis, index, n, sum_sq, sum_ref, maximum, flagged_1_only, flagged_2_only):
+        return {"axis": axis, "index": index, "n": int(n),
+                "rms": float(np.sqrt(sum_sq / n)) if n > 0 else None,
+                "rel_rms": float(np.sqrt(sum_sq / sum_ref)) if sum_ref > 0 else None,
+                "max": float(maximum) if n > 0 else None,
+                "flagged_1_only": int(flagged_1_only), "flagged_2_only": int(flagged_2_only)}
+
+    def rows(self, axis):
+        """
+        The statistics of each index along axis, as dictionaries with keys
+        COLUMNS
+        """
+        stats = self.stats[axis]
+        return [self._row(axis, i, *(stats[field][i] for field in FIELDS)) for i in range(self.shape[AXES.index(axis)])]
+
+    def summary(self):
+        """
+        The statistics over everything, with the location of the maximum
+        deviation
+        """
+        stats = self.stats["pol"]
+        summary = self._row("all", None, *(stats[field].max() if field == "max" else stats[field].sum() for field in FIELDS))
+        summary["max_at"] = self.max_at
+        return summary
+
+    def report(self):
+        return {"shape": list(self.shape), "summary": self.summary(), **{axis: self.rows(axis) for axis in AXES}}
+
+
+class SolutionFile(object):
+    """
+    A solution file, classic or chunked, of which blocks ao[interval,
+    antennas] (antennas a slice) are read on demand with ordinary reads, or
+    for chunked files by decompressing just their chunks
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.chunked = aocal.is_chunked(filename)
+        self.shape = aocal.header_shape(aocal.file_header(filename))
+        self.file = None if self.chunked else open(filename, "rb")
+
+    def __getitem__(self, key):
+        interval, antennas = key
+        n_int, n_ant, n_chan, n_pol = self.shape
+        start, stop, _ = antennas.indices(n_ant)
+        if self.chunked:
+            return np.asarray(aocal.fromfile_chunked(self.filename, intervals=[interval], antennas=range(start, stop))[0])
+        self.file.seek(aocal.HEADER_SIZE + (interval*n_ant + start)*n_chan*n_pol*np.dtype(np.complex128).itemsize)
+        return np.fromfile(self.file, dtype=np.complex128, count=(stop - start)*n_chan*n_pol).reshape(stop - start, n_chan, n_pol)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _read(ao, interval, antennas):
+    block = np.array(ao[interval, antennas])
+    profiling.count("aocal.bytes_read", block.nbytes)
+    return block
+
+
+def _rotation_sum(x1, x2):
+    """
+    Per channel sum of x1*conj(x2) (over antennas and pols), ignoring NaNs,
+    whose phase is the optimal rotation of x2 onto x1 (see
+    do_smoothing.optimal_rotation())
+    """
+    return np.nansum(x1 * np.conj(x2), axis=(0, 2))
+
+
+@profiling.timed("compare.compare")
+def compare(ao1, ao2, antennas_per_block=None):
+    """
+    Compare two sets of solutions of the same shape (arrays, or
+    SolutionFiles), one interval, or block of antennas_per_block antennas, at
+    a time. Returns a Comparison.
+    """
+    if ao1.shape != ao2.shape:
+        raise ValueError("solutions have different shapes: %s and %s" % (ao1.shape, ao2.shape))
+    n_int, n_ant = ao1.shape[:2]
+    if antennas_per_block is None:
+        antennas_per_block = n_ant
+    blocks = [slice(antenna, antenna + antennas_per_block) for antenna in range(0, n_ant, antennas_per_block)]
+
+    comparison = Comparison(ao1.shape)
+    for interval in range(n_int):
+        logging.debug("comparing interval %d", interval)
+        if len(blocks) == 1:
+            pairs = [(_read(ao1, interval, blocks[0]), _read(ao2, interval, blocks[0]))]
+            S = _rotation_sum(*pairs[0])
+        else:
+            S = sum(_rotation_sum(_read(ao1, interval, block), _read(ao2, interval, block)) for block in blocks)
+            pairs = ((_read(ao1, interval, block), _read(ao2, interval, block)) for block in blocks)
+        rotation = np.ones(len(S), dtype=np.complex128)
+        np.divide(S, np.abs(S), out=rotation, where=np.abs(S) > 0)
+        for block, (x1, x2) in zip(blocks, pairs):
+            comparison.add(interval, block.start, x1, x2 * rotation[np.newaxis, :, np.newaxis])
+    return comparison
+
+
+def compare_files(filename1, filename2, antennas_per_block=None):
+    """
+    compare() two solution files, so that only one block of each is in
+    memory at a time
+    """
+    with SolutionFile(filename1) as ao1, SolutionFile(filename2) as ao2:
+        return compare(ao1, ao2, antennas_per_block)
+
+
+def write_csv(report, f):
+    """
+    Write a report (Comparison.report()) as CSV, one row per index of each
+    axis, after a row (axis "all") for everything
+    """
+    writer = csv.DictWriter(f, COLUMNS, extrasaction='ignore')
+    writer.writeheader()
+    writer.writerow(report["summary"])
+    for axis in AXES:
+        writer.writerows(report[axis])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two calibration solution files, up to the optimal rotation of each channel, with bounded memory')
+
+    parser.add_argument('solution_file_1', help='A calibration solution file in the "AOCal" format (the reference)')
+    parser.add_argument('solution_file_2', help='A calibration solution file of the same shape')
+    parser.add_argument('--output', help='Write the full report (per antenna, channel, pol and interval) to this file, as CSV if it ends in .csv, otherwise as JSON')
+    parser.add_argument('--antennas_per_block', type=int, help='Read this many antennas at a time (each interval is then read twice) [default = whole intervals]')
+    parser.add_argument('--profile', metavar='FILE', help='Write timings, bytes read and peak memory to FILE, as JSON')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='-v info, -vv debug')
+
+    args = parser.parse_args()
+
+    if args.antennas_per_block is not None and args.antennas_per_block < 1:
+        parser.error("--antennas_per_block must be at least 1")
+    shapes = [aocal.header_shape(aocal.file_header(filename)) for filename in (args.solution_file_1, args.solution_file_2)]
+    if shapes[0] != shapes[1]:
+        parser.error("the solution files have different shapes: %s and %s" % tuple(shapes))
+
+    if args.verbose == 1:
+        logging.basicConfig(level=logging.INFO)
+    elif args.verbose > 1:
+        logging.basicConfig(level=logging.DEBUG)
+    if args.profile is not None:
+        profiling.enable()
+
+    report = compare_files(args.solution_file_1, args.solution_file_2, args.antennas_per_block).report()
+    report.update(file_1=args.solution_file_1, file_2=args.solution_file_2)
+
+    summary = report["summary"]
+    fmt = lambda value: "-" if value is None else "%.4g" % value
+    print("%d values compared: rms = %s, relative rms = %s, max = %s at %s" % (summary["n"], fmt(summary["rms"]), fmt(summary["rel_rms"]), fmt(summary["max"]), summary["max_at"]))
+    print("flagged in %s only: %d, in %s only: %d" % (args.solution_file_1, summary["flagged_1_only"], args.solution_file_2, summary["flagged_2_only"]))
+
+    if args.output is not None:
+        with open(args.output, "w", newline="") as f:
+            if os.path.splitext(args.output)[1].lower() == ".csv":
+                write_csv(report, f)
+            else:
+                json.dump(report, f, indent=1)
+        print("Report written to %s" % args.output)
+
+    if args.profile is not None:
+        profiling.write(args.profile, argv=sys.argv)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,1333 @@
+import os
+import sys
+import json
+import hashlib
+import time
+import logging
+import contextlib
 import numpy as np
-import matplotlib.pyplot as plt
 import aocal
-import aocal_plot
+import profiling
 import argparse
 
 
+def pad_freqs(freqs):
+    '''
+    Extend freqs by one (extrapolated) point on either side, matching the zero
+    padding used for the second order finite difference
+    '''
+    freqs = np.asarray(freqs, dtype=float)
+    df_start = freqs[1] - freqs[0]
+    df_end = freqs[-1] - freqs[-2]
+    return np.concatenate(([freqs[0] - df_start], freqs, [freqs[-1] + df_end]))
+
+
+def solve_pentadiagonal_hermitian(diag, upper1, upper2, rhs):
+    '''
+    Solve a batch of Hermitian, positive definite, pentadiagonal systems
+    A x = rhs by banded Cholesky decomposition, A = L L^H.
+
+    The last axis of every argument runs along the matrix diagonal, and all
+    other (leading) axes are broadcast against each other, so that a whole
+    set of systems is solved at once:
+
+        diag   -- A[k, k]    (real, length n)
+        upper1 -- A[k, k+1]  (length n-1)
+        upper2 -- A[k, k+2]  (length n-2)
+        rhs    -- length n
+
+    The work is O(n) per system.
+    '''
+    n = rhs.shape[-1]
+    batch = np.broadcast_shapes(np.shape(diag)[:-1], np.shape(upper1)[:-1], np.shape(upper2)[:-1], rhs.shape[:-1])
+
+    # Work with the diagonal axis first, so that each step of the recursion
+    # touches contiguous memory
+    diag = np.ascontiguousarray(np.moveaxis(np.real(diag), -1, 0))
+    lower1 = np.ascontiguousarray(np.moveaxis(np.conj(upper1), -1, 0))
+    lower2 = np.ascontiguousarray(np.moveaxis(np.conj(upper2), -1, 0))
+    rhs = np.ascontiguousarray(np.moveaxis(rhs, -1, 0))
+
+    l0 = np.empty((n,) + batch)
+    l1 = np.zeros((n,) + batch, dtype=np.complex128)  # l1[k] = L[k, k-1]
+    l2 = np.zeros((n,) + batch, dtype=np.complex128)  # l2[k] = L[k, k-2]
+    z = np.empty((n,) + batch, dtype=np.complex128)
+    for k in range(n):
+        d = diag[k] - 0.0
+        r = rhs[k] + 0.0
+        if k >= 2:
+            l2[k] = lower2[k-2] / l0[k-2]
+            d = d - (l2[k].real**2 + l2[k].imag**2)
+            r -= l2[k] * z[k-2]
+        if k >= 1:
+            l1[k] = lower1[k-1]
+            if k >= 2:
+                l1[k] -= l2[k] * np.conj(l1[k-1])
+            l1[k] /= l0[k-1]
+            d = d - (l1[k].real**2 + l1[k].imag**2)
+            r -= l1[k] * z[k-1]
+        l0[k] = np.sqrt(d)
+        z[k] = r / l0[k]
+
+    x = np.empty((n,) + batch, dtype=np.complex128)
+    for k in range(n-1, -1, -1):
+        r = z[k].copy()
+        if k + 1 < n:
+            r -= np.conj(l1[k+1]) * x[k+1]
+        if k + 2 < n:
+            r -= np.conj(l2[k+2]) * x[k+2]
+        x[k] = r / l0[k]
+
+    return np.moveaxis(x, 0, -1)
+
+
+def pentadiagonal_matvec(diag, upper1, upper2, x):
+    '''
+    A x, for the Hermitian pentadiagonal matrices A with the bands diag,
+    upper1, upper2 (as in solve_pentadiagonal_hermitian()) along the last axis
+    '''
+    y = np.asarray(diag * x, dtype=np.result_type(upper1, x))
+    y[..., :-1] += upper1 * x[..., 1:]
+    y[..., 1:] += np.conj(upper1) * x[..., :-1]
+    y[..., :-2] += upper2 * x[..., 2:]
+    y[..., 2:] += np.conj(upper2) * x[..., :-2]
+    return y
+
+
+def conjugate_gradient(matvec, b, precondition, x0=None, tol=1e-8, maxiter=1000):
+    '''
+    Solve the Hermitian positive definite system A x = b, treating the whole
+    of the array b as one vector, by the preconditioned conjugate gradient
+    method. matvec(x) gives A x, and precondition(r) an approximation to
+    A^-1 r. Iteration stops when |b - A x| < tol |b|.
+
+    Returns x and the number of iterations.
+    '''
+    x = np.zeros_like(b) if x0 is None else np.array(x0, dtype=b.dtype)
+    b_norm = np.linalg.norm(b)
+    if b_norm == 0:
+        return np.zeros_like(b), 0
+    r = b - matvec(x)
+    z = precondition(r)
+    p = z.copy()
+    rz = np.vdot(r, z).real
+    for n_iter in range(1, maxiter + 1):
+        Ap = matvec(p)
+        alpha = rz / np.vdot(p, Ap).real
+        x += alpha*p
+        r -= alpha*Ap
+        if np.linalg.norm(r) < tol*b_norm:
+            break
+        z = precondition(r)
+        rz_new = np.vdot(r, z).real
+        p *= rz_new / rz
+        p += z
+        rz = rz_new
+    return x, n_iter
+
+
+def inner(a, b, block=16384):
+    '''
+    np.vdot(a, b), accumulated in double precision. np.vdot accumulates in
+    the precision of its arguments, so for single precision arrays it is
+    applied block by block, and the block sums are added in double
+    precision.
+    '''
+    if a.dtype != np.complex64 and a.dtype != np.float32:
+        return np.vdot(a, b)
+    a = a.reshape(-1)
+    b = b.reshape(-1)
+    return sum(complex(np.vdot(a[i:i+block], b[i:i+block])) for i in range(0, len(a), block))
+
+
+def squared_norm(x):
+    '''
+    The sum of |x|^2, accumulated in double precision (see inner())
+    '''
+    return inner(x, x).real
+
+
+def _solve_pentadiagonal_block(dirname, shape, start, stop, diag, upper1, upper2):
+    '''
+    Worker for PentadiagonalPool: solve systems start:stop of the batch
+    '''
+    weights = aocal.shared_array(dirname, "weights", shape, dtype=float, mode='r')
+    rhs = aocal.shared_array(dirname, "rhs", shape, mode='r')
+    x = aocal.shared_array(dirname, "x", shape, mode='r+')
+    x[start:stop] = solve_pentadiagonal_hermitian(weights[start:stop] + diag, upper1, upper2, rhs[start:stop])
+    x.flush()
+
+
+class PentadiagonalPool:
+    '''
+    Solves the batches of pentadiagonal systems in GeneralisedStickel.solve_banded()
+    over a pool of worker processes. The systems differ only by a diagonal
+    (weights, of shape (n_systems, n)) which is fixed for the lifetime of the
+    pool, and like the right hand sides and solutions, is passed to the
+    workers through shared memory.
+
+    with PentadiagonalPool(weights, workers) as pool:
+        x = pool.solve(diag, upper1, upper2, rhs)
+    '''
+
+    def __init__(self, weights, workers):
+        self.weights = weights
+        self.workers = workers
+        # A few blocks per worker, so that they finish at about the same time
+        n_blocks = min(len(weights), 4*workers)
+        self.bounds = np.linspace(0, len(weights), n_blocks + 1).astype(int)
+
+    def __enter__(self):
+        self._shm = contextlib.ExitStack()
+        self.dirname = self._shm.enter_context(aocal.shared_memory_dir())
+        aocal.shared_array(self.dirname, "weights", self.weights.shape, dtype=float, mode='w+')[:] = self.weights
+        self.rhs = aocal.shared_array(self.dirname, "rhs", self.weights.shape, mode='w+')
+        self.x = aocal.shared_array(self.dirname, "x", self.weights.shape, mode='w+')
+        from concurrent.futures import ProcessPoolExecutor
+        self.pool = self._shm.enter_context(ProcessPoolExecutor(max_workers=self.workers))
+        return self
+
+    def __exit__(self, *exc):
+        self._shm.close()
+
+    def solve(self, diag, upper1, upper2, rhs):
+        '''
+        Solve (diag(weights) + A) x = rhs, where A has the (shared) bands diag,
+        upper1, upper2 (see solve_pentadiagonal_hermitian())
+        '''
+        self.rhs[:] = rhs
+        jobs = [self.pool.submit(_solve_pentadiagonal_block, self.dirname, self.weights.shape, start, stop, diag, upper1, upper2)
+                for start, stop in zip(self.bounds[:-1], self.bounds[1:])]
+        for job in jobs:
+            job.result()
+        return np.array(self.x)
+
+
+class ObjectiveWorkspace:
+    '''
+    Preallocated buffers for evaluating the terms of objective(), and their
+    gradients, for one data set (ao) and its freqs.
+
+    The evaluation (fit_cost(), smooth_cost()) is fused: it works through the
+    buffers in place, so that once the workspace has been created, repeated
+    evaluations (e.g. inside an optimiser) do not allocate any arrays of the
+    size of the data. The model passed in is never modified.
+
+    As for objective(), channels which contain only nans should already have
+    been removed, NaNs in the data are treated as flags, and the model must
+    not contain NaNs.
+
+    times (by default, the interval indices) are the times of the intervals,
+    for the temporal smoothness term (time_cost()).
+
+    dtype is the working precision of the buffers: complex128, or complex64,
+    which halves the memory traffic of each evaluation. In single precision,
+    all sums (the costs, and the per-channel sums which give the rotations)
+    are still accumulated in double precision, and the costs are returned
+    as double precision values.
+    '''
+
+    def __init__(self, ao, freqs=None, times=None, dtype=np.complex128):
+        n_int, n_ant, n_chan, n_pol = ao.shape
+        if freqs is None:
+            freqs = np.arange(n_chan)
+        if len(freqs) != n_chan:
+            raise ValueError("freqs must have one value per channel")
+        self.shape = ao.shape
+        self.freqs = np.asarray(freqs, dtype=float)
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.complex128, np.complex64):
+            raise ValueError("dtype must be complex128 or complex64")
+        real = np.finfo(self.dtype).dtype
+
+        self.good = ~np.isnan(np.asarray(ao))
+        self.n_good = np.count_nonzero(self.good)
+        self.weights = self.good.astype(real)
+        self.data = np.where(self.good, np.asarray(ao), 0.0).astype(self.dtype)
+
+        padded_freqs = pad_freqs(self.freqs)
+        self.h = np.diff(padded_freqs)  # f_n - f_{n-1}, for each backward difference
+        self.w = 2.0 / (padded_freqs[2:] - padded_freqs[:-2])  # 1/(0.5*(f_{n+1} - f_{n-1}))
+        self.n_smooth = n_int * n_ant * n_chan * n_pol
+        self._inv_h = (1.0 / self.h)[np.newaxis, np.newaxis, :, np.newaxis].astype(real)
+        self._w = self.w[np.newaxis, np.newaxis, :, np.newaxis].astype(real)
+        self._grad_w = ((2.0 / self.n_smooth) * self._w).astype(real)
+
+        # Full size buffers. The first and last channels of padded are the zero
+        # padding of ao_min_diff2_freq(), and are never written to.
+        padded_shape = (n_int, n_ant, n_chan + 2, n_pol)
+        diff1_shape = (n_int, n_ant, n_chan + 1, n_pol)
+        self.residual = np.empty(self.shape, dtype=self.dtype)
+        self.grad = np.empty(self.shape, dtype=self.dtype)
+        self.padded = np.zeros(padded_shape, dtype=self.dtype)
+        self.grad_padded = np.empty(padded_shape, dtype=self.dtype)
+        self.diff1 = np.empty(diff1_shape, dtype=self.dtype)
+        self.work1 = np.empty(diff1_shape, dtype=self.dtype)
+        self.diff2 = np.empty(self.shape, dtype=self.dtype)
+
+        # Per channel buffers. The sums are always double precision (numpy
+        # accumulates in the dtype of out), the phasors are in working precision.
+        self.S_fit = np.empty(n_chan, dtype=np.complex128)
+        self.S = np.empty(n_chan + 1, dtype=np.complex128)
+        self.abs_S = np.empty(n_chan + 1)
+        self.dtheta = np.empty(n_chan + 1)
+        self.rot_fit = np.empty((1, 1, n_chan, 1), dtype=self.dtype)
+        self.rot = np.empty((1, 1, n_chan + 1, 1), dtype=self.dtype)
+        self.conj_rot = np.empty((1, 1, n_chan + 1, 1), dtype=self.dtype)
+        self.dtheta_dupper = np.empty((1, 1, n_chan + 1, 1), dtype=self.dtype)
+        self.dtheta_dlower = np.empty((1, 1, n_chan + 1, 1), dtype=self.dtype)
+
+        # Temporal smoothness term, which needs at least 3 intervals
+        if times is None:
+            times = np.arange(n_int)
+        if len(times) != n_int:
+            raise ValueError("times must have one value per interval")
+        self.times = np.asarray(times, dtype=float)
+        self.h_t = np.diff(self.times)  # t_n - t_{n-1}
+        self.w_t = 2.0 / (self.times[2:] - self.times[:-2])
+        self.n_time = max(n_int - 2, 0) * n_ant * n_chan * n_pol
+        if n_int >= 3:
+            self.diff1_t = np.empty((n_int - 1, n_ant, n_chan, n_pol), dtype=self.dtype)
+            self.diff2_t = np.empty((n_int - 2, n_ant, n_chan, n_pol), dtype=self.dtype)
+            self.work_t = np.empty((n_ant, n_chan, n_pol), dtype=self.dtype)
+            self.S_t = np.empty(n_int - 1, dtype=np.complex128)
+            self.abs_S_t = np.empty(n_int - 1)
+            self.rot_t = np.empty((n_int - 1, 1, 1, 1), dtype=self.dtype)
+            self._h_t = self.h_t[:, np.newaxis, np.newaxis, np.newaxis].astype(real)
+            self._w_t = self.w_t[:, np.newaxis, np.newaxis, np.newaxis].astype(real)
+
+    def _unit_phasor(self, S, abs_S, out):
+        '''
+        S/|S| (i.e. exp(1j*np.angle(S))), into out, which has S's values along
+        its channel axis. 1 where S is 0.
+        '''
+        out = out.reshape(-1)
+        np.abs(S, out=abs_S)
+        out.fill(1.0)
+        np.divide(S, abs_S, out=out, where=abs_S > 0)
+
+    @profiling.timed("ObjectiveWorkspace.fit_cost")
+    def fit_cost(self, ao_hat, grad=None):
+        '''
+        C_fit, using the closed-form theta_min of optimal_rotation(). If grad is
+        given, the gradient is added to it.
+
+        Since theta_min minimises C_fit, its dependence on ao_hat does not
+        contribute to the gradient.
+        '''
+        R = self.residual
+        np.conjugate(ao_hat, out=R)
+        np.multiply(self.data, R, out=R)
+        np.sum(R, axis=(0, 1, 3), out=self.S_fit)
+        self._unit_phasor(self.S_fit, self.abs_S[:-1], self.rot_fit)
+
+        np.multiply(ao_hat, self.rot_fit, out=R)
+        np.subtract(self.data, R, out=R)
+        np.multiply(R, self.weights, out=R)
+        C_fit = squared_norm(R) / self.n_good
+
+        if grad is not None:
+            np.multiply(R, np.conjugate(self.rot_fit, out=self.rot_fit), out=R)
+            np.multiply(R, 2.0 / self.n_good, out=R)
+            np.subtract(grad, R, out=grad)
+
+        return C_fit
+
+    @profiling.timed("ObjectiveWorkspace.smooth_cost")
+    def smooth_cost(self, ao_hat, grad=None, lmbda=1.0):
+        '''
+        C_smooth, as computed from ao_min_diff2_freq(). If grad is given,
+        lmbda times the gradient is added to it.
+
+        Unlike theta_min in the fit term, the rotations between adjacent
+        channels do not minimise C_smooth itself, so their dependence on
+        ao_hat is propagated through to the gradient.
+        '''
+        padded = self.padded
+        padded[:, :, 1:-1, :] = ao_hat
+        upper = padded[:, :, 1:, :]
+        lower = padded[:, :, :-1, :]
+        work = self.work1
+
+        # First order differences, for each pair of adjacent channels
+        np.conjugate(lower, out=work)
+        np.multiply(upper, work, out=work)
+        np.sum(work, axis=(0, 1, 3), out=self.S)
+        self._unit_phasor(self.S, self.abs_S, self.rot)
+        diff1 = self.diff1
+        np.multiply(lower, self.rot, out=diff1)
+        np.subtract(upper, diff1, out=diff1)
+        np.multiply(diff1, self._inv_h, out=diff1)
+
+        # Second order difference
+        diff2 = self.diff2
+        np.subtract(diff1[:, :, 1:, :], diff1[:, :, :-1, :], out=diff2)
+        np.multiply(diff2, self._w, out=diff2)
+        C_smooth = squared_norm(diff2) / self.n_smooth
+
+        if grad is not None:
+            # d/d(diff2), then d/d(diff1) (in work), then scaled by 1/h
+            np.multiply(diff2, self._grad_w, out=diff2)
+            u = work
+            u[:, :, -1:, :] = 0.0
+            u[:, :, :-1, :] = 0.0
+            np.add(u[:, :, 1:, :], diff2, out=u[:, :, 1:, :])
+            np.subtract(u[:, :, :-1, :], diff2, out=u[:, :, :-1, :])
+            np.multiply(u, self._inv_h, out=u)
+
+            # Derivative with respect to the rotation angle, Im(conj(u) rot lower),
+            # and from there (via theta = arg S) back to the model
+            np.multiply(lower, self.rot, out=diff1)
+            np.conjugate(diff1, out=diff1)
+            np.multiply(diff1, u, out=diff1)
+            np.sum(diff1.imag, axis=(0, 1, 3), out=self.dtheta)
+            np.negative(self.dtheta, out=self.dtheta)
+            nonzero = self.abs_S > 0
+            dtheta_dupper = self.dtheta_dupper.reshape(-1)
+            dtheta_dlower = self.dtheta_dlower.reshape(-1)
+            dtheta_dupper.fill(0.0)
+            dtheta_dlower.fill(0.0)
+            np.divide(1j*self.dtheta, np.conjugate(self.S), out=dtheta_dupper, where=nonzero)
+            np.divide(-1j*self.dtheta, self.S, out=dtheta_dlower, where=nonzero)
+
+            grad_padded = self.grad_padded
+            grad_padded.fill(0.0)
+            np.add(grad_padded[:, :, 1:, :], u, out=grad_padded[:, :, 1:, :])
+            np.multiply(lower, self.dtheta_dupper, out=diff1)
+            np.add(grad_padded[:, :, 1:, :], diff1, out=grad_padded[:, :, 1:, :])
+            np.multiply(u, np.conjugate(self.rot, out=self.conj_rot), out=diff1)
+            np.subtract(grad_padded[:, :, :-1, :], diff1, out=grad_padded[:, :, :-1, :])
+            np.multiply(upper, self.dtheta_dlower, out=diff1)
+            np.add(grad_padded[:, :, :-1, :], diff1, out=grad_padded[:, :, :-1, :])
+
+            interior = grad_padded[:, :, 1:-1, :]
+            np.multiply(interior, lmbda, out=interior)
+            np.add(grad, interior, out=grad)
+
+        return C_smooth
+
+    @profiling.timed("ObjectiveWorkspace.time_cost")
+    def time_cost(self, ao_hat, grad=None, lmbda_t=1.0):
+        '''
+        C_time, the mean squared second order difference across intervals
+        (at times), in the same form as C_smooth across channels: each
+        interval is first rotated onto the next by the closed-form (per
+        interval) rotation, and it is the differences of these first order
+        differences that are penalised. Unlike C_smooth, the ends are not
+        zero padded, so the first and last intervals are not pulled towards
+        zero. It is 0 if there are fewer than 3 intervals. If grad is given,
+        lmbda_t times the gradient is added to it.
+        '''
+        if self.n_time == 0:
+            return 0.0
+        n_int = self.shape[0]
+        S = self.S_t
+        for t in range(1, n_int):
+            S[t-1] = inner(ao_hat[t-1], ao_hat[t])
+        self._unit_phasor(S, self.abs_S_t, self.rot_t)
+
+        # First order differences between adjacent intervals
+        diff1 = self.diff1_t
+        np.multiply(ao_hat[:-1], self.rot_t, out=diff1)
+        np.subtract(ao_hat[1:], diff1, out=diff1)
+        np.divide(diff1, self._h_t, out=diff1)
+
+        # Second order difference
+        diff2 = self.diff2_t
+        np.subtract(diff1[1:], diff1[:-1], out=diff2)
+        np.multiply(diff2, self._w_t, out=diff2)
+        C_time = squared_norm(diff2) / self.n_time
+
+        if grad is not None:
+            # d/d(diff2), then d/d(diff1) (in diff1), then scaled by 1/h
+            np.multiply(diff2, self._w_t*(2.0*lmbda_t/self.n_time), out=diff2)
+            u = diff1
+            u.fill(0.0)
+            np.add(u[1:], diff2, out=u[1:])
+            np.subtract(u[:-1], diff2, out=u[:-1])
+            np.divide(u, self._h_t, out=u)
+
+            work = self.work_t
+            for t in range(1, n_int):
+                rot = self.rot_t[t-1, 0, 0, 0]
+                # Directly through the differences
+                np.add(grad[t], u[t-1], out=grad[t])
+                np.multiply(u[t-1], np.conj(rot), out=work)
+                np.subtract(grad[t-1], work, out=grad[t-1])
+                # Through the rotation angle, as for C_smooth
+                if self.abs_S_t[t-1] > 0:
+                    dtheta = (rot*inner(u[t-1], ao_hat[t-1])).imag
+                    np.multiply(ao_hat[t-1], 1j*dtheta/np.conj(S[t-1]), out=work)
+                    np.add(grad[t], work, out=grad[t])
+                    np.multiply(ao_hat[t], -1j*dtheta/S[t-1], out=work)
+                    np.add(grad[t-1], work, out=grad[t-1])
+
+        return C_time
+
+    def evaluate(self, ao_hat, lmbda, gradient=True):
+        '''
+        Returns (C_fit, C_smooth, grad), where grad is the gradient of
+        C_fit + lmbda*C_smooth (see GeneralisedStickel), or None if gradient is
+        False. grad is one of the workspace buffers, so is overwritten by the
+        next evaluation.
+        '''
+        grad = None
+        if gradient:
+            grad = self.grad
+            grad.fill(0.0)
+        C_fit = self.fit_cost(ao_hat, grad)
+        C_smooth = self.smooth_cost(ao_hat, grad, lmbda=lmbda)
+        return C_fit, C_smooth, grad
+
+
 class GeneralisedStickel:
-    pass
+    '''
+    Solver for the regularised cost function in objective(),
+
+        C = C_fit + lmbda*C_smooth
+
+    which supplies the value together with its analytic gradient with respect
+    to (the real and imaginary parts of) the model, so that the minimisation
+    can be handed to a quasi-Newton or conjugate gradient method.
+
+    Gradients are returned as complex arrays with the same shape as the model,
+    with the convention
+
+        grad = dC/d(Re ao_hat) + 1j*dC/d(Im ao_hat)
+
+    so that grad.view(np.float64) lines up with ao_hat.view(np.float64).
+
+    NaNs in the data are treated as flags and excluded from C_fit. The model
+    must not contain NaNs. As for objective(), any channels which contain only
+    nans should already have been removed, and freqs (which need not be
+    uniformly spaced) should be given for the remaining channels.
+
+    If lmbda_t > 0, the cost also includes lmbda_t*C_time, which regularises
+    across calibration intervals at times (by default, the interval indices;
+    see ObjectiveWorkspace.time_cost()), so that the intervals are smoothed
+    jointly and flagged intervals are interpolated from their neighbours.
+
+    dtype (complex128 or complex64) is the working precision of the cost and
+    gradient evaluations (see ObjectiveWorkspace). The optimiser itself, the
+    banded solves and the returned model are always double precision.
+    '''
+
+    def __init__(self, ao, lmbda, freqs=None, lmbda_t=0.0, times=None, dtype=np.complex128):
+        self.ao = ao
+        self.lmbda = lmbda
+        self.lmbda_t = lmbda_t
+        self.workspace = ObjectiveWorkspace(ao, freqs=freqs, times=times, dtype=dtype)
+        self.dtype = self.workspace.dtype
+        self.freqs = self.workspace.freqs
+        self.good = self.workspace.good
+        self.n_good = self.workspace.n_good
+        if self.n_good == 0:
+            raise ValueError("data contain no unflagged values")
+        self.data = self.workspace.data
+        self.h = self.workspace.h
+        self.w = self.workspace.w
+
+        # Used to make the cost seen by the optimiser dimensionless and O(1) per
+        # data point, so that the default tolerances are meaningful
+        self.scale = 1.0 / np.mean(np.abs(self.data[self.good])**2, dtype=np.float64)
+
+        self.n_eval = 0
+
+    def initial_model(self):
+        '''
+        The data, with flagged values set to zero
+        '''
+        return self.data.astype(np.complex128)
+
+    def fit_cost(self, ao_hat, grad=None):
+        '''
+        C_fit (see ObjectiveWorkspace.fit_cost()). If grad is given, the
+        gradient is added to it.
+        '''
+        return self.workspace.fit_cost(np.asarray(ao_hat), grad)
+
+    def smooth_cost(self, ao_hat, grad=None):
+        '''
+        C_smooth (see ObjectiveWorkspace.smooth_cost()). If grad is given,
+        lmbda times the gradient is added to it.
+        '''
+        return self.workspace.smooth_cost(np.asarray(ao_hat), grad, lmbda=self.lmbda)
+
+    def time_cost(self, ao_hat, grad=None):
+        '''
+        C_time (see ObjectiveWorkspace.time_cost()). If grad is given,
+        lmbda_t times the gradient is added to it.
+        '''
+        return self.workspace.time_cost(np.asarray(ao_hat), grad, lmbda_t=self.lmbda_t)
+
+    def total_cost(self, ao_hat):
+        '''
+        C = C_fit + lmbda*C_smooth (+ lmbda_t*C_time)
+        '''
+        C = self.fit_cost(ao_hat) + self.lmbda*self.smooth_cost(ao_hat)
+        if self.lmbda_t > 0:
+            C += self.lmbda_t*self.time_cost(ao_hat)
+        return C
+
+    @profiling.timed("GeneralisedStickel.value_and_grad")
+    def value_and_grad(self, ao_hat):
+        '''
+        Returns (C, grad), where C = C_fit + lmbda*C_smooth (+ lmbda_t*C_time).
+        grad belongs to the workspace, and is overwritten by the next
+        evaluation.
+        '''
+        ao_hat = np.asarray(ao_hat)
+        C_fit, C_smooth, grad = self.workspace.evaluate(ao_hat, self.lmbda)
+        C = C_fit + self.lmbda*C_smooth
+        if self.lmbda_t > 0:
+            C += self.lmbda_t*self.workspace.time_cost(ao_hat, grad, lmbda_t=self.lmbda_t)
+        self.n_eval += 1
+        return C, grad
+
+    def _fun(self, x):
+        ao_hat = x.view(np.complex128).reshape(self.ao.shape)
+        if self.dtype != np.complex128:
+            ao_hat = ao_hat.astype(self.dtype)
+        C, grad = self.value_and_grad(ao_hat)
+        grad = np.asarray(grad, dtype=np.complex128)
+        if profiling.enabled:
+            self._last_evaluation = (C, np.linalg.norm(grad))
+        # scipy keeps hold of the gradients it is given, so this one is a copy
+        return C*self.scale, grad.view(np.float64).ravel()*self.scale
+
+    def _fun_subset(self, x, ao_hat, subset):
+        # ao_hat is in working precision, and is updated in place
+        ao_hat[subset] = x.view(np.complex128)
+        C, grad = self.value_and_grad(ao_hat)
+        grad = np.asarray(grad[subset], dtype=np.complex128)
+        if profiling.enabled:
+            self._last_evaluation = (C, np.linalg.norm(grad))
+        return C*self.scale, grad.view(np.float64)*self.scale
+
+    def _trace_iteration(self, *args):
+        '''
+        scipy.optimize.minimize() callback, only used when profiling: traces
+        the cost and gradient norm of the last evaluation
+        '''
+        self._iteration += 1
+        C, grad_norm = self._last_evaluation
+        profiling.trace("iterations", method=self._method, lmbda=float(self.lmbda), n_chan=self.ao.shape[2], iteration=self._iteration, cost=float(C), grad_norm=float(grad_norm))
+
+    def _minimize(self, fun, x0, method, tol, maxiter, args=()):
+        '''
+        scipy.optimize.minimize(), with per-iteration traces when profiling
+        '''
+        from scipy.optimize import minimize
+        callback = None
+        if profiling.enabled:
+            self._method = method
+            self._iteration = 0
+            callback = self._trace_iteration
+        return minimize(fun, x0, args=args, jac=True, method=method, tol=tol, callback=callback, options={'maxiter': maxiter})
+
+    @profiling.timed("GeneralisedStickel.solve")
+    def solve(self, ao_hat=None, method='L-BFGS-B', maxiter=1000, tol=None, spectra=None):
+        '''
+        Minimise the cost function, starting from ao_hat (by default, the data
+        with flags set to zero). method is passed to scipy.optimize.minimize(),
+        and should be one that makes use of the gradient (e.g. 'L-BFGS-B',
+        'CG', 'BFGS' for small problems).
+
+        If spectra (a boolean array of shape (n_int, n_ant, n_pol)) is given,
+        only those spectra are solved for, and the rest are held at ao_hat.
+
+        Returns the model as an AOCal, and stores the scipy OptimizeResult in
+        self.result.
+        '''
+        if ao_hat is None:
+            ao_hat = self.initial_model()
+        ao_hat = np.array(ao_hat, dtype=np.complex128)
+
+        self.n_eval = 0
+        if spectra is None:
+            x0 = ao_hat.view(np.float64).ravel()
+            self.result = self._minimize(self._fun, x0, method, tol, maxiter)
+            ao_hat = self.result.x.view(np.complex128).reshape(self.ao.shape)
+        elif not np.any(spectra):
+            from scipy.optimize import OptimizeResult
+            self.result = OptimizeResult(fun=self.total_cost(ao_hat)*self.scale, nit=0, success=True, message="no spectra to solve for")
+        else:
+            subset = np.broadcast_to(np.asarray(spectra, dtype=bool)[:, :, np.newaxis, :], ao_hat.shape)
+            x0 = ao_hat[subset].view(np.float64)
+            work = ao_hat.astype(self.dtype, copy=False)
+            self.result = self._minimize(self._fun_subset, x0, method, tol, maxiter, args=(work, subset))
+            ao_hat[subset] = self.result.x.view(np.complex128)
+        logging.info("%s: %s (%d iterations, %d evaluations)", method, self.result.message, self.result.nit, self.n_eval)
+
+        self.cost = self.result.fun / self.scale
+        self.n_iter = self.result.nit
+        return aocal.AOCal(ao_hat, getattr(self.ao, 'time_start', 0.0), getattr(self.ao, 'time_end', 0.0))
+
+    def smooth_bands(self, phi):
+        '''
+        The bands (diag, upper1, upper2) of the Hermitian pentadiagonal matrix
+        D^H D, where D is the second order difference operator of
+        smooth_cost() with the rotations between adjacent channels held fixed
+        at phi (one per pair of channels, including the zero padding at either
+        end, i.e. length n_chan + 1).
+        '''
+        rot = np.exp(1j*phi)
+        h = self.h
+        w = self.w
+        # Row j of D: D2_j = a_j x_{j-1} + b_j x_j + c_j x_{j+1}
+        a = w * rot[:-1] / h[:-1]
+        b = -w * (rot[1:] / h[1:] + 1.0 / h[:-1])
+        c = w / h[1:]
+
+        diag = np.abs(b)**2
+        diag[1:] += np.abs(c[:-1])**2
+        diag[:-1] += np.abs(a[1:])**2
+        upper1 = np.conj(b[:-1])*c[:-1] + np.conj(a[1:])*b[1:]
+        upper2 = np.conj(a[1:-1])*c[1:-1]
+        return diag, upper1, upper2
+
+    def time_bands(self, psi):
+        '''
+        The bands (diag, upper1, upper2) of the Hermitian pentadiagonal matrix
+        D_t^H D_t, where D_t is the second order difference operator across
+        intervals of time_cost(), with the rotations between adjacent
+        intervals held fixed at psi (length n_int - 1). Note that diag does
+        not depend on psi.
+        '''
+        rot = np.exp(1j*psi)
+        h = self.workspace.h_t
+        w = self.workspace.w_t
+        # Row k of D_t: a_k x_k + b_k x_{k+1} + c_k x_{k+2}
+        a = w * rot[:-1] / h[:-1]
+        b = -w * (rot[1:] / h[1:] + 1.0 / h[:-1])
+        c = w / h[1:]
+
+        diag = np.zeros(len(psi) + 1)
+        diag[:-2] += np.abs(a)**2
+        diag[1:-1] += np.abs(b)**2
+        diag[2:] += np.abs(c)**2
+        upper1 = np.zeros(len(psi), dtype=np.complex128)
+        upper1[:-1] += np.conj(a)*b
+        upper1[1:] += np.conj(b)*c
+        upper2 = np.conj(a)*c
+        return diag, upper1, upper2
+
+    def _joint(self):
+        '''
+        True if the intervals are smoothed jointly (lmbda_t > 0, and at least
+        3 intervals)
+        '''
+        return self.lmbda_t > 0 and self.workspace.n_time > 0
+
+    @profiling.timed("GeneralisedStickel.solve_normal")
+    def solve_normal(self, phi, rhs, weights, solve, psi=None, x0=None, cg_iterations=None):
+        '''
+        Solve the normal equations (W + k D^H D + k_t D_t^H D_t) x = rhs, with
+        the rotations between channels fixed at phi and (when the intervals are
+        smoothed jointly) those between intervals fixed at psi. Arrays have
+        their channel axis last, i.e. shape (n_int, n_ant, n_pol, n_chan).
+
+        Without the temporal term, the systems along the channel axis are
+        independent, and are solved by solve(diag, upper1, upper2, rhs), which
+        must solve the batch of pentadiagonal systems whose diagonal is
+        weights + diag. With it, the full (interval x channel) system is solved
+        by conjugate_gradient(), with a separable preconditioner. Each iteration
+        is O(size) (plus O(n_int^2) per spectrum for the preconditioner), and
+        no large matrices are formed. The number of conjugate gradient
+        iterations is appended to the list cg_iterations (by default,
+        self.cg_iterations).
+        '''
+        kappa = self.lmbda * self.n_good / self.workspace.n_smooth
+        diag, upper1, upper2 = (kappa*band for band in self.smooth_bands(phi))
+        if psi is None or not self._joint():
+            return solve(diag, upper1, upper2, rhs)
+
+        kappa_t = self.lmbda_t * self.n_good / self.workspace.n_time
+        diag_t, upper1_t, upper2_t = (kappa_t*band for band in self.time_bands(psi))
+
+        def matvec(x):
+            y = weights*x + pentadiagonal_matvec(diag, upper1, upper2, x)
+            y += np.moveaxis(pentadiagonal_matvec(diag_t, upper1_t, upper2_t, np.moveaxis(x, 0, -1)), -1, 0)
+            return y
+
+        # The preconditioner is the same system with the fit weights averaged
+        # over intervals, which is separable: the temporal term is the same
+        # (small, dense) matrix for every antenna, pol and channel, so in its
+        # eigenbasis the system is one pentadiagonal system along the channels
+        # per eigenvalue. It is exact if the flags do not change with time.
+        temporal = np.diag(diag_t).astype(np.complex128) + np.diag(upper1_t, 1) + np.diag(np.conj(upper1_t), -1) + np.diag(upper2_t, 2) + np.diag(np.conj(upper2_t), -2)
+        eigenvalues, eigenvectors = np.linalg.eigh(temporal)
+        diag_separable = weights.mean(axis=0) + diag + eigenvalues[:, np.newaxis, np.newaxis, np.newaxis]
+
+        def precondition(r):
+            z = np.tensordot(np.conj(eigenvectors.T), r, axes=(1, 0))
+            z = solve_pentadiagonal_hermitian(diag_separable, upper1, upper2, z)
+            return np.tensordot(eigenvectors, z, axes=(1, 0))
+
+        x, n_iter = conjugate_gradient(matvec, rhs, precondition, x0=x0)
+        logging.debug("conjugate gradient: %d iterations", n_iter)
+        profiling.count("conjugate_gradient.iterations", n_iter)
+        (self.cg_iterations if cg_iterations is None else cg_iterations).append(n_iter)
+        return x
+
+    @profiling.timed("GeneralisedStickel.solve_banded")
+    def solve_banded(self, ao_hat=None, maxiter=100, tol=1e-5, workers=None, spectra=None, polish=None):
+        '''
+        Minimise the cost function by alternating between
+
+          1. the closed-form rotations (optimal_rotation()) for the fit term
+             and between adjacent channels in the smoothness term, and
+          2. with those rotations held fixed, the exact minimum of what is then
+             a quadratic cost, i.e. the solution of the Stickel (2010) normal
+             equations (W + k D^H D) ao_hat = W ao. These are pentadiagonal
+             along frequency and are solved for all intervals, antennas and
+             pols at once, in O(n_chan) time. With the temporal term, the
+             intervals are coupled, and the normal equations are solved by
+             preconditioned conjugate gradients (see solve_normal()).
+
+        Iteration stops when the relative decrease in the cost falls below
+        tol, or the cost stops decreasing. The default tol of 1e-5 usually
+        stops after 2 iterations, with the cost within ~1e-5 (relative) of
+        where a tol of 1e-9 gets to in up to 100 iterations, but the model can
+        still differ from it by a few percent of its largest value, in the
+        directions the cost barely constrains; use a smaller tol if those
+        matter. This is an alternative to solve(), and is usually much faster;
+        its result can also be used as the starting point for solve(). The
+        number of iterations and the cost after each accepted one are stored
+        in self.n_iter and self.costs.
+
+        The rotations between adjacent channels (and intervals) are those of
+        the model, which do not minimise the smoothness terms, so the fixed
+        point of this iteration is not quite the minimum of the cost function.
+        With the temporal term it can be well short of it (e.g. 8% above it,
+        for 5 intervals). If polish is True (by default, when the intervals
+        are smoothed jointly), the result is therefore polished with solve()
+        (L-BFGS-B), whose number of iterations is stored in
+        self.polish_iterations (0 if there is no polish).
+
+        If workers > 1, the solves are spread over a PentadiagonalPool of that
+        many processes (only when the intervals are independent). The numbers
+        of conjugate gradient iterations (if any) are stored in
+        self.cg_iterations.
+
+        If spectra (a boolean array of shape (n_int, n_ant, n_pol)) is given,
+        only those spectra are solved for, and the rest are held at ao_hat.
+        The rotations are still those of the whole model, so each iteration
+        still touches all of it once, but the solves are only done for the
+        selected spectra (in all intervals, if they are smoothed jointly).
+        '''
+        if ao_hat is None:
+            ao_hat = self.initial_model()
+        ao_hat = np.array(ao_hat, dtype=np.complex128)
+        n_int, n_ant, n_chan, n_pol = ao_hat.shape
+
+        # The normal equations are scaled so that the (diagonal) fit term has
+        # unit weight for every unflagged data point
+        weights = np.moveaxis(self.good, 2, -1).astype(float)
+        self.cg_iterations = []
+
+        # Arrays with their channel axis last, restricted to the spectra being
+        # solved for (keeping the interval axis first if they are coupled)
+        select = lambda a: a
+        if spectra is not None:
+            spectra = np.asarray(spectra, dtype=bool)
+            if self._joint():
+                spectra = np.broadcast_to(np.any(spectra, axis=0), spectra.shape)
+                select = lambda a: a[spectra].reshape(n_int, -1, 1, n_chan)
+            else:
+                select = lambda a: a[spectra]
+            weights = select(weights)
+
+        with contextlib.ExitStack() as stack:
+            # Spectra are independent once the rotations are fixed (unless they
+            # are coupled across intervals), so the solves can be shared out
+            # over a pool of processes
+            if workers is not None and workers > 1 and not self._joint():
+                pool = stack.enter_context(PentadiagonalPool(weights.reshape(-1, n_chan), workers))
+                solve = lambda diag, upper1, upper2, rhs: pool.solve(diag, upper1, upper2, rhs.reshape(-1, n_chan)).reshape(rhs.shape)
+            else:
+                solve = lambda diag, upper1, upper2, rhs: solve_pentadiagonal_hermitian(weights + diag, upper1, upper2, rhs)
+
+            self.costs = []
+            for self.n_iter in range(1, maxiter + 1):
+                # Fit term rotations: rotate the data onto the model
+                theta = optimal_rotation(self.data, ao_hat, axis=(0, 1, 3))
+                target = self.data * np.exp(-1j*theta)[np.newaxis, np.newaxis, :, np.newaxis]
+
+                # Smoothness term rotations, between adjacent (zero padded) channels
+                S = np.zeros(n_chan + 1, dtype=np.complex128)
+                S[1:-1] = np.sum(ao_hat[:, :, 1:, :] * np.conj(ao_hat[:, :, :-1, :]), axis=(0, 1, 3))
+                # and between adjacent intervals
+                psi = np.angle(np.sum(ao_hat[1:] * np.conj(ao_hat[:-1]), axis=(1, 2, 3)))
+
+                rhs = select(np.moveaxis(target, 2, -1)) * weights
+                x = self.solve_normal(np.angle(S), rhs, weights, solve, psi=psi, x0=select(np.moveaxis(ao_hat, 2, -1)))
+                if spectra is None:
+                    new_ao_hat = np.moveaxis(x, -1, 2)
+                else:
+                    new_ao_hat = ao_hat.copy()
+                    np.moveaxis(new_ao_hat, 2, -1)[spectra] = x.reshape(-1, n_chan)
+
+                cost = self.total_cost(new_ao_hat)
+                logging.debug("iteration %d: cost = %g", self.n_iter, cost)
+                if profiling.enabled:
+                    grad_norm = np.linalg.norm(self.value_and_grad(new_ao_hat)[1])
+                    profiling.trace("iterations", method="banded", lmbda=float(self.lmbda), n_chan=n_chan, iteration=self.n_iter, cost=float(cost), grad_norm=float(grad_norm))
+                if self.costs and cost >= self.costs[-1]:
+                    # The rotations between adjacent channels minimise the first,
+                    # not the second, difference, so the fixed point of this
+                    # iteration is not quite the minimum of the cost function.
+                    # Stop as soon as it stops making progress.
+                    break
+                ao_hat = new_ao_hat
+                self.costs.append(cost)
+                if len(self.costs) > 1 and self.costs[-2] - cost < tol*cost:
+                    break
+
+        self.cost = self.costs[-1]
+        logging.info("banded: %d iterations, cost = %g", self.n_iter, self.cost)
+        n_iter = self.n_iter
+        self.polish_iterations = 0
+        if polish is None:
+            polish = self._joint()
+        if polish:
+            model = self.solve(ao_hat=ao_hat, spectra=spectra)
+            logging.info("banded: polished with L-BFGS-B in %d iterations, cost = %g", self.n_iter, self.cost)
+            self.polish_iterations = self.n_iter
+            self.n_iter = n_iter
+            self.costs.append(self.cost)
+            return model
+        return aocal.AOCal(ao_hat, getattr(self.ao, 'time_start', 0.0), getattr(self.ao, 'time_end', 0.0))
+
+    @profiling.timed("GeneralisedStickel.solve_multigrid")
+    def solve_multigrid(self, method='L-BFGS-B', maxiter=1000, workers=None, factor=2, min_channels=16):
+        '''
+        Minimise the cost function coarse-to-fine. The data are averaged onto
+        successively finer grids of channels (restrict_channels(), with bin
+        widths from multigrid_widths()), and the problem is solved on each
+        (with solve_method()), starting from the solution on the previous,
+        coarser grid interpolated onto this one (prolong_channels()). The
+        low-frequency structure, which is what takes first-order methods
+        longest to find, is found on the coarse grids, where it is cheap.
+
+        C_fit and C_smooth are both means over channels, so the same lmbda is
+        used on every level. On the coarse levels, each spectrum's phase slope
+        (phase_slopes()) is taken out of the data first, and it is put back
+        when the model is interpolated onto the original channels.
+
+        Returns the model on the original channels. A summary of each level
+        (coarsest first, finishing with the original channels) is stored in
+        self.levels, as a list of dictionaries with keys n_chan, width,
+        n_iter, cost and seconds.
+
+        The speedup is modest, and grows with the number of channels. The
+        interpolated coarse solution is only a fair start, so the original
+        channels still take most of the iterations. Measured with L-BFGS-B on
+        synthetic solutions (benchmark.synthetic()) of 128 antennas, plain
+        solve() against solve_multigrid():
+
+            channels   lmbda   plain   multigrid
+                 768       1   0.9 s       0.9 s
+                 768     100   6.2 s       4.6 s
+                 768     1e4   160 s       130 s  (747 and 714 iterations)
+                3072       1   1.0 s       2.8 s
+                3072     100    11 s       7.0 s
+                3072     1e4   194 s        87 s
+
+        At 3072 channels the multigrid cost is also lower, by 8% to 76%,
+        because solve() stops early there (at lmbda 1, before its first
+        iteration).
+        '''
+        # Each spectrum's phase slope is taken out before averaging channels
+        # together, and put back on the original channels, so that spectra
+        # whose phases wrap within a coarse channel do not average away
+        ramp = lambda freqs: np.exp(1j*slopes[:, :, np.newaxis, :]*(freqs - self.freqs[0])[np.newaxis, np.newaxis, :, np.newaxis])
+        slopes = phase_slopes(self.ao, self.freqs)
+        demodulated = np.asarray(self.ao) / ramp(self.freqs)
+
+        self.levels = []
+        ao_hat = None
+        freqs = None
+        for width in multigrid_widths(self.freqs, factor, min_channels) + [None]:
+            start = time.perf_counter()
+            if width is None:
+                stickel = self
+                if ao_hat is not None:
+                    ao_hat = prolong_channels(ao_hat, freqs, self.freqs) * ramp(self.freqs)
+            else:
+                coarse, coarse_freqs = restrict_channels(demodulated, self.freqs, width)
+                stickel = GeneralisedStickel(coarse, self.lmbda, freqs=coarse_freqs, lmbda_t=self.lmbda_t, times=self.workspace.times, dtype=self.dtype)
+                if ao_hat is not None:
+                    ao_hat = prolong_channels(ao_hat, freqs, coarse_freqs)
+            ao_hat = stickel.solve_method(method, ao_hat=ao_hat, maxiter=maxiter, workers=workers)
+            freqs = stickel.freqs
+            self.levels.append({"n_chan": len(freqs), "width": width, "n_iter": stickel.n_iter, "cost": stickel.cost, "seconds": time.perf_counter() - start})
+            logging.info("multigrid level with %d channels: %d iterations, cost = %g", len(freqs), stickel.n_iter, stickel.cost)
+        return ao_hat
+
+    def solve_method(self, method='L-BFGS-B', ao_hat=None, maxiter=1000, workers=None, multigrid=False, spectra=None):
+        '''
+        solve_banded() if method is "banded", otherwise solve(). If multigrid
+        is True and there is no starting model, the solve is done
+        coarse-to-fine (see solve_multigrid()). If spectra is given, only
+        those spectra are solved for (see solve()).
+        '''
+        if multigrid and ao_hat is None:
+            return self.solve_multigrid(method=method, maxiter=maxiter, workers=workers)
+        if method == 'banded':
+            return self.solve_banded(ao_hat=ao_hat, maxiter=maxiter, workers=workers, spectra=spectra)
+        return self.solve(ao_hat=ao_hat, method=method, maxiter=maxiter, spectra=spectra)
+
+    @profiling.timed("GeneralisedStickel.influence_trace")
+    def influence_trace(self, ao_hat, n_probes=4, seed=0):
+        '''
+        An estimate of the trace of the influence (hat) matrix of the fit, i.e.
+        the effective number of (complex) parameters, at the model ao_hat.
+
+        With the rotations held fixed at their values for ao_hat, the model is
+        the linear smoother ao_hat = (W + k D^H D (+ k_t D_t^H D_t))^-1 W ao (see
+        solve_banded()). The trace of its influence matrix is estimated with
+        Hutchinson's method, from n_probes random +/-1 probe vectors, each of
+        which costs one (batched, banded) solve. The numbers of conjugate
+        gradient iterations of these solves (if any) are stored in
+        self.influence_cg_iterations, so that self.cg_iterations still
+        describes the last solve_banded().
+        '''
+        n_chan = ao_hat.shape[2]
+        S = np.zeros(n_chan + 1, dtype=np.complex128)
+        S[1:-1] = np.sum(ao_hat[:, :, 1:, :] * np.conj(ao_hat[:, :, :-1, :]), axis=(0, 1, 3))
+        psi = np.angle(np.sum(ao_hat[1:] * np.conj(ao_hat[:-1]), axis=(1, 2, 3)))
+        weights = np.moveaxis(self.good, 2, -1).astype(float)
+        solve = lambda diag, upper1, upper2, rhs: solve_pentadiagonal_hermitian(weights + diag, upper1, upper2, rhs)
+        self.influence_cg_iterations = []
+
+        rng = np.random.default_rng(seed)
+        trace = 0.0
+        for _ in range(n_probes):
+            probe = rng.choice([-1.0, 1.0], size=weights.shape) * weights
+            response = self.solve_normal(np.angle(S), probe + 0j, weights, solve, psi=psi, cg_iterations=self.influence_cg_iterations)
+            trace += np.sum(probe * response.real)
+        return trace / n_probes
+
+    @profiling.timed("GeneralisedStickel.select_lmbda")
+    def select_lmbda(self, lmbdas, criterion='gcv', method='L-BFGS-B', maxiter=1000, workers=None, multigrid=False):
+        '''
+        Choose lmbda automatically from the values in lmbdas.
+
+        The problem is solved for each of lmbdas in increasing order, each
+        solve starting from the solution at the previous lmbda, so that most
+        of them only need a few iterations (with multigrid, the first solve is
+        done coarse-to-fine). The lmbda chosen is then either
+
+        - 'gcv': the one which minimises the generalised cross-validation score
+
+              GCV = N RSS / (N - tr H)^2
+
+          where N is the number of unflagged data points, RSS = N C_fit and
+          tr H is estimated by influence_trace(), or
+        - 'lcurve': the corner of the L-curve, i.e. the point at which the
+          curve (log C_fit, log C_smooth), parameterised by log lmbda, has its
+          maximum (positive, i.e. L-shaped) curvature.
+
+        On noisy solutions GCV finds about the lmbda which is closest to the
+        truth, while the corner of the L-curve can be orders of magnitude
+        above it. Neither need have an optimum inside the range of lmbdas at
+        all: on the bundled B1934 solutions GCV rises with lmbda over the
+        whole of 1e-2 to 1e9, and the L-curve is bent the other way (as C_fit
+        tends to 0 with lmbda) up to about 1e4. The value at (or, for the
+        curvature, next to) an end of the range would then only be an
+        artefact of where it stops, so a ValueError is raised instead, if GCV
+        is smallest at an end, or if the L-curve has no corner at least two
+        values in from the ends.
+
+        Returns the model at the chosen lmbda (which is left in self.lmbda).
+        The whole curve is stored in self.curve (also if a ValueError is
+        raised), as a list of dictionaries with keys lmbda, C_fit, C_smooth,
+        cost, gcv and curvature, and the criterion in self.criterion.
+        '''
+        if criterion not in ('gcv', 'lcurve'):
+            raise ValueError("criterion must be 'gcv' or 'lcurve'")
+        lmbdas = np.sort(np.asarray(lmbdas, dtype=float))
+        if len(lmbdas) < 3:
+            raise ValueError("at least 3 values of lmbda are needed to choose between them")
+        models = []
+        self.curve = []
+        ao_hat = None
+        for lmbda in lmbdas:
+            self.lmbda = lmbda
+            ao_hat = self.solve_method(method, ao_hat=ao_hat, maxiter=maxiter, workers=workers, multigrid=multigrid)
+            models.append(ao_hat)
+            C_fit = self.fit_cost(ao_hat)
+            dof = self.n_good - self.influence_trace(ao_hat)
+            self.curve.append({"lmbda": lmbda, "C_fit": C_fit, "C_smooth": self.smooth_cost(ao_hat), "cost": self.cost,
+                               "gcv": self.n_good**2 * C_fit / dof**2 if dof > 0 else np.inf})
+            logging.info("lmbda = %g: C_fit = %g, C_smooth = %g, GCV = %g", lmbda, C_fit, self.curve[-1]["C_smooth"], self.curve[-1]["gcv"])
+
+        tiny = np.finfo(float).tiny
+        t = np.log(lmbdas)
+        x = np.log(np.maximum([point["C_fit"] for point in self.curve], tiny))
+        y = np.log(np.maximum([point["C_smooth"] for point in self.curve], tiny))
+        dx, dy = np.gradient(x, t), np.gradient(y, t)
+        ddx, ddy = np.gradient(dx, t), np.gradient(dy, t)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            curvature = np.nan_to_num((dx*ddy - dy*ddx) / (dx**2 + dy**2)**1.5, nan=-np.inf)
+        for point, k in zip(self.curve, curvature):
+            point["curvature"] = k
 
+        self.criterion = criterion
+        widen = "widen the range of lmbda, or choose lmbda yourself"
+        if criterion == 'gcv':
+            best = np.argmin([point["gcv"] for point in self.curve])
+            if best in (0, len(lmbdas) - 1):
+                raise ValueError("GCV is smallest at the %s end of the range of lmbda (%g), so has no minimum inside it; %s" % ("lower" if best == 0 else "upper", lmbdas[best], widen))
+        else:
+            best = 1 + np.argmax(curvature[1:-1])
+            if curvature[best] <= 0 or best in (1, len(lmbdas) - 2):
+                raise ValueError("the L-curve has no corner inside the range of lmbda (%g to %g); %s" % (lmbdas[0], lmbdas[-1], widen))
+        self.lmbda = lmbdas[best]
+        self.cost = self.curve[best]["cost"]
+        logging.info("chose lmbda = %g (%s)", self.lmbda, criterion)
+        return models[best]
 
-def rotate_phases(ao1, theta_rad, chan=None):
+
+class ConstrainedJonesStickel(GeneralisedStickel):
+    '''
+    A GeneralisedStickel for Jones matrices of the constrained form (see the
+    README, "Jones matrices with particular forms")
+
+        G = [[g_XX, g_XX sin(alpha)], [-g_YY sin(alpha), g_YY]]
+
+    with complex gains g_XX, g_YY and a real leakage angle alpha, i.e. 5 free
+    parameters per interval, antenna and channel instead of 8. The cost is
+
+        C = C_fit + lmbda*C_smooth,g + lmbda_alpha*C_smooth,alpha (+ lmbda_t*C_time)
+
+    where C_fit (and C_time) are those of the unconstrained model, evaluated
+    on the Jones matrices formed from the parameters, C_smooth,g is C_smooth
+    of diag(g_XX, g_YY) (normalised, like C_smooth, per Jones matrix element)
+    and C_smooth,alpha is the mean squared (ordinary, unpadded) second order
+    difference of alpha across channels (see alpha_cost()). All gradients are
+    analytic, through the construction of the Jones matrices.
+
+    The parameters are held in one real vector (see split()), which is what
+    value_and_grad() takes. The model is found with solve(), which, like
+    GeneralisedStickel.solve(), returns the (constrained) Jones matrices; the
+    parameters themselves are left in self.gains and self.alpha.
+    '''
+
+    def __init__(self, ao, lmbda, lmbda_alpha=None, freqs=None, lmbda_t=0.0, times=None, dtype=np.complex128):
+        super().__init__(ao, lmbda, freqs=freqs, lmbda_t=lmbda_t, times=times, dtype=dtype)
+        if ao.shape[3] != 4:
+            raise ValueError("the constrained Jones model needs all 4 polarisations")
+        self.lmbda_alpha = lmbda if lmbda_alpha is None else lmbda_alpha
+        n_int, n_ant, n_chan, _ = ao.shape
+        self.n_gains = n_int * n_ant * n_chan * 2
+        self.n_params = self.n_gains * 2 + n_int * n_ant * n_chan
+
+        # C_smooth,g is C_smooth of the diagonal terms on their own (whose
+        # workspace holds no data)
+        self.gain_workspace = ObjectiveWorkspace(np.zeros((n_int, n_ant, n_chan, 2), dtype=self.dtype), freqs=self.freqs, dtype=self.dtype)
+
+        # C_smooth,alpha, across interior channels only
+        self.h_alpha = np.diff(self.freqs)[np.newaxis, np.newaxis, :]
+        self.w_alpha = 2.0 / (self.freqs[2:] - self.freqs[:-2])[np.newaxis, np.newaxis, :]
+        self.n_alpha = n_int * n_ant * max(n_chan - 2, 0)
+
+        # The optimiser sees alpha multiplied by alpha_scale, chosen so that
+        # the smoothness terms give alpha and the gains the same curvature
+        # (per Jones matrix, lmbda_alpha*C_smooth,alpha weighs alpha 4 times
+        # as heavily as lmbda*C_smooth,g weighs each gain, relative to their
+        # second differences). This is what matters when the smoothing is
+        # strong, which is when the solve is slow.
+        self.alpha_scale = 2.0 * np.sqrt(self.lmbda_alpha / self.lmbda)
+
+        # The Jones matrices are formed in working precision, the gradient
+        # with respect to the parameters is double precision
+        self._jones = np.empty(ao.shape, dtype=self.dtype)
+        self._grad = np.empty(self.n_params)
+
+    def split(self, x):
+        '''
+        Views of the parameter vector x as (gains, alpha), where gains (g_XX,
+        g_YY) has shape (n_int, n_ant, n_chan, 2) and alpha (n_int, n_ant,
+        n_chan). The same layout is used for gradients, with the convention
+        of GeneralisedStickel for the gains.
+        '''
+        gains = x[:2*self.n_gains].view(np.complex128).reshape(self.ao.shape[:3] + (2,))
+        alpha = x[2*self.n_gains:].reshape(self.ao.shape[:3])
+        return gains, alpha
+
+    def join(self, gains, alpha):
+        '''
+        The parameter vector of gains and alpha (see split())
+        '''
+        x = np.empty(self.n_params)
+        x_gains, x_alpha = self.split(x)
+        x_gains[:] = gains
+        x_alpha[:] = alpha
+        return x
+
+    def jones(self, gains, alpha, out=None):
+        '''
+        The Jones matrices (XX, XY, YX, YY) formed from gains and alpha
+        '''
+        if out is None:
+            out = np.empty(self.ao.shape, dtype=np.complex128)
+        sin_alpha = np.sin(alpha)
+        out[..., 0] = gains[..., 0]
+        np.multiply(gains[..., 0], sin_alpha, out=out[..., 1])
+        np.multiply(gains[..., 1], -sin_alpha, out=out[..., 2])
+        out[..., 3] = gains[..., 1]
+        return out
+
+    def parameters(self, ao_hat):
+        '''
+        The (gains, alpha) whose Jones matrices are closest to ao_hat: the
+        diagonal terms, and the least squares sin(alpha) of the off-diagonal
+        terms given them. Flagged (NaN) values are taken to be 0.
+        '''
+        ao_hat = np.nan_to_num(np.asarray(ao_hat))
+        gains = ao_hat[..., [0, 3]].copy()
+        power = np.sum(np.abs(gains)**2, axis=-1)
+        leakage = np.real(np.conj(ao_hat[..., 0])*ao_hat[..., 1] - np.conj(ao_hat[..., 3])*ao_hat[..., 2])
+        sin_alpha = np.divide(leakage, power, out=np.zeros_like(power), where=power > 0)
+        return gains, np.arcsin(np.clip(sin_alpha, -1.0, 1.0))
+
+    def alpha_cost(self, alpha, grad=None):
+        '''
+        C_smooth,alpha, the mean squared second order difference of alpha
+        across channels. If grad is given, lmbda_alpha times the gradient is
+        added to it.
+        '''
+        if self.n_alpha == 0:
+            return 0.0
+        diff1 = np.diff(alpha, axis=2) / self.h_alpha
+        diff2 = np.diff(diff1, axis=2) * self.w_alpha
+        C_alpha = np.vdot(diff2, diff2) / self.n_alpha
+
+        if grad is not None:
+            diff2 *= self.w_alpha * (2.0*self.lmbda_alpha/self.n_alpha)
+            u = np.zeros_like(diff1)
+            u[:, :, 1:] += diff2
+            u[:, :, :-1] -= diff2
+            u /= self.h_alpha
+            grad[:, :, 1:] += u
+            grad[:, :, :-1] -= u
+
+        return C_alpha
+
+    @profiling.timed("ConstrainedJonesStickel.value_and_grad")
+    def value_and_grad(self, x):
+        '''
+        Returns (C, grad) for the parameter vector x. grad (laid out like x)
+        is overwritten by the next evaluation.
+        '''
+        gains, alpha = self.split(x)
+        jones = self.jones(gains, alpha, out=self._jones)
+
+        # Gradient with respect to the Jones matrices, then (since each
+        # element is a gain times a real function of alpha) the parameters
+        grad_jones = self.workspace.grad
+        grad_jones.fill(0.0)
+        C = self.workspace.fit_cost(jones, grad_jones)
+        if self.lmbda_t > 0:
+            C += self.lmbda_t*self.workspace.time_cost(jones, grad_jones, lmbda_t=self.lmbda_t)
+
+        grad_gains, grad_alpha = self.split(self._grad)
+        sin_alpha = np.sin(alpha)
+        grad_gains[..., 0] = grad_jones[..., 0] + sin_alpha*grad_jones[..., 1]
+        grad_gains[..., 1] = grad_jones[..., 3] - sin_alpha*grad_jones[..., 2]
+        grad_alpha[:] = np.cos(alpha) * np.real(np.conj(grad_jones[..., 1])*gains[..., 0] - np.conj(grad_jones[..., 2])*gains[..., 1])
+
+        # C_smooth over 2 of the 4 Jones matrix elements
+        C += 0.5*self.lmbda*self.gain_workspace.smooth_cost(gains, grad_gains, lmbda=0.5*self.lmbda)
+        C += self.lmbda_alpha*self.alpha_cost(alpha, grad_alpha)
+        self.n_eval += 1
+        return C, self._grad
+
+    def _fun(self, x):
+        x = x.copy()
+        self.split(x)[1][:] /= self.alpha_scale
+        C, grad = self.value_and_grad(x)
+        if profiling.enabled:
+            self._last_evaluation = (C, np.linalg.norm(grad))
+        grad = grad*self.scale
+        self.split(grad)[1][:] /= self.alpha_scale
+        return C*self.scale, grad
+
+    def _fun_subset(self, x, x_all, subset):
+        # x_all is updated in place
+        x_all[subset] = x
+        C, grad = self._fun(x_all)
+        return C, grad[subset]
+
+    def parameter_mask(self, antennas):
+        '''
+        A boolean mask of the parameter vector (see split()), which is True for
+        all the parameters of the Jones matrices of antennas (a boolean array
+        of shape (n_int, n_ant))
+        '''
+        n_int, n_ant, n_chan, _ = self.ao.shape
+        antennas = np.asarray(antennas, dtype=bool)
+        gains = np.broadcast_to(antennas[:, :, np.newaxis, np.newaxis], (n_int, n_ant, n_chan, 4))  # real and imaginary parts of g_XX, g_YY
+        alpha = np.broadcast_to(antennas[:, :, np.newaxis], (n_int, n_ant, n_chan))
+        return np.concatenate((gains.ravel(), alpha.ravel()))
+
+    @profiling.timed("ConstrainedJonesStickel.solve")
+    def solve(self, ao_hat=None, method='L-BFGS-B', maxiter=1000, tol=None, spectra=None):
+        '''
+        Minimise the cost function over the parameters, starting from those
+        closest to the Jones matrices ao_hat (by default, the data with flags
+        set to zero; see parameters()). method is passed to
+        scipy.optimize.minimize(), as for GeneralisedStickel.solve().
+
+        If spectra (a boolean array of shape (n_int, n_ant, n_pol)) is given,
+        only the parameters of the Jones matrices containing any of those
+        spectra (i.e. all 4 polarisations of each antenna and interval that
+        has any) are solved for, and the rest are held at those of ao_hat.
+
+        Returns the Jones matrices of the model as an AOCal.
+        '''
+        if ao_hat is None:
+            ao_hat = self.initial_model()
+        gains, alpha = self.parameters(ao_hat)
+        x0 = self.join(gains, alpha*self.alpha_scale)
+
+        self.n_eval = 0
+        if spectra is None:
+            self.result = self._minimize(self._fun, x0, method, tol, maxiter)
+            x = self.result.x
+        else:
+            subset = self.parameter_mask(np.any(spectra, axis=2))
+            self.result = self._minimize(self._fun_subset, x0[subset], method, tol, maxiter, args=(x0.copy(), subset))
+            x = x0.copy()
+            x[subset] = self.result.x
+        logging.info("%s (constrained Jones): %s (%d iterations, %d evaluations)", method, self.result.message, self.result.nit, self.n_eval)
+
+        self.cost = self.result.fun / self.scale
+        self.n_iter = self.result.nit
+        gains, alpha = self.split(x)
+        self.gains = gains.copy()
+        self.alpha = alpha / self.alpha_scale
+        return aocal.AOCal(self.jones(self.gains, self.alpha), getattr(self.ao, 'time_start', 0.0), getattr(self.ao, 'time_end', 0.0))
+
+    def solve_method(self, method='L-BFGS-B', ao_hat=None, maxiter=1000, workers=None, multigrid=False, spectra=None):
+        '''
+        solve(). The banded and multigrid solvers need the unconstrained
+        (linear) model, so are not available. If spectra is given, the whole
+        Jones matrices containing them are solved for (see solve()).
+        '''
+        if method == 'banded' or multigrid:
+            raise ValueError("the constrained Jones model can only be solved with a scipy.optimize.minimize() method")
+        return self.solve(ao_hat=ao_hat, method=method, maxiter=maxiter, spectra=spectra)
+
+
+def rotate_phases(ao1, theta_rad, chan=None, axis=2):
+    '''
+    Multiply ao1 (in place) by exp(i*theta_rad), either for all channels, for
+    one channel, or, if theta_rad is an array, channel by channel (or, with
+    axis=0, interval by interval)
+    '''
 
     if np.isscalar(theta_rad) and chan is not None:
         ao1[:,:,chan,:] *= np.exp(1j*theta_rad)
@@ -21,11 +1339,14 @@ def rotate_phases(ao1, theta_rad, chan=None):
 
     if not np.isscalar(theta_rad):
         # Attempt broadcasting
-        ao1 *= np.exp(1j*theta_rad[np.newaxis, np.newaxis, :, np.newaxis])
+        shape = [1]*ao1.ndim
+        shape[axis] = -1
+        ao1 *= np.exp(1j*np.reshape(theta_rad, shape))
         return ao1
 
+@profiling.timed("do_smoothing.optimal_rotation")
 def optimal_rotation(ao1, ao2, axis=None):
-    mean = np.nanmean(ao1 * np.conj(ao2), axis=axis)
+    mean = np.nanmean(ao1 * np.conj(ao2), axis=axis, dtype=np.complex128)
     return np.angle(mean)
 
 def ao_min_diff(ao1, ao2, axis=None):
@@ -40,10 +1361,11 @@ def ao_min_diff(ao1, ao2, axis=None):
     optimum theta value.
     '''
     theta_min = optimal_rotation(ao1, ao2, axis=axis)
-    diff = ao1 - rotate_phases(ao2, theta_min)
+    diff = ao1 - rotate_phases(ao2.copy(), theta_min)
 
     return diff
 
+@profiling.timed("do_smoothing.ao_min_diff2_freq")
 def ao_min_diff2_freq(ao1, freqs=None):
     '''
     Returns the second order central finite difference over the frequency axis
@@ -53,13 +1375,11 @@ def ao_min_diff2_freq(ao1, freqs=None):
         freqs = np.arange(ao1.n_chan)
 
     # Pad the frequency axis by zeros on either side
-    zero_slice = np.full((ao1.n_int, ao1.n_ant, 1, ao1.n_pol), 0.0 + 0.0j)
+    zero_slice = np.zeros((ao1.n_int, ao1.n_ant, 1, ao1.n_pol), dtype=ao1.dtype)
     padded_ao1 = np.concatenate((zero_slice, ao1, zero_slice), axis=2)
 
     # Do something similar with the frequencies
-    df_start = freqs[1] - freqs[0]
-    df_end = freqs[-1] - freqs[-2]
-    padded_freqs = np.concatenate(([freqs[0] - df_start], freqs, [freqs[-1] + df_end]))
+    padded_freqs = pad_freqs(freqs)
 
     # First order differences
     dfreq_12 = padded_freqs[np.newaxis, np.newaxis, 1:-1, np.newaxis] - padded_freqs[np.newaxis, np.newaxis, :-2, np.newaxis]  # f_n - f_{n-1}
@@ -74,7 +1394,95 @@ def ao_min_diff2_freq(ao1, freqs=None):
     return diff2_123
 
 
+def channel_alignment(ao1):
+    '''
+    Returns the cumulative phases psi (one per channel) which line up adjacent
+    channels, i.e. such that the sum over intervals, antennas and pols of
+    each channel of ao1*exp(-i psi) times the conjugate of the previous channel
+    is real. This is the phase between channels that the fit term of
+    objective() leaves free. NaNs are ignored.
+    '''
+    x = np.nan_to_num(np.asarray(ao1))
+    S = np.sum(x[:, :, 1:, :] * np.conj(x[:, :, :-1, :]), axis=(0, 1, 3))
+    return np.concatenate(([0.0], np.cumsum(np.angle(S))))
+
+
+def phase_slopes(ao1, freqs):
+    '''
+    Returns the phase slope (radians per unit of freqs) of each spectrum
+    (interval, antenna, pol), from the phase of the sum of the products of
+    adjacent channels at the most common channel spacing. NaNs are ignored.
+    '''
+    x = np.nan_to_num(np.asarray(ao1))
+    h = np.diff(freqs)
+    if len(h) == 0:
+        return np.zeros(x.shape[:2] + x.shape[3:])
+    step = np.median(h)
+    pairs = np.flatnonzero(np.isclose(h, step))
+    S = np.sum(x[:, :, pairs + 1, :] * np.conj(x[:, :, pairs, :]), axis=2)
+    return np.angle(S) / step
+
+
+def multigrid_widths(freqs, factor=2, min_channels=16):
+    '''
+    Bin widths (in the units of freqs, coarsest first) of the coarse levels
+    of a multigrid solve: successive factors of the median channel spacing,
+    down to the coarsest level that still has about min_channels channels
+    '''
+    freqs = np.asarray(freqs, dtype=float)
+    span = freqs[-1] - freqs[0]
+    width = factor * np.median(np.diff(freqs)) if len(freqs) > 1 else np.inf
+    widths = []
+    while span / width >= min_channels:
+        widths.append(width)
+        width *= factor
+    return widths[::-1]
+
+
+def restrict_channels(ao, freqs, width):
+    '''
+    Average ao onto a coarse grid of channels, by lining up adjacent channels
+    (channel_alignment()) and then taking the mean of the unflagged values in
+    bins of the given width in freqs (which must be increasing).
+
+    Returns the coarse solutions, which are NaN where a bin contains no
+    unflagged values, and the mean frequency of each bin. Bins that contain
+    no channels, or only flagged values, are left out.
+    '''
+    ao = np.asarray(ao)
+    freqs = np.asarray(freqs, dtype=float)
+    bins = np.floor((freqs - freqs[0]) / width).astype(int)
+    starts = np.flatnonzero(np.diff(bins, prepend=-1))
+
+    good = ~np.isnan(ao)
+    aligned = np.where(good, ao, 0.0) * np.exp(-1j*channel_alignment(ao))[np.newaxis, np.newaxis, :, np.newaxis]
+    counts = np.add.reduceat(good, starts, axis=2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        coarse = np.add.reduceat(aligned, starts, axis=2) / counts
+    coarse_freqs = np.add.reduceat(freqs, starts) / np.diff(np.append(starts, len(freqs)))
+
+    chans = good_channels(coarse)
+    return coarse[:, :, chans, :], coarse_freqs[chans]
+
+
+def prolong_channels(model, coarse_freqs, freqs):
+    '''
+    Interpolate a model on coarse_freqs (lined up with channel_alignment())
+    linearly onto freqs. Beyond the ends of coarse_freqs, the end values are
+    used.
+    '''
+    model = np.asarray(model)
+    if len(coarse_freqs) == 1:
+        return np.repeat(model, len(freqs), axis=2)
+    aligned = model * np.exp(-1j*channel_alignment(model))[np.newaxis, np.newaxis, :, np.newaxis]
+    upper = np.clip(np.searchsorted(coarse_freqs, freqs), 1, len(coarse_freqs) - 1)
+    lower = upper - 1
+    t = np.clip((freqs - coarse_freqs[lower]) / (coarse_freqs[upper] - coarse_freqs[lower]), 0.0, 1.0)[np.newaxis, np.newaxis, :, np.newaxis]
+    return (1 - t)*aligned[:, :, lower, :] + t*aligned[:, :, upper, :]
+
+
 def test_optimal_rotation(ao):
+    import aocal_plot
 
     # Plot the original
     aocal_plot.plot(ao, plot_filename="orig", n_rows=6, ants_per_line=6)
@@ -85,42 +1493,39 @@ def test_optimal_rotation(ao):
     rotate_phases(ao, theta)
     aocal_plot.plot(ao, plot_filename="rand", n_rows=6, ants_per_line=6)
 
-    # Optimise across frequency
-    # Remove nan frequencies
-    delete_chans = np.isnan(np.angle(np.nanmean(ao, axis=(0,1,3))))
-    chans = np.arange(ao.n_chan)
-
-    ao = np.delete(ao, delete_chans, axis=2)
-    chans = np.delete(chans, delete_chans)
-
-    delta_theta_mins = np.array([0.0] + [-optimal_rotation(ao[:,:,i,:], ao[:,:,i-1,:]) for i in range(1, ao.shape[2])])
-    theta_mins = np.cumsum(delta_theta_mins)
+    # Optimise across frequency (the optimal rotations between adjacent
+    # channels, accumulated; nan channels are skipped over), in place
+    aocal.align_phases(ao, intervals=False)
+    aocal_plot.plot(ao, plot_filename="test", n_rows=6, ants_per_line=6)
 
-    # Rotate using the found optimal thetas
-    ao = rotate_phases(ao, theta_mins)
-    aocal_plot.plot(ao, plot_filename="test", n_rows=6, ants_per_line=6, chan_idxs=chans)
 
-
-def objective(ao, ao_hat, lmbda, freqs):
+@profiling.timed("do_smoothing.objective")
+def objective(ao, ao_hat, lmbda, freqs, workspace=None):
     '''
     ao is the original data set
     ao_hat is the model
     lmbda is the regularisation parameter
+    workspace, if given, is an ObjectiveWorkspace for ao and freqs, which is
+    used to evaluate the cost without allocating any full-size arrays
 
     IMPORTANT: It is assumed that any channels which contain only nans have
     already been removed
     '''
+    if workspace is not None:
+        C_fit, C_smooth, _ = workspace.evaluate(np.asarray(ao_hat), lmbda, gradient=False)
+        return C_fit + lmbda*C_smooth
+
     # Calculate the residuals
     R = ao_min_diff(ao, ao_hat, axis=(0, 1, 3)) # "axis" controls how theta_min is calculated
 
     # The "goodness-of-fit" cost function:
-    C_fit = np.nanmean(np.abs(R)**2)  # Is actually (the square of) the Frobenius norm
+    C_fit = np.nanmean(np.abs(R)**2, dtype=np.float64)  # Is actually (the square of) the Frobenius norm
 
     # The second derivative
     Diff2 = ao_min_diff2_freq(ao_hat, freqs=freqs)
 
     # The smoothness cost function
-    C_smooth = np.nanmean(np.abs(Diff2)**2)
+    C_smooth = np.nanmean(np.abs(Diff2)**2, dtype=np.float64)
 
     # The final, regularised cost function
     return C_fit + lmbda*C_smooth
@@ -135,20 +1540,439 @@ def test_objective(ao, lmbda):
     return objective(ao, ao_hat, lmbda, freqs)
 
 
+# The second order differences of the smoothness term need at least this many
+# (unflagged) channels
+MIN_CHANNELS = 3
+
+
+def good_channels(ao):
+    '''
+    Returns the indices of channels that contain at least one non-nan value
+    '''
+    return np.flatnonzero(~np.all(np.isnan(ao), axis=(0, 1, 3)))
+
+
+def check_channels(chans):
+    '''
+    Raise a ValueError if there are too few channels (chans, from
+    good_channels()) to smooth
+    '''
+    if len(chans) < MIN_CHANNELS:
+        raise ValueError("at least %d channels with data are needed for smoothing, but there are %d" % (MIN_CHANNELS, len(chans)))
+
+
+def expand_channels(ao, model, chans, interpolate_intervals=False):
+    '''
+    Place a model solved on the channels "chans" back into an AOCal with the
+    same shape as ao. Channels that were removed, and spectra (interval,
+    antenna, pol) that contain no data at all, are set to nan. With
+    interpolate_intervals (for models smoothed across intervals), a spectrum
+    is only set to nan if it contains no data in any interval.
+    '''
+    out = aocal.AOCal(np.full(ao.shape, np.nan, dtype=np.complex128), ao.time_start, ao.time_end)
+    out[:, :, chans, :] = model
+    empty = np.all(np.isnan(ao), axis=2)
+    if interpolate_intervals:
+        empty = np.broadcast_to(np.all(empty, axis=0), empty.shape)
+    out[empty[:, :, np.newaxis, :].repeat(ao.n_chan, axis=2)] = np.nan
+    return out
+
+
+def default_outfile(solution_file, suffix="_smoothed", outdir=None):
+    '''
+    SOLUTION_FILE with suffix appended to its base name (optionally moved to
+    outdir)
+    '''
+    base, ext = os.path.splitext(solution_file)
+    if outdir is not None:
+        base = os.path.join(outdir, os.path.basename(base))
+    return base + suffix + ext
+
+
+@profiling.timed("do_smoothing.smooth")
+def smooth(ao, lmbda, method='L-BFGS-B', maxiter=1000, workers=None, lmbdas=None, criterion='gcv', multigrid=False, lmbda_t=0.0, times=None, jones='full', lmbda_alpha=None, dtype=np.complex128):
+    '''
+    Smooth the solutions in ao. Channels containing only nans are removed
+    before solving (and are nan in the output), and the channel indices of the
+    remaining channels are used as their frequencies.
+
+    method is either "banded" (see GeneralisedStickel.solve_banded()) or a
+    scipy.optimize.minimize() method (see GeneralisedStickel.solve()). The
+    banded solves can be spread over a pool of worker processes.
+
+    If lmbda is "auto", it is chosen from the values in lmbdas by
+    GeneralisedStickel.select_lmbda(), using the given criterion.
+
+    If multigrid is True, the problem is solved coarse-to-fine (see
+    GeneralisedStickel.solve_multigrid()).
+
+    If lmbda_t > 0, the intervals (at times, by default their indices) are
+    also smoothed across, jointly, and intervals in which a spectrum is
+    flagged are filled in from the others.
+
+    If jones is "constrained", the model is the 5-parameter Jones matrix of
+    ConstrainedJonesStickel, with lmbda_alpha (by default, lmbda) for the
+    leakage angle. It can only be solved with a scipy method, for a fixed
+    lmbda.
+
+    dtype is the working precision of the cost function evaluations
+    (complex128, or complex64, which is faster; see ObjectiveWorkspace). The
+    smoothed AOCal is always complex128.
+
+    Raises a ValueError if fewer than MIN_CHANNELS channels contain any data.
+
+    Returns the smoothed AOCal, and the GeneralisedStickel used to solve it.
+    '''
+    chans = good_channels(ao)
+    check_channels(chans)
+    if jones == 'constrained':
+        if lmbda == 'auto':
+            raise ValueError("lmbda cannot be chosen automatically for the constrained Jones model")
+        stickel = ConstrainedJonesStickel(ao[:, :, chans, :], lmbda, lmbda_alpha=lmbda_alpha, freqs=chans, lmbda_t=lmbda_t, times=times, dtype=dtype)
+        model = stickel.solve_method(method, maxiter=maxiter, workers=workers, multigrid=multigrid)
+    elif jones != 'full':
+        raise ValueError("jones must be 'full' or 'constrained'")
+    elif lmbda == 'auto':
+        stickel = GeneralisedStickel(ao[:, :, chans, :], lmbdas[0], freqs=chans, lmbda_t=lmbda_t, times=times, dtype=dtype)
+        model = stickel.select_lmbda(lmbdas, criterion=criterion, method=method, maxiter=maxiter, workers=workers, multigrid=multigrid)
+    else:
+        stickel = GeneralisedStickel(ao[:, :, chans, :], lmbda, freqs=chans, lmbda_t=lmbda_t, times=times, dtype=dtype)
+        model = stickel.solve_method(method, maxiter=maxiter, workers=workers, multigrid=multigrid)
+    return expand_channels(ao, model, chans, interpolate_intervals=lmbda_t > 0), stickel
+
+
+def clip_outliers(ao, sigma=5.0, pols=(0, 3), iterations=5):
+    '''
+    Flag (set to NaN) all polarisations of each channel in which any of pols
+    is an outlier from its fit_complex_gains model (aocal.AOCal.fit with
+    mode="clip"), e.g. RFI-hit channels, before smoothing.
+
+    Returns the flagged AOCal and the number of channels flagged on each
+    antenna.
+    '''
+    clipped = ao.fit(pols=pols, mode='clip', clip_sigma=sigma, clip_iterations=iterations, inplace=False)
+    clipped[np.isnan(np.asarray(clipped)[..., list(pols)]).any(axis=3)] = np.nan
+    return clipped, aocal.count_flagged(ao, clipped)
+
+
+def smooth_file(in_filename, out_filename, lmbda, method='L-BFGS-B', maxiter=1000, workers=None, lmbdas=None, criterion='gcv', multigrid=False, jones='full', lmbda_alpha=None, dtype=np.complex128, clip_sigma=None):
+    '''
+    Smooth a solution file one calibration interval at a time, writing each
+    interval to out_filename as soon as it is done, so that memory use is
+    bounded by the size of one interval rather than the whole file.
+
+    Each interval is smoothed as an independent problem (i.e. the optimal
+    rotations are not shared between intervals). If clip_sigma is given,
+    outliers are first flagged with clip_outliers(). Intervals with fewer
+    than MIN_CHANNELS channels that contain any data are written unsmoothed.
+
+    Yields (interval, GeneralisedStickel) as each interval is finished.
+    '''
+    header = aocal.file_header(in_filename)
+    with aocal.AOCalWriter(out_filename, *aocal.header_shape(header), time_start=header.timeStart, time_end=header.timeEnd) as writer:
+        for interval, _, ao in aocal.iter_blocks(in_filename):
+            if clip_sigma is not None:
+                ao, clipped = clip_outliers(ao, clip_sigma)
+                logging.info("interval %d: %d channels clipped", interval, clipped.sum())
+            n_chans = len(good_channels(ao))
+            if n_chans < MIN_CHANNELS:
+                if n_chans > 0:
+                    logging.warning("interval %d: only %d channels with data, so written unsmoothed", interval, n_chans)
+                writer.write(ao, interval)
+                continue
+            smoothed, stickel = smooth(ao, lmbda, method=method, maxiter=maxiter, workers=workers, lmbdas=lmbdas, criterion=criterion, multigrid=multigrid, jones=jones, lmbda_alpha=lmbda_alpha, dtype=dtype)
+            writer.write(smoothed, interval)
+            yield interval, stickel
+
+
+def changed_spectra(ao, previous):
+    '''
+    Returns a boolean array of shape (n_int, n_ant, n_pol), which is True for
+    each spectrum in which ao and previous differ in any value or flag (NaN)
+    '''
+    ao = np.asarray(ao)
+    previous = np.asarray(previous)
+    same = (ao == previous) | (np.isnan(ao) & np.isnan(previous))
+    return ~np.all(same, axis=2)
+
+
+class SolutionCache:
+    '''
+    A directory of earlier smoothing results, each stored as its input and
+    output solutions (as ordinary solution files, which are much quicker to
+    write than compressed ones) and a small JSON file of the settings
+    (lmbda, method, ...) it was smoothed with. Entries are keyed by a hash of
+    the input solutions and the settings.
+
+    lookup() finds the result for exactly the same input and settings, and
+    nearest() the result (with the same settings) whose input differs from
+    the given one in the fewest spectra, e.g. the run before some flags were
+    changed, from which smooth_incremental() can carry on.
+    '''
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        os.makedirs(dirname, exist_ok=True)
+
+    @staticmethod
+    def key(ao, settings):
+        '''
+        A hash of the solutions in ao (with all NaNs counting as the same
+        flag), their time range, and settings (a dictionary)
+        '''
+        h = hashlib.sha1()
+        h.update(json.dumps(settings, sort_keys=True).encode())
+        h.update(json.dumps([ao.shape, ao.time_start, ao.time_end]).encode())
+        values = np.ascontiguousarray(np.asarray(ao), dtype=np.complex128)
+        h.update(np.where(np.isnan(values), np.nan, values).tobytes())
+        return h.hexdigest()
+
+    def _filename(self, key, suffix):
+        return os.path.join(self.dirname, key + suffix)
+
+    def lookup(self, key):
+        '''
+        The output solutions stored under key, or None
+        '''
+        filename = self._filename(key, ".out.bin")
+        if not os.path.exists(filename):
+            return None
+        return aocal.fromfile(filename)
+
+    def nearest(self, ao, settings):
+        '''
+        Returns (key, input, changed) for the entry with the same shape and
+        settings as ao whose input differs from it in the fewest spectra
+        (changed is the changed_spectra() of the two), or None if there is no
+        such entry
+        '''
+        best = None
+        for filename in sorted(os.listdir(self.dirname)):
+            if not filename.endswith(".json"):
+                continue
+            key = filename[:-len(".json")]
+            try:
+                with open(os.path.join(self.dirname, filename)) as f:
+                    meta = json.load(f)
+                if meta["settings"] != settings or tuple(meta["shape"]) != ao.shape:
+                    continue
+                previous = aocal.fromfile(self._filename(key, ".in.bin"))
+            except (OSError, ValueError, KeyError) as e:
+                logging.debug("skipping cache entry %s: %s", key, e)
+                continue
+            changed = changed_spectra(ao, previous)
+            if best is None or np.count_nonzero(changed) < np.count_nonzero(best[2]):
+                best = (key, previous, changed)
+        return best
+
+    def store(self, key, ao, smoothed, settings):
+        '''
+        Store the input and output solutions of a run under key
+        '''
+        ao.tofile(self._filename(key, ".in.bin"))
+        smoothed.tofile(self._filename(key, ".out.bin"))
+        # The JSON file is written last, so that only complete entries are found
+        with open(self._filename(key, ".json"), "w") as f:
+            json.dump({"settings": settings, "shape": list(ao.shape)}, f)
+
+
+@profiling.timed("do_smoothing.smooth_incremental")
+def smooth_incremental(ao, lmbda, cache, method='L-BFGS-B', maxiter=1000, workers=None, multigrid=False, lmbda_t=0.0, times=None, jones='full', lmbda_alpha=None, dtype=np.complex128):
+    '''
+    smooth() (for a fixed lmbda), reusing earlier results from cache (a
+    SolutionCache).
+
+    If the same input has been smoothed with the same settings before, that
+    result is returned. Otherwise, if the cache holds a result for an input
+    that differs only in some spectra (e.g. after a tile or some channels
+    have been flagged), only the changed spectra (with the constrained Jones
+    model, the Jones matrices containing them) are solved for, starting
+    from that result: the others are held fixed, while the per-channel
+    rotations are those of the whole model. If the set of channels that
+    contain any data has changed, all spectra are solved for, but still
+    starting from the earlier result. The new result is stored in the cache.
+
+    Returns the smoothed AOCal, the GeneralisedStickel used to solve it
+    (None if it came straight from the cache), and a dictionary describing
+    what was done, with keys key, status ("cached", "incremental" or
+    "full"), n_spectra and n_solved.
+    '''
+    check_channels(good_channels(ao))
+    settings = {"lmbda": lmbda, "method": method, "maxiter": maxiter, "multigrid": multigrid, "lmbda_t": lmbda_t, "jones": jones, "lmbda_alpha": lmbda_alpha,
+                "dtype": np.dtype(dtype).name,
+                "times": None if times is None else [float(t) for t in times]}
+    key = cache.key(ao, settings)
+    n_spectra = ao.n_int * ao.n_ant * ao.n_pol
+    smoothed = cache.lookup(key)
+    if smoothed is not None:
+        logging.info("found %s in cache", key)
+        return smoothed, None, {"key": key, "status": "cached", "n_spectra": n_spectra, "n_solved": 0}
+
+    nearest = cache.nearest(ao, settings)
+    if nearest is None:
+        smoothed, stickel = smooth(ao, lmbda, method=method, maxiter=maxiter, workers=workers, multigrid=multigrid, lmbda_t=lmbda_t, times=times, jones=jones, lmbda_alpha=lmbda_alpha, dtype=dtype)
+        info = {"key": key, "status": "full", "n_spectra": n_spectra, "n_solved": n_spectra}
+    else:
+        previous_key, previous, spectra = nearest
+        logging.info("starting from %s in cache, in which %d of %d spectra differ", previous_key, np.count_nonzero(spectra), n_spectra)
+        chans = good_channels(ao)
+        if jones == 'constrained':
+            stickel = ConstrainedJonesStickel(ao[:, :, chans, :], lmbda, lmbda_alpha=lmbda_alpha, freqs=chans, lmbda_t=lmbda_t, times=times, dtype=dtype)
+        else:
+            stickel = GeneralisedStickel(ao[:, :, chans, :], lmbda, freqs=chans, lmbda_t=lmbda_t, times=times, dtype=dtype)
+
+        # The earlier model, with the data where it has none (e.g. spectra that
+        # have been unflagged), which are then also solved for
+        ao_hat = np.asarray(cache.lookup(previous_key))[:, :, chans, :]
+        missing = np.isnan(ao_hat)
+        ao_hat = np.where(missing, stickel.initial_model(), ao_hat)
+        spectra = spectra | np.any(missing, axis=2)
+        if jones == 'full' and not lmbda_t > 0:
+            # Spectra with no data at all (which are nan in the output) are
+            # best modelled as zero, and need not be solved for
+            empty = np.all(~stickel.good, axis=2)
+            ao_hat[empty[:, :, np.newaxis, :].repeat(len(chans), axis=2)] = 0.0
+            spectra &= ~empty
+        if jones == 'constrained':
+            # Each Jones matrix is solved for as a whole (see
+            # ConstrainedJonesStickel.solve())
+            spectra[:] = np.any(spectra, axis=2, keepdims=True)
+        if not np.array_equal(chans, good_channels(previous)):
+            # The channels (frequencies) of every spectrum have changed
+            spectra[:] = True
+
+        status = "full" if np.all(spectra) else "incremental"
+        model = stickel.solve_method(method, ao_hat=ao_hat, maxiter=maxiter, workers=workers, spectra=None if status == "full" else spectra)
+        smoothed = expand_channels(ao, model, chans, interpolate_intervals=lmbda_t > 0)
+        info = {"key": key, "status": status, "n_spectra": n_spectra, "n_solved": int(np.count_nonzero(spectra))}
+
+    cache.store(key, ao, smoothed, settings)
+    return smoothed, stickel, info
+
+
+def lmbda_arg(value):
+    '''
+    argparse type for --lmbda: a number, or "auto"
+    '''
+    if value == 'auto':
+        return value
+    return float(value)
+
+
+def report_lmbda_curve(stickel, label=""):
+    '''
+    Print the curve found by GeneralisedStickel.select_lmbda(), and return it
+    in a form that can be written out as JSON
+    '''
+    print("%s%12s %12s %12s %12s %12s" % (label, "lmbda", "C_fit", "C_smooth", "GCV", "curvature"))
+    for point in stickel.curve:
+        print("%s%12.4g %12.4g %12.4g %12.4g %12.4g%s" % (label, point["lmbda"], point["C_fit"], point["C_smooth"], point["gcv"], point["curvature"], " <--" if point["lmbda"] == stickel.lmbda else ""))
+    print("%sChosen lmbda = %g (%s)" % (label, stickel.lmbda, stickel.criterion))
+    to_json = lambda v: float(v) if np.isfinite(v) else None
+    return {"lmbda": float(stickel.lmbda), "criterion": stickel.criterion, "curve": [{k: to_json(v) for k, v in point.items()} for point in stickel.curve]}
+
+
+def report_levels(stickel, label=""):
+    '''
+    Print the per-level summary of GeneralisedStickel.solve_multigrid()
+    '''
+    print("%s%10s %10s %10s %12s %10s" % (label, "channels", "width", "iterations", "cost", "seconds"))
+    for level in stickel.levels:
+        width = "-" if level["width"] is None else "%g" % level["width"]
+        print("%s%10d %10s %10d %12.4g %10.2f" % (label, level["n_chan"], width, level["n_iter"], level["cost"], level["seconds"]))
+
+
+def write_profile(filename):
+    '''
+    Write the profile of this run (see profiling.report()), if profiling
+    '''
+    if filename is None:
+        return
+    profiling.write(filename, argv=sys.argv)
+    print("Profile written to %s" % filename)
+
+
 def main():
     # Argument parser
     parser = argparse.ArgumentParser(description='Apply smoothing by regularisation to calibration solutions')
 
     parser.add_argument('solution_file', help='A calibration solution file in the "AOCal" format')
-    parser.add_argument('--lmbda', type=float, default=1.0, help='The regularisation parameter. Small numbers make models that match the data, large numbers make smooth models. Finding the right balance is a case-by-case black art. [default = 1.0]')
+    parser.add_argument('--lmbda', type=lmbda_arg, default=1.0, help='The regularisation parameter. Small numbers make models that match the data, large numbers make smooth models. Finding the right balance is a case-by-case black art, so "auto" chooses it by generalised cross-validation or from the L-curve (see --lmbda_criterion). The curve is written to OUTFILE (without extension) + "_lmbda.json". [default = 1.0]')
+    parser.add_argument('--lmbda_criterion', choices=('gcv', 'lcurve'), default='gcv', help='How --lmbda auto chooses lmbda: the minimum generalised cross-validation score, or the corner of the L-curve. It is an error if there is no minimum (or corner) inside --lmbda_range [default = gcv]')
+    parser.add_argument('--lmbda_range', type=float, nargs=2, default=[1e-2, 1e6], metavar=('MIN', 'MAX'), help='The range of lmbda searched by --lmbda auto [default = 1e-2 1e6]')
+    parser.add_argument('--lmbda_steps', type=int, default=17, help='The number of (log-spaced) values of lmbda tried by --lmbda auto [default = 17]')
+    parser.add_argument('--outfile', help='The file to write the smoothed solutions to [default = SOLUTION_FILE with "_smoothed" appended to its base name]')
+    parser.add_argument('--method', default='L-BFGS-B', help='The scipy.optimize.minimize() method used to find the solution, which must be one that uses gradients, or "banded" to alternate closed-form rotations with direct (pentadiagonal) solves of the Stickel normal equations (polished with L-BFGS-B if --lmbda_t > 0). [default = L-BFGS-B]')
+    parser.add_argument('--maxiter', type=int, default=1000, help='The maximum number of iterations of the solver [default = 1000]')
+    parser.add_argument('--lmbda_t', type=float, default=0.0, help='The regularisation parameter across calibration intervals (in units of intervals). If > 0, all intervals are smoothed jointly, and flagged intervals are interpolated from their neighbours [default = 0]')
+    parser.add_argument('--jones', choices=('full', 'constrained'), default='full', help='The form of the model Jones matrices: unconstrained (8 parameters), or constrained to [[g_XX, g_XX sin(alpha)], [-g_YY sin(alpha), g_YY]] (5 parameters; see the README), which needs a scipy --method and a fixed --lmbda [default = full]')
+    parser.add_argument('--lmbda_alpha', type=float, help='The regularisation parameter for the leakage angle alpha of --jones constrained (--lmbda is then used for g_XX and g_YY) [default = LMBDA]')
+    parser.add_argument('--precision', choices=('double', 'single'), default='double', help='The precision the cost function is evaluated in. Single precision (complex64) is faster and uses less memory, with sums still accumulated in double precision; the output is always double precision [default = double]')
+    parser.add_argument('--clip', type=float, metavar='SIGMA', help='Before smoothing, flag all polarisations of channels in which the XX or YY solution is more than SIGMA robust (MAD) standard deviations, in phase or amplitude, both from a delay and polynomial fit and from a local smooth of its neighbouring channels (see aocal.fit_complex_gains_batch), e.g. RFI-hit channels. A typical value is 5 [default = no clipping]')
+    parser.add_argument('--multigrid', action='store_true', help='Solve coarse-to-fine: first on the channels averaged onto successively finer grids, each solution being the starting point for the next. Up to about 2x faster with thousands of channels and large lmbda, but little faster with hundreds of channels (see GeneralisedStickel.solve_multigrid())')
+    parser.add_argument('--cache', metavar='DIR', help='Keep the inputs and results of runs in DIR. A run with the same input and settings as an earlier one reuses its result; one whose input differs only in some spectra (e.g. after flagging a tile or some channels) re-solves just those, starting from the earlier result. Not with --stream or --lmbda auto')
+    parser.add_argument('--stream', action='store_true', help='Smooth (and write out) one calibration interval at a time, each as an independent problem, so that only one interval is held in memory at once')
+    parser.add_argument('--profile', metavar='FILE', help='Write timings, evaluation and iteration counts, per-iteration cost/lmbda/gradient norm traces, bytes read and written and peak memory to FILE, as JSON')
+    parser.add_argument('--workers', type=int, default=1, help='The number of worker processes to spread the solves over (--method banded only) [default = 1]')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='-v info, -vv debug')
 
     args = parser.parse_args()
 
     # Validate arguments
-    assert args.lmbda > 0, "The 'lmbda' parameter must be > 0"
+    assert args.lmbda == 'auto' or args.lmbda > 0, "The 'lmbda' parameter must be > 0"
+    assert 0 < args.lmbda_range[0] < args.lmbda_range[1], "The 'lmbda_range' must be > 0 and increasing"
+    assert args.lmbda_steps >= 3, "The 'lmbda_steps' parameter must be at least 3"
+    lmbdas = np.logspace(np.log10(args.lmbda_range[0]), np.log10(args.lmbda_range[1]), args.lmbda_steps)
+    dtype = np.complex64 if args.precision == 'single' else np.complex128
+    if args.workers > 1 and args.method != 'banded':
+        parser.error("--workers requires --method banded")
+    if args.lmbda_t < 0:
+        parser.error("--lmbda_t must be >= 0")
+    if args.stream and args.lmbda_t > 0:
+        parser.error("--stream smooths intervals independently, so cannot be used with --lmbda_t")
+    if args.jones == 'constrained' and (args.method == 'banded' or args.multigrid or args.lmbda == 'auto'):
+        parser.error("--jones constrained needs a scipy --method, a fixed --lmbda, and no --multigrid")
+    if args.lmbda_alpha is not None and args.lmbda_alpha <= 0:
+        parser.error("--lmbda_alpha must be > 0")
+    if args.cache is not None and (args.stream or args.lmbda == 'auto'):
+        parser.error("--cache cannot be used with --stream or --lmbda auto")
+    if args.clip is not None and args.clip <= 0:
+        parser.error("--clip must be > 0")
+
+    if args.profile is not None:
+        profiling.enable()
+
+    if args.verbose == 1:
+        logging.basicConfig(level=logging.INFO)
+    elif args.verbose > 1:
+        logging.basicConfig(level=logging.DEBUG)
+
+    if args.outfile is None:
+        args.outfile = default_outfile(args.solution_file)
+
+    lmbda_file = os.path.splitext(args.outfile)[0] + "_lmbda.json"
+    lmbda_curves = []
+
+    if args.stream:
+        for interval, stickel in smooth_file(args.solution_file, args.outfile, args.lmbda, method=args.method, maxiter=args.maxiter, workers=args.workers, lmbdas=lmbdas, criterion=args.lmbda_criterion, multigrid=args.multigrid, jones=args.jones, lmbda_alpha=args.lmbda_alpha, dtype=dtype, clip_sigma=args.clip):
+            if args.lmbda == 'auto':
+                lmbda_curves.append(dict(interval=interval, **report_lmbda_curve(stickel, label="Interval %d: " % interval)))
+            print("Interval %d: cost = %g" % (interval, stickel.cost))
+            if args.multigrid:
+                report_levels(stickel, label="Interval %d: " % interval)
+        print("Smoothed solutions written to %s" % args.outfile)
+        if args.lmbda == 'auto':
+            with open(lmbda_file, "w") as f:
+                json.dump({"criterion": args.lmbda_criterion, "intervals": lmbda_curves}, f, indent=1)
+            print("lmbda curves written to %s" % lmbda_file)
+        write_profile(args.profile)
+        return
 
     # Open cal file and load the data
     ao = aocal.fromfile(args.solution_file)
+    if args.clip is not None:
+        ao, clipped = clip_outliers(ao, args.clip)
+        print("Clipped %d channels: %s" % (clipped.sum(), ", ".join("antenna %d: %d" % (antenna, clipped[antenna]) for antenna in np.flatnonzero(clipped)) or "none"))
 
     # Run "test_optimal_rotation" to output orig_*.png, rand_*.png, and test_*.png plots,
     # showing that the method for "lining up the phases without using a reference antenna"
@@ -163,17 +1987,38 @@ def main():
 
     #print(test_objective(ao, args.lmbda))
 
-    # YET TO DO: actually put the objective function into scipy's minimize() (or other
-    # numerical solver of your choice).
+    # Channels which contain only nans are removed before solving (see objective()).
+    # The channel indices of the remaining channels serve as the (non-uniform) frequencies.
+    if args.cache is not None:
+        smoothed, stickel, info = smooth_incremental(ao, args.lmbda, SolutionCache(args.cache), method=args.method, maxiter=args.maxiter, workers=args.workers, multigrid=args.multigrid, lmbda_t=args.lmbda_t, jones=args.jones, lmbda_alpha=args.lmbda_alpha, dtype=dtype)
+        print("Cache %s: %s, %d of %d spectra solved for" % (info["key"], info["status"], info["n_solved"], info["n_spectra"]))
+    else:
+        smoothed, stickel = smooth(ao, args.lmbda, method=args.method, maxiter=args.maxiter, workers=args.workers, lmbdas=lmbdas, criterion=args.lmbda_criterion, multigrid=args.multigrid, lmbda_t=args.lmbda_t, jones=args.jones, lmbda_alpha=args.lmbda_alpha, dtype=dtype)
+    if args.lmbda == 'auto':
+        with open(lmbda_file, "w") as f:
+            json.dump({"criterion": args.lmbda_criterion, "intervals": [dict(interval="all", **report_lmbda_curve(stickel))]}, f, indent=1)
+        print("lmbda curve written to %s" % lmbda_file)
+    elif stickel is None:
+        # Straight from the cache
+        pass
+    elif args.method == 'banded':
+        print("Cost = %g after %d iterations" % (stickel.cost, stickel.n_iter))
+        if stickel.cg_iterations:
+            print("%d conjugate gradient iterations in all" % sum(stickel.cg_iterations))
+        if stickel.polish_iterations:
+            print("Polished with L-BFGS-B in %d iterations" % stickel.polish_iterations)
+    else:
+        print("%s: %s" % (args.method, stickel.result.message))
+        print("Cost = %g after %d iterations (%d evaluations)" % (stickel.cost, stickel.result.nit, stickel.n_eval))
+    if args.multigrid and getattr(stickel, 'levels', None):
+        report_levels(stickel)
 
-    # ...
-
-    # YET TO DO: Once it's been solved, choose how to display the results.
     # Note that the fitted model, like the original data, will not necessarily be "lined up
     # in phase" (e.g. as determined by optimal_rotation()), so if you want to plot it like that,
     # you'll have to do that step again yourself. See test_optimal_rotation() as an example.
-
-    # ...
+    smoothed.tofile(args.outfile)
+    print("Smoothed solutions written to %s" % args.outfile)
+    write_profile(args.profile)
 
 
 if __name__ == '__main__':
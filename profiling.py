@@ -0,0 +1,199 @@
+"""
+Lightweight instrumentation of the I/O, smoothing and plotting paths.
+
+Instrumented code records timers (timed(), timer()), counters (count()) and
+traces, i.e. per-iteration records such as the cost and gradient norm
+(trace()), here. Nothing is recorded unless profiling is switched on, either
+with enable(), or by registering a callback with add_callback(); until then,
+every hook is a single test of the module-level flag "enabled", and
+expensive extras (e.g. gradient norms) are skipped entirely.
+
+Timers are inclusive (a timed function's time includes that of the timed
+functions it calls) and also count calls. report() gives everything recorded
+so far, together with the peak memory of the process, as a dictionary, and
+write() saves it as JSON.
+
+Callbacks are called as callback(kind, name, value) for each record as it is
+made, where kind is "timer" (value in seconds), "count" (value is the
+increment) or "trace" (value is a dictionary).
+"""
+import time
+import json
+import functools
+import contextlib
+
+enabled = False
+
+_recording = False
+_callbacks = []
+_timers = {}
+_counters = {}
+_traces = {}
+
+
+def _update():
+    global enabled
+    enabled = _recording or bool(_callbacks)
+
+
+def enable():
+    """
+    Start recording
+    """
+    global _recording
+    _recording = True
+    _update()
+
+
+def disable():
+    """
+    Stop recording (callbacks are still called until they are removed)
+    """
+    global _recording
+    _recording = False
+    _update()
+
+
+def add_callback(callback):
+    """
+    Call callback(kind, name, value) for each record from now on, where kind
+    is "timer" (value in seconds), "count" (value is the increment) or
+    "trace" (value is a dictionary); this switches the hooks on even if
+    recording is not
+    """
+    _callbacks.append(callback)
+    _update()
+
+
+def remove_callback(callback):
+    """
+    Stop calling a callback registered with add_callback()
+    """
+    _callbacks.remove(callback)
+    _update()
+
+
+def reset():
+    """
+    Forget everything recorded so far
+    """
+    _timers.clear()
+    _counters.clear()
+    _traces.clear()
+
+
+def _notify(kind, name, value):
+    for callback in _callbacks:
+        callback(kind, name, value)
+
+
+def add_time(name, seconds):
+    """
+    Record one call of timer name, taking seconds
+    """
+    if not enabled:
+        return
+    if _recording:
+        record = _timers.setdefault(name, [0, 0.0])
+        record[0] += 1
+        record[1] += seconds
+    _notify("timer", name, seconds)
+
+
+def count(name, n=1):
+    """
+    Add n to counter name
+    """
+    if not enabled:
+        return
+    if _recording:
+        _counters[name] = _counters.get(name, 0) + n
+    _notify("count", name, n)
+
+
+def trace(name, **values):
+    """
+    Append a record of values (e.g. cost=..., grad_norm=...) to trace name
+    """
+    if not enabled:
+        return
+    if _recording:
+        _traces.setdefault(name, []).append(values)
+    _notify("trace", name, values)
+
+
+class _Timer(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        add_time(self.name, time.perf_counter() - self.start)
+
+
+def timer(name):
+    """
+    A context manager which times its block as name (when enabled)
+
+    with profiling.timer("plot"):
+        ...
+    """
+    if not enabled:
+        return contextlib.nullcontext()
+    return _Timer(name)
+
+
+def timed(name):
+    """
+    Decorator which times each call of a function as name (when enabled)
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return f(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                add_time(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def peak_memory_mb():
+    """
+    The peak resident memory of this process so far, in MB (None where this
+    is not available)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def report():
+    """
+    Everything recorded so far, as a dictionary with keys timers ({name:
+    {"calls": n, "seconds": s}}), counters, traces ({name: [record, ...]})
+    and peak_memory_mb
+    """
+    return {"timers": {name: {"calls": calls, "seconds": seconds} for name, (calls, seconds) in sorted(_timers.items())},
+            "counters": dict(sorted(_counters.items())),
+            "traces": {name: list(records) for name, records in _traces.items()},
+            "peak_memory_mb": peak_memory_mb()}
+
+
+def write(filename, **extra):
+    """
+    Write report() (and any extra items, e.g. the command line) as JSON
+    """
+    result = report()
+    result.update(extra)
+    with open(filename, "w") as f:
+        json.dump(result, f, indent=1)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""
+Resample calibration solutions onto a different grid of channels, e.g. from
+768 to 3072 channels, or onto a subset of channels, without calibrating again.
+
+Frequencies are given in units of the original channel index (so that the
+original channels are at 0, 1, ..., n_chan - 1; see channel_grid() for the
+centres of the channels of a finer or coarser grid spanning the same band).
+Two methods are available:
+
+- "delay": each spectrum's coarse delay (aocal.delay_gradients(), as in
+  aocal.fit_complex_gains) is taken out, and the amplitude and (unwrapped)
+  phase of what is left are interpolated linearly between the nearest
+  unflagged channels, before the delay is put back at the new frequencies.
+- "smooth": the solutions are first smoothed (do_smoothing.smooth()), and
+  the smoothed model is then interpolated as for "delay". Solutions with too
+  few channels with data to smooth are interpolated as they are.
+
+Flags are kept: a new channel is flagged (NaN) wherever the original channel
+nearest to it is, unless fill_gaps is set, in which case flagged channels
+are bridged by the interpolation (and the ends of the band extrapolated).
+
+Everything is vectorised over intervals, antennas and polarisations.
+regrid_file() streams a file interval by interval.
+"""
+import os
+import sys
+import logging
+import argparse
+
+import numpy as np
+
+import aocal
+import profiling
+
+METHODS = ("delay", "smooth")
+
+
+def channel_grid(n_chan, new_n_chan):
+    """
+    The centres of new_n_chan channels spanning the same band as n_chan
+    channels, in units of the original channel index
+    """
+    return (np.arange(new_n_chan) + 0.5) * n_chan / new_n_chan - 0.5
+
+
+def _nearest_good(good):
+    """
+    For each position along the last axis of good, the index of the nearest
+    True position at or before it (-1 if there is none), and at or after it
+    (n if there is none)
+    """
+    n = good.shape[-1]
+    index = np.arange(n)
+    before = np.maximum.accumulate(np.where(good, index, -1), axis=-1)
+    after = np.minimum.accumulate(np.where(good, index, n)[..., ::-1], axis=-1)[..., ::-1]
+    return before, after
+
+
+def nearest_channels(freqs, new_freqs):
+    """
+    The index of the original channel (at freqs, increasing) nearest to each
+    of new_freqs
+    """
+    upper = np.clip(np.searchsorted(freqs, new_freqs), 1, max(len(freqs) - 1, 1))
+    lower = upper - 1
+    if len(freqs) == 1:
+        return np.zeros(len(new_freqs), dtype=int)
+    return np.where(new_freqs - freqs[lower] <= freqs[upper] - new_freqs, lower, upper)
+
+
+def uniform_grid(v, index):
+    """
+    The spectra (along the last axis) of v, at positions index (increasing,
+    at least 1 apart) on a grid of unit spacing, spread onto that grid, with
+    NaN at the positions between them
+    """
+    positions = np.rint(index).astype(int)
+    if np.all(np.diff(positions) == 1):
+        return v
+    grid = np.full(v.shape[:-1] + (positions[-1] + 1,), np.nan, dtype=v.dtype)
+    grid[..., positions] = v
+    return grid
+
+
+@profiling.timed("regrid.interpolate")
+def interpolate(v, freqs, new_freqs, fft_pad_factor=8):
+    """
+    Interpolate each spectrum (along the last axis) of v, at freqs
+    (increasing, and ideally on a uniform grid, with or without gaps), onto
+    new_freqs.
+
+    The delay of each spectrum is taken out, the amplitude and unwrapped phase
+    are interpolated linearly between the nearest unflagged (non-NaN)
+    channels on either side (beyond the last unflagged channel, its value is
+    used), and the delay is put back. Spectra which are entirely NaN stay NaN.
+    """
+    v = np.asarray(v)
+    freqs = np.asarray(freqs, dtype=float)
+    new_freqs = np.asarray(new_freqs, dtype=float)
+    shape = v.shape[:-1] + (len(new_freqs),)
+    n = v.shape[-1]
+    v = v.reshape(-1, n)
+    out = np.full((v.shape[0], len(new_freqs)), np.nan, dtype=np.complex128)
+    good = ~np.isnan(v)
+    rows = np.flatnonzero(good.any(axis=1))
+    if len(rows) == 0:
+        return out.reshape(shape)
+    v = v[rows]
+    good = good[rows]
+
+    # Delays, in turns per step (the smallest channel spacing), as signed
+    # gradients so that they can be evaluated between channels. The FFT
+    # needs uniformly spaced samples, so the channels are first placed on a
+    # grid of that spacing, with any gaps flagged
+    step = np.min(np.diff(freqs)) if n > 1 else 1.0
+    index = (freqs - freqs[0]) / step
+    new_index = (new_freqs - freqs[0]) / step
+    gradient = aocal.delay_gradients(uniform_grid(v, index), fft_pad_factor)
+    gradient = (gradient + 0.5) % 1.0 - 0.5
+
+    # Flagged values are filled with the nearest unflagged value before them
+    # (or after, at the start), so that the phases can be unwrapped
+    before, after = _nearest_good(good)
+    filled = np.where(before >= 0, before, after)
+    u = np.take_along_axis(v, filled, axis=1) * np.exp(-2j*np.pi*gradient[:, np.newaxis]*index[filled])
+    amp = np.abs(u)
+    phase = np.unwrap(np.angle(u), axis=1)
+
+    # The unflagged channels on either side of each new frequency
+    lower = np.clip(np.searchsorted(freqs, new_freqs, side='right') - 1, 0, n - 1)
+    upper = np.minimum(lower + 1, n - 1)
+    lo = before[:, lower]
+    hi = after[:, upper]
+    lo = np.where(lo < 0, hi, lo)
+    hi = np.where(hi >= n, lo, hi)
+    span = freqs[hi] - freqs[lo]
+    t = np.divide(new_freqs - freqs[lo], span, out=np.zeros(span.shape), where=span > 0)
+    t = np.clip(t, 0.0, 1.0)
+
+    new_amp = (1 - t)*np.take_along_axis(amp, lo, axis=1) + t*np.take_along_axis(amp, hi, axis=1)
+    new_phase = (1 - t)*np.take_along_axis(phase, lo, axis=1) + t*np.take_along_axis(phase, hi, axis=1)
+    out[rows] = new_amp * np.exp(1j*(new_phase + 2*np.pi*gradient[:, np.newaxis]*new_index))
+    return out.reshape(shape)
+
+
+@profiling.timed("regrid.regrid")
+def regrid(ao, new_freqs, freqs=None, method="delay", lmbda=1.0, smooth_options=None, fill_gaps=False):
+    """
+    Resample ao onto new_freqs (in the units of freqs, by default the channel
+    index) with the given method ("delay" or "smooth", see the module
+    docstring). For "smooth", lmbda and smooth_options (a dictionary of
+    keyword arguments, e.g. method) are passed to do_smoothing.smooth(), which
+    smooths over the channel index (whatever freqs are). If ao has fewer than
+    do_smoothing.MIN_CHANNELS channels with data, it is interpolated as for
+    "delay" instead.
+
+    New channels whose nearest original channel is flagged are flagged,
+    unless fill_gaps is True.
+
+    Returns a complex128 AOCal with len(new_freqs) channels.
+    """
+    if method not in METHODS:
+        raise ValueError("method must be one of %s" % ", ".join(METHODS))
+    if freqs is None:
+        freqs = np.arange(ao.n_chan)
+    if len(freqs) != ao.n_chan:
+        raise ValueError("%d freqs given for %d channels" % (len(freqs), ao.n_chan))
+    if np.any(np.diff(freqs) <= 0):
+        raise ValueError("freqs must be increasing")
+    model = ao
+    if method == "smooth" and not np.all(np.isnan(ao)):
+        import do_smoothing
+        n_chans = len(do_smoothing.good_channels(ao))
+        if n_chans < do_smoothing.MIN_CHANNELS:
+            logging.warning("only %d channels with data, too few to smooth, so interpolated as for the delay method", n_chans)
+        else:
+            model, _ = do_smoothing.smooth(ao, lmbda, **(smooth_options or {}))
+    values = interpolate(np.moveaxis(np.asarray(model), 2, -1), freqs, new_freqs)
+    if not fill_gaps:
+        flagged = np.isnan(np.moveaxis(np.asarray(ao), 2, -1))[..., nearest_channels(np.asarray(freqs, dtype=float), np.asarray(new_freqs, dtype=float))]
+        values[flagged] = np.nan
+    return aocal.AOCal(np.moveaxis(values, -1, 2), ao.time_start, ao.time_end)
+
+
+def regrid_file(in_filename, out_filename, new_freqs, freqs=None, method="delay", lmbda=1.0, smooth_options=None, antennas_per_block=None, fill_gaps=False):
+    """
+    regrid() a solution file one interval at a time (or, for "delay", one
+    block of antennas_per_block antennas at a time), writing each block to
+    out_filename, whose header has len(new_freqs) channels, as soon as it is
+    done. For "smooth", each interval is smoothed as an independent problem.
+    """
+    header = aocal.file_header(in_filename)
+    n_int, n_ant, n_chan, n_pol = aocal.header_shape(header)
+    if method == "smooth":
+        antennas_per_block = None
+    with aocal.AOCalWriter(out_filename, n_int, n_ant, len(new_freqs), n_pol, time_start=header.timeStart, time_end=header.timeEnd) as writer:
+        for interval, antenna, block in aocal.iter_blocks(in_filename, antennas_per_block):
+            logging.debug("regridding interval %d, antennas from %d", interval, antenna)
+            writer.write(regrid(block, new_freqs, freqs=freqs, method=method, lmbda=lmbda, smooth_options=smooth_options, fill_gaps=fill_gaps), interval, antenna)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Resample calibration solutions onto a different grid of channels')
+
+    parser.add_argument('solution_file', help='A calibration solution file in the "AOCal" format')
+    grid = parser.add_mutually_exclusive_group(required=True)
+    grid.add_argument('--n_chan', type=int, help='The number of channels of the new grid, spanning the same band')
+    grid.add_argument('--channels', type=float, nargs='+', help='The new channels, in units of the original channel index (fractions allowed), e.g. a subset of channels')
+    parser.add_argument('--outfile', help='The file to write the regridded solutions to [default = SOLUTION_FILE with "_regridded" appended to its base name]')
+    parser.add_argument('--method', choices=METHODS, default='delay', help='Interpolate the solutions themselves (with their delays taken out), or a smoothed model of them (see do_smoothing.py) [default = delay]')
+    parser.add_argument('--fill_gaps', action='store_true', help='Interpolate across flagged channels (and extrapolate beyond the first and last unflagged ones) instead of flagging the new channels whose nearest original channel is flagged')
+    parser.add_argument('--lmbda', type=float, default=1.0, help='The regularisation parameter of --method smooth [default = 1.0]')
+    parser.add_argument('--smooth_method', default='banded', help='The solver used by --method smooth (see do_smoothing.py --method) [default = banded]')
+    parser.add_argument('--profile', metavar='FILE', help='Write timings, bytes read and written and peak memory to FILE, as JSON')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='-v info, -vv debug')
+
+    args = parser.parse_args()
+
+    if args.n_chan is not None and args.n_chan < 1:
+        parser.error("--n_chan must be at least 1")
+    if args.lmbda <= 0:
+        parser.error("--lmbda must be > 0")
+
+    if args.verbose == 1:
+        logging.basicConfig(level=logging.INFO)
+    elif args.verbose > 1:
+        logging.basicConfig(level=logging.DEBUG)
+    if args.profile is not None:
+        profiling.enable()
+
+    if args.outfile is None:
+        base, ext = os.path.splitext(args.solution_file)
+        args.outfile = base + "_regridded" + ext
+
+    n_chan = aocal.header_shape(aocal.file_header(args.solution_file))[2]
+    new_freqs = channel_grid(n_chan, args.n_chan) if args.n_chan is not None else np.array(args.channels)
+    regrid_file(args.solution_file, args.outfile, new_freqs, method=args.method, lmbda=args.lmbda, smooth_options={"method": args.smooth_method}, fill_gaps=args.fill_gaps)
+    print("Regridded solutions (%d channels) written to %s" % (len(new_freqs), args.outfile))
+
+    if args.profile is not None:
+        profiling.write(args.profile, argv=sys.argv)
+
+
+if __name__ == '__main__':
+    main()
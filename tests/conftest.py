@@ -0,0 +1,28 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+B1934_FILE = os.path.join(ROOT, "SB38969.B1934-638.beam0.aocalibrate.bin")
+
+
+def write_metafits(filename, rx_offset=0):
+    '''
+    A minimal metafits file for 4 tiles: a TILEDATA table with the X and Y
+    inputs of each tile, in the (shuffled) order of the correlator inputs
+    '''
+    fits = pytest.importorskip("astropy.io.fits")
+    antenna = np.repeat(np.array([2, 0, 3, 1]), 2)
+    columns = [
+        fits.Column(name='Antenna', format='I', array=antenna),
+        fits.Column(name='Pol', format='1A', array=np.tile(['X', 'Y'], 4)),
+        fits.Column(name='Rx', format='I', array=antenna // 2 + 1 + rx_offset),
+        fits.Column(name='Slot', format='I', array=antenna % 2 + 1),
+        fits.Column(name='Flavors', format='4A', array=np.repeat(['RG6', 'LMR', 'RG6', 'LMR'], 2)),
+    ]
+    hdus = fits.HDUList([fits.PrimaryHDU(), fits.BinTableHDU.from_columns(columns, name='TILEDATA')])
+    hdus.writeto(filename, overwrite=True)
@@ -0,0 +1,267 @@
+import os
+import glob
+
+import numpy as np
+import pytest
+
+import aocal
+import aocal_plot
+import benchmark
+import tileindex
+from conftest import B1934_FILE, write_metafits
+
+
+@pytest.mark.parametrize("amp_order", [5, 0])
+def test_fit_matches_fit_complex_gains(amp_order):
+    ao = benchmark.synthetic(2, 6, 96)
+    ao[1, 2, 10:20] = np.nan
+    fitted = ao.fit(amp_order=amp_order, inplace=False)
+    for interval, antenna, pol in np.ndindex(ao.shape[0], ao.shape[1], 4):
+        if pol in (0, 3):
+            expected = aocal.fit_complex_gains(np.asarray(ao[interval, antenna, :, pol]), amp_order=amp_order)
+        else:
+            expected = ao[interval, antenna, :, pol]
+        np.testing.assert_allclose(fitted[interval, antenna, :, pol], expected, rtol=1e-10, atol=1e-12)
+    assert fitted.time_start == ao.time_start
+
+
+def test_fit_in_place():
+    ao = benchmark.synthetic(1, 3, 48)
+    expected = ao.fit(inplace=False)
+    assert ao.fit() is ao
+    np.testing.assert_array_equal(ao, expected)
+
+
+@pytest.mark.parametrize("mode", ["model", "clip"])
+def test_fit_workers_match_serial(mode):
+    ao = benchmark.synthetic(2, 5, 64)
+    ao[0, 1, 30, 0] *= 3
+    # The same up to rounding (the antennas are fitted in different batches)
+    np.testing.assert_allclose(ao.fit(mode=mode, workers=2, inplace=False), ao.fit(mode=mode, inplace=False), rtol=1e-12, atol=0)
+
+
+def test_open_copy_on_write_leaves_the_file_alone(tmp_path):
+    filename = str(tmp_path / "solutions.bin")
+    ao = benchmark.synthetic(2, 4, 32)
+    ao.tofile(filename)
+    with open(filename, "rb") as f:
+        contents = f.read()
+
+    readonly = aocal.open(filename)
+    assert not readonly.flags.owndata and not readonly.flags.writeable
+    np.testing.assert_array_equal(readonly[1, 2], ao[1, 2])
+    assert (readonly.time_start, readonly.time_end) == (ao.time_start, ao.time_end)
+    with pytest.raises(ValueError):
+        readonly[0, 0, 0, 0] = 0
+
+    copy = aocal.open(filename, mode='c')
+    copy[0, 0, :, 0] = 0
+    copy.fit(pols=(3,))
+    assert np.all(copy[0, 0, :, 0] == 0)
+    del readonly, copy
+    with open(filename, "rb") as f:
+        assert f.read() == contents
+
+
+@pytest.mark.parametrize("damage", ["garbage", "empty", "truncated", "padded", "file_type", "chunked_truncated"])
+def test_bad_files_raise_value_error(tmp_path, damage):
+    filename = str(tmp_path / "bad.bin")
+    ao = benchmark.synthetic(1, 2, 16)
+    if damage == "chunked_truncated":
+        ao.tofile_chunked(filename)
+    else:
+        ao.tofile(filename)
+    with open(filename, "rb") as f:
+        contents = f.read()
+    contents = {
+        "garbage": b"not a calibration file at all" * 100,
+        "empty": b"",
+        "truncated": contents[:-8],
+        "padded": contents + bytes(16),
+        "file_type": contents[:8] + (1).to_bytes(4, "little") + contents[12:],
+        "chunked_truncated": contents[:-8],
+    }[damage]
+    with open(filename, "wb") as f:
+        f.write(contents)
+    with pytest.raises(ValueError, match="bad.bin"):
+        aocal.file_header(filename)
+    with pytest.raises(ValueError, match="bad.bin"):
+        aocal.fromfile(filename)
+
+
+def with_awkward_flags(ao):
+    '''
+    ao with flags set as the rest of the repo sets them (nan+0j), with both
+    parts NaN, with only the real part NaN, and with a NaN payload
+    '''
+    ao = ao.copy()
+    ao[0, 0, 3] = np.nan
+    ao[0, 1, 4, 1] = complex(np.nan, np.nan)
+    ao[-1, -1, 5, 2] = complex(np.nan, 0.5)
+    bits = np.asarray(ao).view(np.uint64)
+    bits[0, 0, 6, 0:2] = 0x7ff8000000000123  # both parts of XX
+    return ao
+
+
+@pytest.mark.parametrize("level", [1, 6])
+def test_chunked_round_trip(tmp_path, level):
+    ao = with_awkward_flags(benchmark.synthetic(2, 5, 48))
+    filename = str(tmp_path / "chunked.bin")
+    ao.tofile_chunked(filename, level=level)
+    assert aocal.is_chunked(filename)
+    back = aocal.fromfile(filename)
+    assert back.shape == ao.shape
+    assert (back.time_start, back.time_end) == (ao.time_start, ao.time_end)
+    # Bit for bit, NaN payloads included
+    np.testing.assert_array_equal(np.asarray(back).view(np.uint64), np.asarray(ao).view(np.uint64))
+
+    part = aocal.fromfile_chunked(filename, intervals=[1], antennas=[4, 0])
+    np.testing.assert_array_equal(np.asarray(part).view(np.uint64), np.asarray(ao)[[1]][:, [4, 0]].view(np.uint64))
+
+    blocks = list(aocal.iter_blocks(filename, antennas_per_block=2))
+    assert [(interval, antenna) for interval, antenna, _ in blocks] == [(i, a) for i in range(2) for a in (0, 2, 4)]
+    for interval, antenna, block in blocks:
+        np.testing.assert_array_equal(block[0], ao[interval, antenna:antenna + 2])
+
+
+def test_chunked_single_precision(tmp_path):
+    ao = with_awkward_flags(benchmark.synthetic(1, 4, 48))
+    filename = str(tmp_path / "chunked64.bin")
+    ao.tofile_chunked(filename, dtype=np.complex64)
+    back = aocal.fromfile(filename)
+    assert back.dtype == np.complex128
+    np.testing.assert_array_equal(np.isnan(back), np.isnan(ao))
+    np.testing.assert_allclose(back, ao.astype(np.complex64), rtol=0, atol=0, equal_nan=True)
+
+
+def test_convert_file_round_trip(tmp_path):
+    chunked = str(tmp_path / "chunked.bin")
+    classic = str(tmp_path / "classic.bin")
+    aocal.convert_file(B1934_FILE, chunked)
+    aocal.convert_file(chunked, classic)
+    with open(B1934_FILE, "rb") as f1, open(classic, "rb") as f2:
+        assert f1.read() == f2.read()
+    with pytest.raises(ValueError):
+        aocal.read_header(chunked)
+    assert aocal.file_header(chunked) == aocal.read_header(B1934_FILE)._replace(intro=aocal.CHUNKED_INTRO)
+
+
+def read_rts_line_by_line(metafits, pattern):
+    '''
+    The RTS DI_JonesMatrices parser as it was before rtsfile read files in
+    bulk (one interval, Jref ignored)
+    '''
+    pol_map = [3, 2, 1, 0]
+    ant_map = tileindex.tile_index(metafits).rts_to_ao
+    rts_filenames = sorted(glob.glob(pattern))
+    rts_filenames.reverse()
+    for chan, rts_filename in enumerate(rts_filenames):
+        with open(rts_filename) as rts_file:
+            rts_file.readline()
+            rts_file.readline()
+            lines = rts_file.readlines()
+        if chan == 0:
+            data = np.full((1, len(lines), len(rts_filenames), 4), np.nan, dtype=np.complex128)
+        for ant, line in enumerate(lines):
+            jones_str = line.split(",")
+            for pol, p in enumerate(pol_map):
+                data[0, ant_map[ant], chan, pol] = float(jones_str[2*p]) + float(jones_str[2*p + 1])*1j
+    return data
+
+
+def write_rts_files(dirname, n_channels, seed, prefix="DI_JonesMatrices_node"):
+    '''
+    RTS DI_JonesMatrices files of random gains for the 4 tiles of
+    write_metafits(), one per coarse channel, with numbers in a mix of
+    formats. Returns their Jref factors, in channel order.
+    '''
+    rng = np.random.default_rng(seed)
+    jrefs = rng.uniform(0.5, 2, n_channels)
+    for node, jref in enumerate(jrefs):
+        with open(os.path.join(dirname, "%s%03d.dat" % (prefix, node + 1)), "w") as f:
+            f.write("%.17g\n" % jref)
+            f.write(", ".join(["1.0", "0.0"]*4) + "\n")
+            for values in rng.standard_normal((4, 8)):
+                f.write(", ".join("%.9g" % v if i % 3 else "%.6e" % v for i, v in enumerate(values)) + "\n")
+    return jrefs[::-1]
+
+
+def test_rtsfile_matches_line_by_line_parser(tmp_path):
+    metafits = str(tmp_path / "obs.metafits")
+    write_metafits(metafits)
+    jrefs = write_rts_files(str(tmp_path), 3, seed=0)
+    pattern = str(tmp_path / "DI_JonesMatrices_node[0-9]*.dat")
+    expected = read_rts_line_by_line(metafits, pattern)
+
+    ao = aocal.rtsfile(metafits, pattern, apply_jref=False)
+    np.testing.assert_array_equal(ao, expected)
+    np.testing.assert_array_equal(aocal.rtsfile(metafits, pattern, apply_jref=False, workers=2), expected)
+    np.testing.assert_allclose(aocal.rtsfile(metafits, pattern), expected*jrefs[np.newaxis, np.newaxis, :, np.newaxis], rtol=1e-15)
+
+    # One interval per pattern
+    write_rts_files(str(tmp_path), 3, seed=1, prefix="DI_JonesMatrices_t1_node")
+    second = str(tmp_path / "DI_JonesMatrices_t1_node[0-9]*.dat")
+    ao = aocal.rtsfile(metafits, [pattern, second], apply_jref=False, time_start=1.0, time_end=2.0)
+    assert ao.shape == (2, 4, 3, 4) and (ao.time_start, ao.time_end) == (1.0, 2.0)
+    np.testing.assert_array_equal(ao[1:], read_rts_line_by_line(metafits, second))
+
+
+def align_line_by_line(ao):
+    '''
+    The alignment --refant align replaced: the optimal rotation between each
+    pair of adjacent channels, accumulated, on a copy without the flagged
+    channels
+    '''
+    flagged = np.all(np.isnan(ao), axis=(0, 1, 3))
+    kept = np.delete(np.asarray(ao), np.flatnonzero(flagged), axis=2)
+    rotations = [np.angle(np.nanmean(kept[:, :, i] * np.conj(kept[:, :, i-1]))) for i in range(1, kept.shape[2])]
+    phases = np.zeros(ao.shape[2])
+    phases[~flagged] = np.cumsum([0.0] + rotations)
+    return ao * np.exp(-1j*phases)[np.newaxis, np.newaxis, :, np.newaxis]
+
+
+def test_align_phases():
+    ao = benchmark.synthetic(3, 8, 96)
+    ao[1] = np.nan  # a flagged interval
+    rng = np.random.default_rng(4)
+    # A phase common to all antennas, per interval and per channel, of the
+    # kind a reference antenna takes out
+    common = np.exp(1j*(rng.uniform(-np.pi, np.pi, (3, 1, 1, 1)) + rng.uniform(-np.pi, np.pi, (1, 1, 96, 1))))
+
+    aligned, _ = aocal_plot.reference(ao*common, "align")
+    good = ~np.isnan(aligned)
+    assert np.array_equal(good, ~np.isnan(ao))
+    # Lined up channel to channel, the common phases are gone (up to a phase
+    # for the whole array) with no reference antenna ...
+    expected = aocal.align_phases(ao.copy())
+    rotation = np.exp(1j*np.angle(np.nansum(aligned * np.conj(expected))))
+    np.testing.assert_allclose(aligned[good], (expected*rotation)[good], atol=1e-10)
+    # ... and referenced to an antenna, it is the same as the original
+    # referenced to that antenna
+    with np.errstate(invalid='ignore'):
+        referenced, _ = aocal_plot.reference(aligned, 3)
+        expected, _ = aocal_plot.reference(ao, 3)
+    good = ~np.isnan(expected)
+    np.testing.assert_allclose(referenced[good], expected[good], rtol=1e-10)
+
+    # The same as the line-by-line alignment, whichever way it is blocked
+    interval = (ao*common)[:1]
+    np.testing.assert_allclose(aocal.align_phases(interval.copy(), intervals=False, block_size=1), align_line_by_line(interval), rtol=1e-12)
+
+
+@pytest.mark.parametrize("sigma, max_flagged", [(5.0, 10), (10.0, 0)])
+def test_clip_leaves_clean_solutions_alone(sigma, max_flagged):
+    ao = aocal.fromfile(B1934_FILE)
+    clipped = ao.fit(mode="clip", clip_sigma=sigma, inplace=False)
+    assert aocal.count_flagged(ao, clipped).sum() <= max_flagged
+
+
+def test_clip_finds_rfi():
+    ao = aocal.fromfile(B1934_FILE)
+    rfi = [(3, 50, 1), (10, 120, 2), (20, 200, 3), (30, 240, 1)]
+    for antenna, channel, width in rfi:
+        ao[0, antenna, channel:channel + width, [0, 3]] *= 1.3*np.exp(0.4j)
+    clipped = ao.fit(mode="clip", inplace=False)
+    for antenna, channel, width in rfi:
+        assert np.all(np.isnan(clipped[0, antenna, channel:channel + width, 0]))
+    assert aocal.count_flagged(ao, clipped).sum() <= sum(width for _, _, width in rfi) + 10
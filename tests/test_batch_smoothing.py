@@ -0,0 +1,15 @@
+import os
+
+import benchmark
+import batch_smoothing
+
+
+def test_process_file_reports_bad_files(tmp_path):
+    filename = str(tmp_path / "truncated.bin")
+    benchmark.synthetic(1, 2, 16).tofile(filename)
+    with open(filename, "r+b") as f:
+        f.truncate(1000)
+    status = batch_smoothing.process_file(filename, 1.0, method='banded', fit=True)
+    assert status["status"] == "error"
+    assert "truncated.bin is the wrong size" in status["error"]
+    assert not any(os.path.exists(f) for f in status["outputs"].values())
@@ -0,0 +1,83 @@
+import csv
+import json
+import sys
+
+import numpy as np
+import pytest
+
+import benchmark
+import compare
+
+
+def solution_files(tmp_path):
+    '''
+    Two files of synthetic solutions which differ, after the optimal rotation
+    of each channel, only in one value and one extra flag
+    '''
+    ao1 = benchmark.synthetic(2, 6, 32)
+    rng = np.random.default_rng(1)
+    ao2 = ao1 * np.exp(1j*rng.uniform(-np.pi, np.pi, (2, 1, 32, 1)))
+    ao2[1, 4, 20, 3] += 0.5
+    ao2[0, 2, 10, 0] = np.nan
+    filenames = str(tmp_path / "1.bin"), str(tmp_path / "2.bin")
+    ao1.tofile(filenames[0])
+    ao2.tofile(filenames[1])
+    return ao1, ao2, filenames
+
+
+def test_compare_finds_the_difference(tmp_path):
+    ao1, ao2, filenames = solution_files(tmp_path)
+    report = compare.compare_files(*filenames).report()
+    summary = report["summary"]
+    assert summary["n"] == np.count_nonzero(~np.isnan(ao1) & ~np.isnan(ao2))
+    assert summary["max"] == pytest.approx(0.5, rel=0.05)
+    assert summary["max_at"] == {"interval": 1, "antenna": 4, "channel": 20, "pol": 3}
+    assert summary["flagged_1_only"] == 0
+    assert summary["flagged_2_only"] == 1
+    # In every other channel, the rotation takes out the phases exactly
+    assert [row["max"] for row in report["channel"] if row["index"] != 20] == pytest.approx([0.0]*31, abs=1e-12)
+    assert [row["n"] for row in report["interval"]] == [summary["n"] - report["interval"][1]["n"], report["interval"][1]["n"]]
+
+
+def assert_reports_equal(report, expected):
+    summary = dict(report["summary"])
+    assert summary.pop("max_at") == expected["summary"]["max_at"]
+    assert summary == pytest.approx({key: value for key, value in expected["summary"].items() if key != "max_at"}, abs=1e-12)
+    for axis in compare.AXES:
+        for row, expected_row in zip(report[axis], expected[axis]):
+            assert row == pytest.approx(expected_row, abs=1e-12)
+
+
+def test_blocks_and_chunked_files_agree(tmp_path):
+    ao1, ao2, filenames = solution_files(tmp_path)
+    expected = compare.compare_files(*filenames).report()
+    assert_reports_equal(compare.compare_files(*filenames, antennas_per_block=4).report(), expected)
+
+    chunked = str(tmp_path / "2.chunked")
+    ao2.tofile_chunked(chunked)
+    assert_reports_equal(compare.compare_files(filenames[0], chunked).report(), expected)
+
+
+@pytest.mark.parametrize("extension", [".json", ".csv"])
+def test_main_writes_the_report(tmp_path, monkeypatch, capsys, extension):
+    ao1, ao2, filenames = solution_files(tmp_path)
+    chunked = str(tmp_path / "1.chunked")
+    ao1.tofile_chunked(chunked)
+    output = str(tmp_path / ("report" + extension))
+    monkeypatch.setattr(sys, "argv", ["compare.py", chunked, filenames[1], "--output", output])
+    compare.main()
+    printed = capsys.readouterr().out
+    assert "at {'interval': 1, 'antenna': 4, 'channel': 20, 'pol': 3}" in printed
+    assert "in %s only: 1" % filenames[1] in printed
+
+    with open(output) as f:
+        if extension == ".json":
+            report = json.load(f)
+            assert report["file_1"] == chunked
+            assert len(report["channel"]) == 32
+            assert report["summary"]["max_at"] == {"interval": 1, "antenna": 4, "channel": 20, "pol": 3}
+        else:
+            rows = list(csv.DictReader(f))
+            assert rows[0]["axis"] == "all"
+            assert len(rows) == 1 + 2 + 6 + 32 + 4
+            assert rows[0]["flagged_2_only"] == "1"
@@ -0,0 +1,211 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+
+import aocal
+import benchmark
+import do_smoothing
+from conftest import B1934_FILE
+
+
+def trimmed(ao):
+    '''
+    ao without its channels that contain only nans, and their channel indices
+    '''
+    chans = do_smoothing.good_channels(ao)
+    return ao[:, :, chans, :], chans
+
+
+def directional_derivatives(fun, x, direction, grad, step=1e-6):
+    '''
+    The derivative of fun at x along direction, by central differences, and
+    as given by grad (with the convention grad = dC/d(Re) + 1j*dC/d(Im) for
+    complex x)
+    '''
+    numerical = (fun(x + step*direction) - fun(x - step*direction)) / (2*step)
+    analytic = np.sum(np.real(np.conj(grad)*direction))
+    return numerical, analytic
+
+
+@pytest.mark.parametrize("lmbda_t", [0.0, 2.0])
+def test_generalised_stickel_gradient(lmbda_t):
+    ao, chans = trimmed(benchmark.synthetic(3, 3, 24, n_flagged_tiles=1))
+    stickel = do_smoothing.GeneralisedStickel(ao, 10.0, freqs=chans, lmbda_t=lmbda_t)
+    rng = np.random.default_rng(1)
+    x = stickel.initial_model() + 0.05*(rng.standard_normal(ao.shape) + 1j*rng.standard_normal(ao.shape))
+    C, grad = stickel.value_and_grad(x)
+    grad = grad.copy()
+    assert C == pytest.approx(stickel.total_cost(x))
+    for _ in range(3):
+        direction = rng.standard_normal(ao.shape) + 1j*rng.standard_normal(ao.shape)
+        numerical, analytic = directional_derivatives(lambda y: stickel.value_and_grad(y)[0], x, direction, grad)
+        assert analytic == pytest.approx(numerical, rel=1e-5)
+
+
+def test_constrained_jones_gradient():
+    ao, chans = trimmed(benchmark.synthetic(3, 3, 24, n_flagged_tiles=1))
+    stickel = do_smoothing.ConstrainedJonesStickel(ao, 10.0, lmbda_alpha=3.0, freqs=chans, lmbda_t=2.0)
+    gains, alpha = stickel.parameters(stickel.initial_model())
+    rng = np.random.default_rng(2)
+    x = stickel.join(gains, alpha + 0.1*rng.standard_normal(alpha.shape))
+    grad = stickel.value_and_grad(x)[1].copy()
+    for _ in range(3):
+        direction = rng.standard_normal(x.shape)
+        numerical, analytic = directional_derivatives(lambda y: stickel.value_and_grad(y)[0], x, direction, grad)
+        assert analytic == pytest.approx(numerical, rel=1e-5)
+
+
+@pytest.mark.parametrize("case, lmbda, lmbda_t", [
+    ("b1934", 1.0, 0.0),
+    ("b1934", 100.0, 0.0),
+    ("5x8x48", 1.0, 2.0),
+])
+def test_banded_agrees_with_lbfgsb(case, lmbda, lmbda_t):
+    if case == "b1934":
+        ao = aocal.fromfile(B1934_FILE)
+    else:
+        ao = benchmark.synthetic(*benchmark.parse_size(case))
+    ao, chans = trimmed(ao)
+    banded = do_smoothing.GeneralisedStickel(ao, lmbda, freqs=chans, lmbda_t=lmbda_t)
+    banded.solve_banded()
+    lbfgsb = do_smoothing.GeneralisedStickel(ao, lmbda, freqs=chans, lmbda_t=lmbda_t)
+    lbfgsb.solve()
+    # Neither is exactly at the minimum, but banded should get at least as close
+    assert banded.cost <= lbfgsb.cost * 1.01
+
+
+def test_banded_workers_match_serial():
+    ao, chans = trimmed(benchmark.synthetic(2, 6, 64))
+    serial = do_smoothing.GeneralisedStickel(ao, 10.0, freqs=chans)
+    expected = serial.solve_banded()
+    parallel = do_smoothing.GeneralisedStickel(ao, 10.0, freqs=chans)
+    np.testing.assert_allclose(parallel.solve_banded(workers=2), expected, rtol=1e-10, atol=1e-12)
+    assert parallel.n_iter == serial.n_iter
+
+
+@pytest.mark.parametrize("size", [(1, 8, 256), (2, 6, 384)])
+def test_multigrid_reaches_plain_cost(size):
+    ao, chans = trimmed(benchmark.synthetic(*size))
+    plain = do_smoothing.GeneralisedStickel(ao, 10.0, freqs=chans)
+    plain.solve()
+    multigrid = do_smoothing.GeneralisedStickel(ao, 10.0, freqs=chans)
+    model = multigrid.solve_multigrid()
+    assert model.shape == ao.shape
+    assert [level["n_chan"] for level in multigrid.levels][-1] == len(chans)
+    assert multigrid.cost <= plain.cost * 1.01
+
+
+@pytest.mark.parametrize("dtype, rtol", [(np.complex128, 1e-12), (np.complex64, 1e-5)])
+def test_workspace_matches_objective(dtype, rtol):
+    ao, chans = trimmed(benchmark.synthetic(2, 6, 96))
+    rng = np.random.default_rng(3)
+    ao_hat = np.nan_to_num(np.asarray(ao)) + 0.05*(rng.standard_normal(ao.shape) + 1j*rng.standard_normal(ao.shape))
+    ao_hat = aocal.AOCal(ao_hat)
+    before = ao_hat.copy()
+    workspace = do_smoothing.ObjectiveWorkspace(ao, freqs=chans, dtype=dtype)
+    for lmbda in (0.1, 10.0):
+        expected = do_smoothing.objective(ao, ao_hat, lmbda, chans)
+        assert do_smoothing.objective(ao, ao_hat, lmbda, chans, workspace=workspace) == pytest.approx(expected, rel=rtol)
+    np.testing.assert_array_equal(ao_hat, before)
+
+    # Once the workspace exists, evaluations allocate nothing of the size of
+    # the data (only ufunc buffers, of a fixed size)
+    ao = benchmark.synthetic(1, 32, 1536)
+    workspace = do_smoothing.ObjectiveWorkspace(ao, dtype=dtype)
+    ao_hat = np.nan_to_num(np.asarray(ao)).astype(dtype)
+    workspace.evaluate(ao_hat, 10.0)
+    tracemalloc.start()
+    workspace.evaluate(ao_hat, 10.0)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert peak < ao_hat.nbytes / 4
+
+
+def noisy_solutions(n_antennas=8, n_channel=256, sigma=0.1, seed=0):
+    '''
+    Smooth solutions (a bandpass ripple and a phase slope, different for each
+    antenna and pol), and those solutions with complex Gaussian noise added
+    '''
+    rng = np.random.default_rng(seed)
+    shape = (1, n_antennas, 1, 4)
+    freq = np.linspace(-1, 1, n_channel)[np.newaxis, np.newaxis, :, np.newaxis]
+    truth = (1 + 0.3*np.sin(2*freq + rng.uniform(0, 2*np.pi, shape))) * np.exp(1j*(rng.uniform(-3, 3, shape)*freq + rng.uniform(0, 2*np.pi, shape)))
+    noise = sigma*(rng.standard_normal(truth.shape) + 1j*rng.standard_normal(truth.shape))
+    return truth, aocal.AOCal(truth + noise)
+
+
+def test_select_lmbda_finds_the_best_lmbda():
+    truth, ao = noisy_solutions()
+    lmbdas = np.logspace(-2, 6, 17)
+    stickel = do_smoothing.GeneralisedStickel(ao, 1.0)
+    errors = []
+    for lmbda in lmbdas:
+        stickel.lmbda = lmbda
+        model = stickel.solve_banded()
+        # The model is only defined up to a phase per channel
+        theta = do_smoothing.optimal_rotation(model, truth, axis=(0, 1, 3))
+        errors.append(np.mean(np.abs(model - truth*np.exp(-1j*theta)[np.newaxis, np.newaxis, :, np.newaxis])**2))
+    best = np.argmin(errors)
+    assert 3 <= best <= 13
+
+    stickel.select_lmbda(lmbdas, method='banded')
+    assert stickel.criterion == 'gcv'
+    assert abs(np.flatnonzero(lmbdas == stickel.lmbda)[0] - best) <= 1
+
+
+@pytest.mark.parametrize("criterion", ["gcv", "lcurve"])
+def test_select_lmbda_refuses_a_range_without_an_optimum(criterion):
+    # GCV rises with lmbda, and the L-curve is bent the wrong way, across
+    # all of these (see select_lmbda())
+    ao, chans = trimmed(aocal.fromfile(B1934_FILE))
+    stickel = do_smoothing.GeneralisedStickel(ao, 1.0, freqs=chans)
+    with pytest.raises(ValueError, match="widen the range"):
+        stickel.select_lmbda(np.logspace(-2, 4, 7), criterion=criterion, method='banded')
+    assert len(stickel.curve) == 7
+
+
+def test_smooth_file_writes_short_intervals_unsmoothed(tmp_path):
+    ao = aocal.AOCal(np.repeat(np.asarray(benchmark.synthetic(1, 4, 24, n_flagged_tiles=0)), 2, axis=0))
+    ao[0, :, 1:] = np.nan
+    in_filename = str(tmp_path / "in.bin")
+    out_filename = str(tmp_path / "out.bin")
+    ao.tofile(in_filename)
+    intervals = [interval for interval, _ in do_smoothing.smooth_file(in_filename, out_filename, 1.0, method='banded')]
+    assert intervals == [1]
+    np.testing.assert_array_equal(aocal.fromfile(out_filename)[0], ao[0])
+    with pytest.raises(ValueError):
+        do_smoothing.smooth(ao[:1], 1.0)
+
+
+@pytest.mark.parametrize("jones", ["full", "constrained"])
+def test_smooth_incremental(tmp_path, jones):
+    ao = benchmark.synthetic(1, 6, 48, n_flagged_tiles=0)
+    cache = do_smoothing.SolutionCache(str(tmp_path))
+    first, _, info = do_smoothing.smooth_incremental(ao, 10.0, cache, jones=jones)
+    assert (info["status"], info["n_solved"]) == ("full", 24)
+
+    # The same input again comes straight from the cache
+    again, stickel, info = do_smoothing.smooth_incremental(ao, 10.0, cache, jones=jones)
+    assert stickel is None and (info["status"], info["n_solved"]) == ("cached", 0)
+    np.testing.assert_array_equal(again, first)
+
+    # Flagging some channels of one polarisation of one antenna re-solves
+    # just that spectrum (or, for the constrained model, that Jones matrix),
+    # reaching the cost of a full solve
+    flagged = ao.copy()
+    flagged[0, 2, 10:14, 0] = np.nan
+    smoothed, stickel, info = do_smoothing.smooth_incremental(flagged, 10.0, cache, jones=jones)
+    assert (info["status"], info["n_solved"]) == ("incremental", 1 if jones == "full" else 4)
+    unchanged = [0, 1, 3, 4, 5]
+    np.testing.assert_allclose(smoothed[0, unchanged], first[0, unchanged], rtol=0, atol=1e-12)
+    if jones == "full":
+        np.testing.assert_array_equal(smoothed[0, 2, :, 1:], first[0, 2, :, 1:])
+    assert not np.allclose(smoothed[0, 2, :, 0], first[0, 2, :, 0])
+    assert stickel.cost <= do_smoothing.smooth(flagged, 10.0, jones=jones)[1].cost * 1.001
+
+    # Flagging a whole channel changes the frequencies of every spectrum
+    flagged[:, :, 20] = np.nan
+    _, _, info = do_smoothing.smooth_incremental(flagged, 10.0, cache, jones=jones)
+    assert (info["status"], info["n_solved"]) == ("full", 24)
+
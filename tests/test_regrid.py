@@ -0,0 +1,88 @@
+import logging
+
+import numpy as np
+import pytest
+
+import aocal
+import regrid
+
+
+def delay_solutions(n_interval=2, n_antennas=4, n_channel=96, seed=0):
+    '''
+    Solutions which are exactly a delay times a linear amplitude, which the
+    delay method interpolates without error, as a function of the channel
+    index
+    '''
+    rng = np.random.default_rng(seed)
+    shape = (n_interval, n_antennas, 1, 4)
+    delay = rng.uniform(-0.3, 0.3, shape)
+    offset = rng.uniform(-np.pi, np.pi, shape)
+    amp = rng.uniform(0.5, 1.5, shape)
+    slope = rng.uniform(-0.002, 0.002, shape)
+    def gains(freqs):
+        f = np.asarray(freqs, dtype=float)[np.newaxis, np.newaxis, :, np.newaxis]
+        return (amp + slope*f) * np.exp(1j*(2*np.pi*delay*f + offset))
+    return gains
+
+
+def test_round_trip():
+    gains = delay_solutions()
+    ao = aocal.AOCal(gains(np.arange(96)))
+    ao[:, :, 40:44] = np.nan
+    fine_freqs = regrid.channel_grid(96, 384)
+    fine = regrid.regrid(ao, fine_freqs)
+    expected = gains(fine_freqs)
+    # Beyond the first and last channels, the values there are used
+    good = ~np.isnan(fine)
+    good[:, :, [0, 1, -2, -1]] = False
+    np.testing.assert_allclose(fine[good], expected[good], rtol=1e-10)
+    # The new channels nearest the flagged ones are flagged
+    flagged = np.all(np.isnan(fine), axis=(0, 1, 3))
+    np.testing.assert_array_equal(np.flatnonzero(flagged), np.arange(160, 176))
+
+    back = regrid.regrid(fine, np.arange(96), freqs=fine_freqs)
+    good = ~np.isnan(ao)
+    np.testing.assert_array_equal(np.isnan(back), ~good)
+    good[:, :, [0, -1]] = False
+    np.testing.assert_allclose(back[good], ao[good], rtol=1e-10)
+
+    # Across the gap, with fill_gaps
+    filled = regrid.regrid(ao, fine_freqs, fill_gaps=True)
+    np.testing.assert_allclose(filled[:, :, 2:-2], expected[:, :, 2:-2], rtol=1e-10)
+
+
+def test_uneven_channels():
+    # A subset of channels, with gaps between them: the delay is still
+    # found in turns per channel, not per sample
+    gains = delay_solutions()
+    freqs = np.concatenate((np.arange(0, 30), np.arange(45, 60), np.arange(61, 96, 2)))
+    ao = aocal.AOCal(gains(freqs))
+    new_freqs = np.arange(96)
+    np.testing.assert_allclose(regrid.regrid(ao, new_freqs, freqs=freqs, fill_gaps=True), gains(new_freqs), rtol=1e-10)
+
+
+@pytest.mark.parametrize("n_good", [1, 2])
+def test_smooth_with_too_few_channels(caplog, n_good):
+    gains = delay_solutions(n_interval=1)
+    ao = aocal.AOCal(gains(np.arange(96)))
+    ao[:, :, n_good:] = np.nan
+    new_freqs = regrid.channel_grid(96, 48)
+    with caplog.at_level(logging.WARNING):
+        smoothed = regrid.regrid(ao, new_freqs, method="smooth", fill_gaps=True)
+    assert "too few to smooth" in caplog.text
+    np.testing.assert_array_equal(smoothed, regrid.regrid(ao, new_freqs, fill_gaps=True))
+
+
+def test_regrid_file_smooth(tmp_path):
+    gains = delay_solutions()
+    ao = aocal.AOCal(gains(np.arange(96)))
+    ao[1, :, 2:] = np.nan  # an interval with too few channels to smooth
+    in_filename = str(tmp_path / "in.bin")
+    out_filename = str(tmp_path / "out.bin")
+    ao.tofile(in_filename)
+    new_freqs = regrid.channel_grid(96, 192)
+    regrid.regrid_file(in_filename, out_filename, new_freqs, method="smooth", lmbda=1.0, smooth_options={"method": "banded"})
+    out = aocal.fromfile(out_filename)
+    assert out.shape == (2, 4, 192, 4)
+    np.testing.assert_array_equal(out[1], regrid.regrid(ao[1:], new_freqs)[0])
+    assert not np.any(np.isnan(out[0]))
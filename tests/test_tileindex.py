@@ -0,0 +1,48 @@
+import os
+
+import numpy as np
+import pytest
+
+import tileindex
+from conftest import write_metafits
+
+
+def test_tile_index(tmp_path):
+    metafits = str(tmp_path / "obs.metafits")
+    write_metafits(metafits)
+    tileindex.clear_cache()
+    index = tileindex.tile_index(metafits)
+    np.testing.assert_array_equal(index.antenna, [0, 1, 2, 3])
+    np.testing.assert_array_equal(index.rx, [1, 1, 2, 2])
+    np.testing.assert_array_equal(index.slot, [1, 2, 1, 2])
+    np.testing.assert_array_equal(index.flavor, ['LMR', 'LMR', 'RG6', 'RG6'])
+    np.testing.assert_array_equal(index.rts_to_ao, [2, 0, 3, 1])
+    assert index.receiver_slot_order() == {1: {1: 0, 2: 1}, 2: {1: 2, 2: 3}}
+    assert tileindex.tile_index(metafits) is index
+
+
+def test_sidecar_is_used_and_invalidated(tmp_path, monkeypatch):
+    metafits = str(tmp_path / "obs.metafits")
+    write_metafits(metafits)
+    tileindex.clear_cache()
+    index = tileindex.tile_index(metafits, sidecar=True)
+    assert os.path.exists(tileindex.sidecar_filename(metafits))
+
+    # With the metafits file unchanged, the sidecar is read instead of it
+    tileindex.clear_cache()
+    def no_metafits(path):
+        raise AssertionError("metafits file read")
+    monkeypatch.setattr(tileindex.TileIndex, "from_metafits", staticmethod(no_metafits))
+    from_sidecar = tileindex.tile_index(metafits)
+    for field in tileindex.TileIndex.FIELDS:
+        np.testing.assert_array_equal(getattr(from_sidecar, field), getattr(index, field))
+
+    # A changed metafits file is read again, in this process and the next,
+    # and its sidecar is rewritten
+    monkeypatch.undo()
+    write_metafits(metafits, rx_offset=10)
+    os.utime(metafits, ns=(os.stat(metafits).st_atime_ns, os.stat(metafits).st_mtime_ns + 10**9))
+    np.testing.assert_array_equal(tileindex.tile_index(metafits, sidecar=True).rx, [11, 11, 12, 12])
+    tileindex.clear_cache()
+    monkeypatch.setattr(tileindex.TileIndex, "from_metafits", staticmethod(no_metafits))
+    np.testing.assert_array_equal(tileindex.tile_index(metafits).rx, [11, 11, 12, 12])
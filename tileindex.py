@@ -0,0 +1,126 @@
+"""
+Tile metadata from MWA metafits files, cached.
+
+Reading the tile table of a metafits file with astropy is slow compared with
+everything we do with it, and the same metafits file is typically used for
+many solutions. tile_index() returns a TileIndex, a small array-backed record
+of the tile table, which is memoised in-process (keyed by metafits path,
+modification time and size, with least-recently-used eviction) and can be
+persisted as a sidecar .npz file next to the metafits file, so that later runs
+need not import astropy at all.
+"""
+import os
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+CACHE_SIZE = 32
+SIDECAR_SUFFIX = ".tiles.npz"
+
+_cache = OrderedDict()
+
+
+class TileIndex(object):
+    """
+    Tile metadata, in AO (antenna) order:
+    antenna, rx, slot, flavor -- one entry per tile
+    rts_to_ao -- AO antenna index of each tile in metafits (RTS) order
+    """
+    FIELDS = ("antenna", "rx", "slot", "flavor", "rts_to_ao")
+
+    def __init__(self, antenna, rx, slot, flavor, rts_to_ao):
+        self.antenna = np.asarray(antenna)
+        self.rx = np.asarray(rx)
+        self.slot = np.asarray(slot)
+        self.flavor = np.asarray(flavor)
+        self.rts_to_ao = np.asarray(rts_to_ao)
+
+    @classmethod
+    def from_metafits(cls, metafits):
+        from astropy.io import fits
+
+        with fits.open(metafits) as hdus:
+            inputs = hdus['TILEDATA'].data
+            rts_to_ao = np.array(inputs['Antenna'][::2]) # only want each tile once
+            # This mirrors what cotter does (see metafitsfile.cpp MetaFitsFile::ReadTiles
+            tiles = inputs[inputs['Pol'] == 'X']
+            tiles = tiles[tiles['Antenna'].argsort()]
+            if 'Flavors' in inputs.columns.names:
+                flavor = np.array(tiles['Flavors']).astype(str)
+            else:
+                flavor = np.full(len(tiles), "")
+            return cls(np.array(tiles['Antenna']), np.array(tiles['Rx']), np.array(tiles['Slot']), flavor, rts_to_ao)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename, allow_pickle=False) as npz:
+            return cls(*(npz[field] for field in cls.FIELDS))
+
+    def save(self, filename, mtime_ns=0, size=0):
+        with open(filename, "wb") as f:
+            np.savez(f, mtime_ns=mtime_ns, size=size, **{field: getattr(self, field) for field in self.FIELDS})
+
+    def receiver_slot_order(self):
+        """
+        returns a dictionary of dictionaries which will give an AO ordinal index to each receiver and slot
+        """
+        rec_slot_dict = {}
+        for receiver in sorted(set(self.rx)):
+            rec_slot_dict[receiver] = {}
+            for slot in sorted(set(self.slot[self.rx == receiver])):
+                # tiles with this rec, slot
+                ant = self.antenna[(self.rx == receiver) & (self.slot == slot)]
+                if not len(ant) == 1:
+                    raise RuntimeError("Rx %d Slot %d does not map to a single antenna, but to %s" % (receiver, slot, str(ant)))
+                rec_slot_dict[receiver][slot] = ant[0]
+        return rec_slot_dict
+
+
+def sidecar_filename(metafits):
+    return metafits + SIDECAR_SUFFIX
+
+
+def _read_sidecar(filename, mtime_ns, size):
+    try:
+        with np.load(filename, allow_pickle=False) as npz:
+            if int(npz['mtime_ns']) != mtime_ns or int(npz['size']) != size:
+                logging.debug("%s is out of date", filename)
+                return None
+        return TileIndex.load(filename)
+    except (OSError, KeyError, ValueError) as e:
+        logging.debug("cannot read %s: %s", filename, e)
+        return None
+
+
+def tile_index(metafits, sidecar=False):
+    """
+    TileIndex of a metafits file, from the in-process cache, or else from a
+    valid sidecar .npz file, or else read from the metafits file. If sidecar
+    is True, a sidecar file is written when the metafits file has to be read.
+    """
+    path = os.path.abspath(metafits)
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+
+    sidecar_path = sidecar_filename(path)
+    index = _read_sidecar(sidecar_path, stat.st_mtime_ns, stat.st_size) if os.path.exists(sidecar_path) else None
+    if index is None:
+        index = TileIndex.from_metafits(path)
+        if sidecar:
+            try:
+                index.save(sidecar_path, stat.st_mtime_ns, stat.st_size)
+            except OSError as e:
+                logging.warning("cannot write tile index %s: %s", sidecar_path, e)
+
+    _cache[key] = index
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return index
+
+
+def clear_cache():
+    _cache.clear()